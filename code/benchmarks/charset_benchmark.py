@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Decoding time of fetched pages: requests (response.text) against decode_response
+# Run from the code folder:
+# - save pages (body and Content-Type header), from a file of URLs (one by line):
+#   PYTHONPATH=src python benchmarks/charset_benchmark.py save pages_folder --urls urls.txt
+# - compare both decodings on the saved pages (offline):
+#   PYTHONPATH=src python benchmarks/charset_benchmark.py run pages_folder
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from mana_common.shared import decode_response, USER_AGENT, TIMEOUT_REQUESTS_S
+
+
+# <n>.body: raw body, <n>.json: {"url": ..., "content_type": ...}
+def save(folder, urls_path):
+    os.makedirs(folder, exist_ok=True)
+    with open(urls_path, encoding="utf-8") as f:
+        urls = [line.strip() for line in f if line.strip()]
+    saved = 0
+    for i, url in enumerate(urls):
+        try:
+            response = requests.get(url, headers={'User-Agent': USER_AGENT}, timeout=TIMEOUT_REQUESTS_S)
+        except Exception as ex:
+            print("{}: {}".format(url, ex))
+            continue
+        with open(os.path.join(folder, "{}.body".format(i)), "wb") as f:
+            f.write(response.content)
+        with open(os.path.join(folder, "{}.json".format(i)), "w", encoding="utf-8") as f:
+            json.dump({"url": url, "content_type": response.headers.get("content-type", "")}, f)
+        saved += 1
+    print("{} page(s) saved in {}".format(saved, folder))
+
+
+def load_response(folder, name):
+    with open(os.path.join(folder, name + ".json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    response = requests.models.Response()
+    with open(os.path.join(folder, name + ".body"), "rb") as f:
+        response._content = f.read()
+    response.headers = CaseInsensitiveDict({"content-type": meta["content_type"]})
+    # As requests.get does
+    response.encoding = get_encoding_from_headers(response.headers)
+    return meta["url"], response
+
+
+def run(folder):
+    names = sorted(name[:-len(".json")] for name in os.listdir(folder) if name.endswith(".json"))
+    requests_ms = []
+    decode_ms = []
+    different = []
+    for name in names:
+        url, response = load_response(folder, name)
+        started_at = time.perf_counter()
+        requests_text = response.text
+        requests_ms.append((time.perf_counter() - started_at) * 1000)
+        started_at = time.perf_counter()
+        text = decode_response(response)
+        decode_ms.append((time.perf_counter() - started_at) * 1000)
+        if text != requests_text:
+            different.append(url)
+
+    print("Pages: {}".format(len(names)))
+    print("response.text: mean {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms".format(
+        np.mean(requests_ms), np.percentile(requests_ms, 95), np.max(requests_ms)))
+    print("decode_response: mean {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms".format(
+        np.mean(decode_ms), np.percentile(decode_ms, 95), np.max(decode_ms)))
+    # Mostly text/html pages without charset header, which requests decodes as latin-1
+    print("Decoded differently: {}".format(len(different)))
+    for url in different:
+        print("  {}".format(url))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Charset detection benchmark")
+    parser.add_argument("command", choices=["save", "run"])
+    parser.add_argument("folder", help="folder of saved pages")
+    parser.add_argument("--urls", help="file of URLs to save, one by line")
+    args = parser.parse_args()
+    if args.command == "save":
+        save(args.folder, args.urls)
+    else:
+        run(args.folder)
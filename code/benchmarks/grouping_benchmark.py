@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Candidates for suggested matches of source grouping: fuzzy index (bigram prefixes) against every pair
+# of entities compared with is_suggested_match, on synthetic entities
+# Run from the code folder:
+#   PYTHONPATH=src python benchmarks/grouping_benchmark.py --sizes 10000 50000 100000
+import time
+import random
+import argparse
+
+from source_grouping.main import is_suggested_match, FUZZY_MATCH_SUGGESTED_THRESHOLD
+from source_grouping.fuzzy import FuzzyIndex
+
+WORDS = ["green", "peace", "earth", "wild", "life", "ocean", "climate", "forest", "river", "eco", "bio", "sun", "terra",
+         "natur", "friends", "action", "watch", "news", "planet", "future", "clean", "water", "land", "rain", "coral"]
+CONSONANTS = "bcdfghjklmnprstvwz"
+VOWELS = "aeiou"
+VARIANTS = ["", "", "", "_uk", "_fr", "usa", "news", "_org", "media", "1", "_official", "hq"]
+TLDS = ["org", "com", "net", "org.uk", "de", "fr", "co.id", "eu"]
+PATHS = ["", "", "", "/en", "/fr/", "/news", "/blog/", "/about-us", "/international"]
+
+
+def create_word(generator):
+    if generator.random() < 0.3:
+        return generator.choice(WORDS)
+    return "".join(generator.choice(CONSONANTS) + generator.choice(VOWELS) for _ in range(generator.randint(2, 4)))
+
+
+def create_organization(generator):
+    name = "".join(create_word(generator) for _ in range(generator.randint(1, 2)))
+    return name, "https://{}{}.{}".format(generator.choice(["", "www.", "www."]), name, generator.choice(TLDS))
+
+
+# Entities as returned by get_repartition_entities: organizations with one or several sources, some of them
+# twice (different variants of the same names and sites)
+def create_entities(count, seed=1):
+    generator = random.Random(seed)
+    organizations = [create_organization(generator) for _ in range(max(count // 2, 1))]
+    entities = []
+    for i in range(count):
+        name, site = generator.choice(organizations)
+        origins = []
+        for j in range(generator.randint(1, 3)):
+            kind = generator.choice(["twitter_origin", "web_origin", "rss_origin"])
+            if kind == "twitter_origin":
+                origins.append({"type": kind, "screen_name": (name + generator.choice(VARIANTS))[:15],
+                                "twitter_profile_url": site if generator.random() < 0.7 else None})
+            elif kind == "web_origin":
+                url = site + generator.choice(PATHS)
+                origins.append({"type": kind, "expanded_url": url, "base_url": url})
+            else:
+                origins.append({"type": kind})
+        entities.append({"id": i, "name": name, "is_reference": generator.random() < 0.1, "origins": origins})
+    return entities
+
+
+def run(size, pairs_sample, check_size):
+    entities = create_entities(size)
+    started_at = time.perf_counter()
+    fuzzy_index = FuzzyIndex(entities, FUZZY_MATCH_SUGGESTED_THRESHOLD)
+    index_s = time.perf_counter() - started_at
+    candidates = sum(len(ids) for ids in fuzzy_index.candidates.values()) // 2
+
+    # Every pair: timed on a sample, then extrapolated
+    generator = random.Random(size)
+    sample = [(generator.choice(entities), generator.choice(entities)) for _ in range(pairs_sample)]
+    started_at = time.perf_counter()
+    for e1, e2 in sample:
+        is_suggested_match(e1, e2)
+    pair_s = (time.perf_counter() - started_at) / pairs_sample
+    pairs = size * (size - 1) // 2
+
+    # The candidates of the index contain every suggested match among the first entities
+    suggested = missed = 0
+    for i, e1 in enumerate(entities[:check_size]):
+        for e2 in entities[i + 1:check_size]:
+            if is_suggested_match(e1, e2)[0]:
+                suggested += 1
+                missed += e2["id"] not in fuzzy_index.get_candidates(e1)
+
+    print("{} entities".format(size))
+    print("  every pair:   {} pairs, ~{:.0f} s (extrapolated from {} pairs)".format(pairs, pairs * pair_s, pairs_sample))
+    print("  fuzzy index:  {} candidate pairs, {:.1f} s, ~{:.1f} s more to check them".format(
+        candidates, index_s, candidates * pair_s))
+    print("  suggested matches among the first {} entities: {}, missed by the fuzzy index: {}".format(
+        check_size, suggested, missed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--pairs-sample", type=int, default=100000)
+    parser.add_argument("--check-size", type=int, default=1000)
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.pairs_sample, args.check_size)
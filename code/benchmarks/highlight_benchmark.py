@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmark of the highlighting of daniel_evaluation: chained str.replace (previous implementation) vs. spans
+# Run from the code folder: PYTHONPATH=src python benchmarks/highlight_benchmark.py
+import re
+import random
+import timeit
+
+from content_analysis.highlight import SentenceIndex, Highlighter, keyword_score_label
+
+# Same size as the longest analysed texts (TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS)
+TEXT_LENGTH = 50000
+VOCABULARY_SIZE = 3000
+# Keywords returned by NLU (nlu_analysis returns up to 50 keywords)
+KEYWORDS = 50
+CONFIRMED_SENTENCES = 20
+ALERTING_ENTITIES = 5
+# (keywords, confirmed sentences) highlighted: the replace chain scans the text once per pattern
+HIGHLIGHT_SIZES = [(KEYWORDS, CONFIRMED_SENTENCES), (200, 50), (500, 100)]
+
+
+def generate_vocabulary(rnd):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rnd.choice(letters) for _ in range(rnd.randint(2, 10))) for _ in range(VOCABULARY_SIZE)] + ["$"]
+
+
+# Random sentences of words with a Zipf-like distribution (a few frequent words, many rare ones)
+def generate_text(length, seed=42):
+    rnd = random.Random(seed)
+    vocabulary = generate_vocabulary(rnd)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    sentences = []
+    size = 0
+    while size < length:
+        sentence = " ".join(rnd.choices(vocabulary, weights, k=rnd.randint(8, 25))).capitalize()
+        sentences.append(sentence)
+        size += len(sentence) + 2
+    return ". ".join(sentences)
+
+
+def legacy_highlight(text, sentences, keywords, entities):
+    for sentence in sentences:
+        text = text.replace(sentence, '<mark style="background-color: yellow">' + sentence + '</mark>')
+    for keyword, score in keywords:
+        text = text.replace(keyword, '<mark style="background-color: orange">' + keyword + keyword_score_label(score) +
+                            '</mark>')
+    for entity in entities:
+        text = text.replace(entity, '<mark style="background-color: red">' + entity + '</mark>')
+    return text.replace('$', 'dollars')
+
+
+def span_highlight(text, sentences, keywords, entities):
+    # The regex of the patterns is compiled for each text
+    re.purge()
+    highlighter = Highlighter(text)
+    for sentence in sentences:
+        highlighter.mark(sentence, "yellow")
+    for keyword, score in keywords:
+        highlighter.mark(keyword, "orange", label=keyword_score_label(score))
+    for entity in entities:
+        highlighter.mark(entity, "red")
+    return highlighter.render(replace_dollars=True)
+
+
+def legacy_sentences_containing(text, keywords):
+    return [[s for s in text.split('. ') if keyword in s] for keyword, _ in keywords]
+
+
+def indexed_sentences_containing(text, keywords):
+    index = SentenceIndex(text)
+    return [index.sentences_containing(keyword) for keyword, _ in keywords]
+
+
+# Keywords are 1 to 3 consecutive words of the text, alerting entities are some of the keywords
+def pick_marks(all_sentences, keyword_count, sentence_count, seed=7):
+    rnd = random.Random(seed)
+    keywords = []
+    for _ in range(keyword_count):
+        words = rnd.choice(all_sentences).split(" ")
+        start = rnd.randrange(len(words))
+        keywords.append((" ".join(words[start:start + rnd.randint(1, 3)]), rnd.uniform(-1, 1)))
+    entities = [keyword for keyword, _ in rnd.sample(keywords, ALERTING_ENTITIES)]
+    sentences = rnd.sample(all_sentences, sentence_count)
+    return sentences, keywords, entities
+
+
+def main():
+    text = generate_text(TEXT_LENGTH)
+    all_sentences = text.split('. ')
+    sentences, keywords, entities = pick_marks(all_sentences, KEYWORDS, CONFIRMED_SENTENCES)
+
+    # Outputs are the same when marks do not overlap: whole sentences, and capitalized words (first of a sentence)
+    # that are neither in these sentences nor part of the HTML of the marks
+    first_words = [s.split(" ")[0] for s in all_sentences if len(s.split(" ")[0]) > 6]
+    distinct = [w for w in sorted(set(first_words)) if not any(w in s for s in sentences)][:4]
+    assert legacy_highlight(text, sentences, [(w, 0.5) for w in distinct[:2]], distinct[2:]) == \
+        span_highlight(text, sentences, [(w, 0.5) for w in distinct[:2]], distinct[2:])
+    assert legacy_sentences_containing(text, keywords) == indexed_sentences_containing(text, keywords)
+
+    runs = 20
+    benchmarks = []
+    for keyword_count, sentence_count in HIGHLIGHT_SIZES:
+        marks = pick_marks(all_sentences, keyword_count, sentence_count)
+        size = "{} keywords, {} sentences".format(keyword_count, sentence_count)
+        benchmarks.append(("highlight / str.replace / " + size, legacy_highlight, (text,) + marks))
+        benchmarks.append(("highlight / spans / " + size, span_highlight, (text,) + marks))
+    benchmarks.append(("keyword sentences / split per keyword", legacy_sentences_containing, (text, keywords)))
+    benchmarks.append(("keyword sentences / sentence index", indexed_sentences_containing, (text, keywords)))
+    for name, function, args in benchmarks:
+        duration = min(timeit.repeat(lambda: function(*args), number=runs, repeat=3)) / runs
+        print("{:<60} {:8.2f} ms".format(name, duration * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Agreement and latency of the local language identification against recorded Watson identify results, or against
+# the labelled sample of langid_sample.jsonl (the thresholds of langid.py are calibrated on it)
+# Run from the code folder:
+# - record a sample (needs the database and Watson Language Translator credentials, see env-local-dev):
+#   PYTHONPATH=src python benchmarks/langid_benchmark.py record identify_sample.jsonl --size 500
+# - compare the local identification with the recorded results (offline):
+#   PYTHONPATH=src python benchmarks/langid_benchmark.py run identify_sample.jsonl
+# - compare it with the labels of the committed sample (offline):
+#   PYTHONPATH=src python benchmarks/langid_benchmark.py run benchmarks/langid_sample.jsonl
+import json
+import time
+import argparse
+
+import numpy as np
+
+from content_analysis.langid import identify_language_locally, load_profiles, is_local_result_trusted
+
+
+# One JSON line per text: {"text": ..., "language": ..., "confidence": ..., "latency_ms": ...} (only text and language
+# in the labelled sample)
+def record(path, size):
+    from mana_common import orm
+    from mana_common.orm import Analysis
+    from mana_common.shared import get_translator
+
+    texts = [row[0] for row in orm.get_session().query(Analysis.original_text)
+             .filter(Analysis.original_text != None, Analysis.original_text != "")
+             .order_by(Analysis.id.desc()).limit(size).all()]
+    with open(path, "w", encoding="utf-8") as f:
+        for text in texts:
+            started_at = time.perf_counter()
+            result = get_translator().identify(text).get_result()["languages"][0]
+            f.write(json.dumps({
+                "text": text,
+                "language": result["language"],
+                "confidence": result["confidence"],
+                "latency_ms": (time.perf_counter() - started_at) * 1000
+            }, ensure_ascii=False) + "\n")
+    print("{} Watson identify results recorded in {}".format(len(texts), path))
+
+
+def run(path):
+    with open(path, encoding="utf-8") as f:
+        sample = [json.loads(line) for line in f if line.strip()]
+    load_profiles()
+
+    latencies = []
+    agree = 0
+    confident = 0
+    confident_agree = 0
+    for item in sample:
+        started_at = time.perf_counter()
+        language, _, margin, letters = identify_language_locally(item["text"])
+        latencies.append((time.perf_counter() - started_at) * 1000)
+        same = language is not None and language.lower() == item["language"].lower()
+        agree += same
+        if is_local_result_trusted(language, margin, letters):
+            confident += 1
+            confident_agree += same
+
+    print("Texts: {}".format(len(sample)))
+    print("Agreement (all texts): {:.1%}".format(agree / len(sample)))
+    print("Decided locally (confident): {:.1%}, agreement: {:.1%}".format(
+        confident / len(sample), confident_agree / confident if confident else 0))
+    print("Local latency: mean {:.2f} ms, p95 {:.2f} ms".format(np.mean(latencies), np.percentile(latencies, 95)))
+    remote = [item["latency_ms"] for item in sample if "latency_ms" in item]
+    if remote:
+        print("Recorded Watson latency: mean {:.2f} ms, p95 {:.2f} ms".format(np.mean(remote),
+                                                                             np.percentile(remote, 95)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local language identification benchmark")
+    parser.add_argument("command", choices=["record", "run"])
+    parser.add_argument("sample", help="JSON lines file of recorded Watson identify results")
+    parser.add_argument("--size", type=int, default=500, help="number of texts to record")
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args.sample, args.size)
+    else:
+        run(args.sample)
@@ -5,9 +5,11 @@ import io
 import pandas as pd
 import os
 from mana_common.shared import log, get_twitter_infos, set_logger
-from mana_common.orm import setup_db, get_session, get_db_engine, SCHEMA
-from mana_common.orm import Company, CompanySynonym, merge_entities, load_cache_companies, ContentType, TwitterOrigin
+from mana_common.orm import setup_db, get_session, get_db_engine, SCHEMA, upgrade_origin_columns
+from mana_common.orm import Company, CompanySynonym, merge_entities, load_cache_companies, ContentType, TwitterOrigin, \
+    ContentLease, RssDiscovery, GroupingKey
 from api.tests import analyse_test_contents, extract_rss_articles, extract_content_from_url
+from content_analysis.leases import get_content_queue_status
 from api.auth import any_role, Role
 from api.companies import check_companies_duplicates, delete_companies_not_used_by_analysis, process_companies, \
     compute_companies_kpis, company_name_column, synonym_column, delete_company_from_db
@@ -51,6 +53,10 @@ def init_api():
     log.info("Will use schema: {}".format(SCHEMA))
     Company.__table__.create(bind=get_db_engine(), checkfirst=True)
     CompanySynonym.__table__.create(bind=get_db_engine(), checkfirst=True)
+    ContentLease.__table__.create(bind=get_db_engine(), checkfirst=True)
+    RssDiscovery.__table__.create(bind=get_db_engine(), checkfirst=True)
+    GroupingKey.__table__.create(bind=get_db_engine(), checkfirst=True)
+    upgrade_origin_columns()
 
     load_cache_companies()
 
@@ -287,6 +293,19 @@ async def download_data(startDate: date, endDate: date):
     return StreamingResponse(output, headers=headers)
 
 
+@app.get(
+    "/analysis/queue",
+    tags=["Data"],
+    summary="Content analysis queue status",
+    description="Number of contents not analysed yet (and not given up), and content leases that are in flight, "
+                + "expired (worker most likely crashed), done, failed and to be retried, or failed too many times "
+                + "(content given up). Leases are only used when content analysis runs with `CA_USE_LEASES` set.",
+    dependencies=[Security(any_role([Role.ADMIN]))]
+)
+async def get_analysis_queue():
+    return get_content_queue_status()
+
+
 @app.post(
     "/tests/tweets/ca",
     tags=["Tests"],
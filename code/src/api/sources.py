@@ -1,6 +1,7 @@
-from mana_common.shared import log, find_rss_feed, check_if_url_match_pattern
+from mana_common.shared import log, check_if_url_match_pattern
 from mana_common.orm import Group, Entity, Origin, TwitterOrigin, WebOrigin, RssOrigin, update_tweeter_profile, \
-    retrieve_tweeter_profile, create_web_and_rss_origins, create_twitter_origin, get_config
+    retrieve_tweeter_profile, create_web_and_rss_origins, create_twitter_origin, get_config_matchers, \
+    find_rss_feed_cached, find_origin_by_base_url, belongs_to_other_entity
 from api.utils import list_duplicates
 import pandas as pd
 from fastapi import HTTPException
@@ -129,18 +130,32 @@ def update_source(db, entity, group, is_reference, twitter, web, is_trusted, loc
         previous_web_origins = list(filter(lambda o : isinstance(o, WebOrigin), entity.origins))
         if len(previous_web_origins) > 0:
             web_origin = previous_web_origins[0]
-            if (web_origin.raw_url != web):
+            existing_web_origin_in_db = find_origin_by_base_url(WebOrigin, web)
+            if existing_web_origin_in_db is not None and existing_web_origin_in_db is not web_origin:
+                # The entity keeps its web origin: it would have two of them, and the other entity could have none
+                log.warning("this web site already exists in db {} (entity {}), keeping web origin {}".format(
+                    web, existing_web_origin_in_db.entity_id, web_origin.base_url))
+            elif (web_origin.raw_url != web):
                 log.info("Updating web origin {} to {}".format(web_origin.raw_url, web))
                 web_origin.raw_url = web
                 web_origin.base_url = web
                 web_origin.expanded_url = web
-                if not check_if_url_match_pattern(web, get_config()["ignore_for_rss_search"]):
-                    rss = find_rss_feed(web)
+                if not check_if_url_match_pattern(web, get_config_matchers()["ignore_for_rss_search"]):
+                    rss = find_rss_feed_cached(web)
                     previous_rss_origins = list(filter(lambda o : isinstance(o, RssOrigin), entity.origins))
                     if rss is not None:
                         log.info("Found rss {}".format(rss))
                         
-                        if len(previous_rss_origins) > 0:
+                        existing_rss_origin_in_db = find_origin_by_base_url(RssOrigin, web_origin.base_url)
+                        if existing_rss_origin_in_db is not None \
+                                and belongs_to_other_entity(existing_rss_origin_in_db, entity):
+                            log.warning("this rss already exists in db {} (entity {}), not linking it".format(
+                                existing_rss_origin_in_db.rss, existing_rss_origin_in_db.entity_id))
+                        elif existing_rss_origin_in_db is not None:
+                            log.info("this rss already exists in db {}, linking it".format(existing_rss_origin_in_db.rss))
+                            existing_rss_origin_in_db.entity = entity
+                            existing_rss_origin_in_db.origin_web = web_origin
+                        elif len(previous_rss_origins) > 0:
                             log.info("Previous web site has an rss, updating it")
                             rss_origin = previous_rss_origins[0]
                             rss_origin.rss = rss
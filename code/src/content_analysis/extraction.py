@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import multiprocessing
+
+from bs4 import BeautifulSoup
+
+from mana_common.shared import log
+
+# ----------------------------------------------------------------------------------------
+# Supervised extraction: HTML parsing and PDF pages (see pdf.py) run in a pool of worker
+# processes, so that a pathological document (huge DOM, malformed PDF) cannot hang the
+# analysis loop:
+# - every task has a hard timeout: the stuck worker is killed and the pool replaced
+# - every worker has a memory ceiling (address space), a task that exceeds it fails
+# - workers are replaced after a number of tasks (memory held by lxml / MuPDF)
+# A document that cannot be extracted raises ExtractionError, its analysis gets the
+# 'failed_at_extraction' status with the reason.
+# ----------------------------------------------------------------------------------------
+
+EXTRACTION_WORKERS = 2
+EXTRACTION_TIMEOUT_S = 30
+EXTRACTION_MAX_TASKS_PER_WORKER = 100
+EXTRACTION_MEMORY_LIMIT_MB = 1024
+EXTRACTION_START_METHOD = "spawn"
+
+_extraction_pool = None
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def get_extraction_workers():
+    return int(os.getenv("CA_EXTRACTION_WORKERS", EXTRACTION_WORKERS))
+
+
+def get_extraction_timeout():
+    return float(os.getenv("CA_EXTRACTION_TIMEOUT_S", EXTRACTION_TIMEOUT_S))
+
+
+def get_extraction_max_tasks_per_worker():
+    return int(os.getenv("CA_EXTRACTION_MAX_TASKS_PER_WORKER", EXTRACTION_MAX_TASKS_PER_WORKER))
+
+
+def get_extraction_memory_limit_mb():
+    return int(os.getenv("CA_EXTRACTION_MEMORY_LIMIT_MB", EXTRACTION_MEMORY_LIMIT_MB))
+
+
+# Runs in a worker process when it starts
+def init_extraction_worker(memory_limit_mb):
+    if memory_limit_mb > 0:
+        import resource
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# Daemon processes (e.g. multiprocessing.Pool workers) cannot have children: there, extraction runs in-process, without
+# timeout nor memory ceiling. The content analysis workers (see main.analyse_contents_in_workers) are not daemons.
+def is_extraction_isolated():
+    return not multiprocessing.current_process().daemon
+
+
+def get_extraction_pool():
+    global _extraction_pool
+    if _extraction_pool is None:
+        _extraction_pool = multiprocessing.get_context(EXTRACTION_START_METHOD).Pool(
+            processes=get_extraction_workers(),
+            initializer=init_extraction_worker,
+            initargs=(get_extraction_memory_limit_mb(),),
+            maxtasksperchild=get_extraction_max_tasks_per_worker()
+        )
+    return _extraction_pool
+
+
+def close_extraction_pool(terminate=False):
+    global _extraction_pool
+    if _extraction_pool is not None:
+        if terminate:
+            _extraction_pool.terminate()
+        else:
+            _extraction_pool.close()
+        _extraction_pool.join()
+        _extraction_pool = None
+
+
+def describe_extraction_failure(ex):
+    if isinstance(ex, MemoryError):
+        return "memory limit of {} MB exceeded".format(get_extraction_memory_limit_mb())
+    return "{}: {}".format(type(ex).__name__, ex)
+
+
+# Result of function(*args) computed by a worker process, ExtractionError if it fails or takes too long
+def run_extraction_task(function, *args, timeout=None):
+    timeout = timeout if timeout is not None else get_extraction_timeout()
+    try:
+        if not is_extraction_isolated():
+            return function(*args)
+        result = get_extraction_pool().apply_async(function, args)
+        try:
+            return result.get(timeout)
+        except multiprocessing.TimeoutError:
+            # The worker is stuck (or died): replace the pool
+            close_extraction_pool(terminate=True)
+            raise ExtractionError("{} not done after {}s".format(function.__name__, timeout))
+    except ExtractionError:
+        raise
+    except Exception as ex:
+        raise ExtractionError(describe_extraction_failure(ex))
+
+
+def find_useful_div(p):
+    parent = p.find_parent('article')
+    if parent is not None:
+        return parent
+
+    max_parent_lookup = 5
+    current_lookup = 1
+    parent = p.parent
+    while parent is not None and len(parent.find_all('p')) <= 1 and current_lookup < max_parent_lookup:
+        parent = parent.parent
+        current_lookup = current_lookup + 1
+    return parent
+
+
+def is_useful_paragraph(p, social_keywords_pattern):
+    if p.find_parent('header') is not None \
+            or p.find_parent('div', {"id": "header"}) is not None \
+            or p.find_parent('nav') is not None:
+        return False
+
+    if len(set(re.findall(social_keywords_pattern, p.text.lower()))) >= 1:
+        if p.find_parent('a'):
+            return False
+
+    return True
+
+
+# Runs in a worker process: text of the useful paragraphs of a page, with the index (in the returned texts of divs) of
+# the div they belong to
+def parse_html_paragraphs(html_content, social_keywords_pattern):
+    soup = BeautifulSoup(html_content, "lxml")
+    for p in soup.find_all("p"):
+        if not (is_useful_paragraph(p, social_keywords_pattern)):
+            p.parent.decompose()
+
+    paragraphs = []
+    div_texts = []
+    div_indexes = {}
+    for p in soup.find_all("p"):
+        useful_div = find_useful_div(p)
+        div_index = None
+        if useful_div is not None:
+            if id(useful_div) not in div_indexes:
+                div_indexes[id(useful_div)] = len(div_texts)
+                div_texts.append(" ".join([e.text for e in useful_div.find_all(["p", "h1", "h2"])])
+                                 .replace("\n", "").replace("\r", ""))
+            div_index = div_indexes[id(useful_div)]
+        paragraphs.append((p.text, div_index))
+    return paragraphs, div_texts
+
+
+# Text of the div of the first paragraph that is relevant according to is_relevant(text) (checked in this process),
+# "" if there is none
+def extract_html_text(html_content, social_keywords_pattern, is_relevant):
+    paragraphs, div_texts = run_extraction_task(parse_html_paragraphs, html_content, social_keywords_pattern)
+    for text, div_index in paragraphs:
+        if is_relevant(text):
+            log.info("HTML Content - NLU match found for text: {}".format(text))
+            if div_index is not None:
+                # text is in original language
+                return div_texts[div_index]
+            break
+    log.info("HTML Content - Did not find useful div")
+    return ""
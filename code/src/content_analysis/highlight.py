@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import re
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+# ----------------------------------------------------------------------------------------
+# Highlighting of the analysed text (see daniel_evaluation): the occurrences of all the
+# marked patterns are found in a single pass over the original text (one regex of their
+# first characters, as a trie, so that a position is only checked against the patterns it
+# may start), overlaps of these spans are resolved, then the HTML is rendered in a single
+# pass. A mark may contain another one (e.g. a keyword in a confirmed sentence) but
+# two marks never partially overlap: the one of the lowest layer (first color used) wins.
+# ----------------------------------------------------------------------------------------
+
+SENTENCE_SEPARATOR = ". "
+# Patterns are looked for by their first characters (the regex of long sentences takes long to compile), then checked
+PATTERN_KEY_LENGTH = 16
+
+
+# Sentences of a text (split on ". ", as the assistant confirmation does), with their offsets so that the sentences
+# containing a keyword are found from the occurrences of the keyword in the whole text
+class SentenceIndex:
+    def __init__(self, text, separator=SENTENCE_SEPARATOR):
+        self.text = text
+        self.sentences = text.split(separator)
+        self.starts = []
+        offset = 0
+        for sentence in self.sentences:
+            self.starts.append(offset)
+            offset += len(sentence) + len(separator)
+
+    def end(self, i):
+        return self.starts[i] + len(self.sentences[i])
+
+    # Same result as [s for s in text.split(". ") if keyword in s]
+    def sentences_containing(self, keyword):
+        if len(keyword) == 0:
+            return list(self.sentences)
+        found = []
+        position = self.text.find(keyword)
+        while position >= 0:
+            i = bisect_right(self.starts, position) - 1
+            if position + len(keyword) <= self.end(i):
+                found.append(self.sentences[i])
+                # One occurrence is enough: go on with the next sentence
+                if i + 1 == len(self.sentences):
+                    break
+                position = self.text.find(keyword, self.starts[i + 1])
+            else:
+                # Occurrence over a separator: there may be another one starting within it
+                position = self.text.find(keyword, position + 1)
+        return found
+
+
+# Regex of the alternation of the patterns, longest first, factored as a trie
+def get_patterns_regex(patterns):
+    return _get_trie_regex(sorted(set(patterns)), 0)
+
+
+# patterns: sorted, sharing their first depth characters
+def _get_trie_regex(patterns, depth):
+    # Sorted: a pattern ending there comes first
+    optional = len(patterns[0]) == depth
+    if optional:
+        patterns = patterns[1:]
+    alternatives = []
+    i = 0
+    while i < len(patterns):
+        j = i + 1
+        while j < len(patterns) and patterns[j][depth] == patterns[i][depth]:
+            j += 1
+        # Characters shared by the patterns of the branch (the first and the last ones) are appended as they are
+        first, last = patterns[i], patterns[j - 1]
+        end = depth + 1
+        while end < len(first) and first[end] == last[end]:
+            end += 1
+        alternatives.append(re.escape(first[depth:end]) + _get_trie_regex(patterns[i:j], end))
+        i = j
+    if len(alternatives) == 0:
+        return ""
+    regex = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+    # Optional (greedy) when a pattern ends there: the longest one is matched first
+    return "(?:" + regex + ")?" if optional else regex
+
+
+def keyword_score_label(score):
+    return "(" + str(round(score, 2)) + ")"
+
+
+class Highlighter:
+    def __init__(self, text):
+        self.text = text
+        self._layers = {}
+        self._tags = {}
+        # pattern -> [(layer, color, label)]
+        self._marks = {}
+
+    # Marks all (non overlapping) occurrences of pattern, like text.replace(pattern, '<mark ...>' + pattern + label...)
+    def mark(self, pattern, color, label=""):
+        if len(pattern) == 0:
+            return
+        layer = self._layers.setdefault(color, len(self._layers))
+        self._tags[color] = '<mark style="background-color: {}">'.format(color)
+        self._marks.setdefault(pattern, []).append((layer, color, label))
+
+    # Spans (start, end, layer, color, label) of the marks, by start then longest first. The regex gives the longest
+    # key (first characters of the patterns) starting at a position: the patterns starting there have this key or one
+    # of its prefixes.
+    def find_spans(self):
+        if len(self._marks) == 0:
+            return []
+        # key -> patterns, longest first
+        keys = defaultdict(list)
+        for pattern in sorted(self._marks, key=len, reverse=True):
+            keys[pattern[:PATTERN_KEY_LENGTH]].append(pattern)
+        # matched key -> patterns that may start there, longest first
+        candidates = {}
+        search = re.compile(get_patterns_regex(keys)).search
+        # pattern -> end of its last occurrence: occurrences of a pattern do not overlap (as for str.replace)
+        ends = {}
+        spans = []
+        match = search(self.text)
+        while match is not None:
+            start = match.start()
+            key = match.group()
+            if key not in candidates:
+                candidates[key] = sorted((p for n in range(1, len(key) + 1) for p in keys.get(key[:n], [])),
+                                         key=len, reverse=True)
+            for pattern in candidates[key]:
+                # A pattern is only longer than its key when it is longer than PATTERN_KEY_LENGTH
+                if start >= ends.get(pattern, 0) and (len(pattern) <= PATTERN_KEY_LENGTH or
+                                                      self.text.startswith(pattern, start)):
+                    end = start + len(pattern)
+                    ends[pattern] = end
+                    for layer, color, label in self._marks[pattern]:
+                        spans.append((start, end, layer, color, label))
+            # Next position: patterns may overlap
+            match = search(self.text, start + 1)
+        return spans
+
+    # Groups of overlapping spans to render, outer ones first: most spans overlap no other one and are kept as they are
+    def resolve_span_groups(self):
+        group = []
+        group_end = 0
+        for span in self.find_spans():
+            if span[0] >= group_end and len(group) > 0:
+                yield group if len(group) == 1 else self._resolve_group(group)
+                group = []
+            group.append(span)
+            group_end = max(group_end, span[1])
+        if len(group) > 0:
+            yield group if len(group) == 1 else self._resolve_group(group)
+
+    # Keeps the spans by layer (then position); a span partially overlapping a kept one (or identical to a kept one of
+    # the same layer) is dropped. Kept spans are indexed by start and by end so that only the spans starting or ending
+    # within the new one are checked.
+    def _resolve_group(self, spans):
+        accepted = []
+        by_start = []
+        by_end = []
+        for span in sorted(spans, key=lambda s: (s[2], s[0], -s[1])):
+            start, end, layer = span[0], span[1], span[2]
+            if self._overlaps(by_start, by_end, start, end, layer):
+                continue
+            accepted.append(span)
+            insort(by_start, (start, end, layer))
+            insort(by_end, (end, start))
+        # Outer spans first: the widest one, then the lowest layer when two marks cover the same text
+        return sorted(accepted, key=lambda s: (s[0], -s[1], s[2]))
+
+    @staticmethod
+    def _overlaps(by_start, by_end, start, end, layer):
+        i = bisect_left(by_start, (start,))
+        while i < len(by_start) and by_start[i][0] < end:
+            a_start, a_end, a_layer = by_start[i]
+            if (a_start > start and a_end > end) or (a_start == start and a_end == end and a_layer == layer):
+                return True
+            i += 1
+        i = bisect_right(by_end, (start, float("inf")))
+        while i < len(by_end) and by_end[i][0] < end:
+            if by_end[i][1] < start:
+                return True
+            i += 1
+        return False
+
+    def render(self, replace_dollars=False):
+        text = self.text
+        parts = []
+        position = 0
+        for group in self.resolve_span_groups():
+            if len(group) == 1:
+                start, end, _, color, label = group[0]
+                parts += (text[position:start], self._tags[color], text[start:end], label, '</mark>')
+                position = end
+                continue
+            opened = []
+            for start, end, _, color, label in group:
+                while len(opened) > 0 and opened[-1][0] <= start:
+                    close_end, close_label = opened.pop()
+                    parts += (text[position:close_end], close_label, '</mark>')
+                    position = close_end
+                parts += (text[position:start], self._tags[color])
+                opened.append((end, label))
+                position = start
+            while len(opened) > 0:
+                close_end, close_label = opened.pop()
+                parts += (text[position:close_end], close_label, '</mark>')
+                position = close_end
+        parts.append(text[position:])
+        html = "".join(parts)
+        # Neither the marks nor the labels contain '$'
+        return html.replace('$', 'dollars') if replace_dollars else html
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import gzip
+import json
+import math
+import argparse
+from collections import Counter
+
+import numpy as np
+
+# ----------------------------------------------------------------------------------------
+# Local (offline, CPU only) language identification: naive Bayes on character 1 to 3-grams.
+# Profiles (language_profiles.json.gz) are reduced from the profiles of langdetect
+# (https://github.com/Mimino666/langdetect, Apache License 2.0, built from Wikipedia by
+# Nakatani Shuyo), see build_profiles(). Naive Bayes posteriors are about 1 for almost any
+# text: the local result is trusted on the margin between the log-likelihoods of the two
+# most likely languages, and for texts long enough. Otherwise, translate() falls back on the
+# identify call of Watson Language Translator. Thresholds are calibrated on the labelled
+# sample of benchmarks/langid_sample.jsonl (see langid_benchmark.py).
+# ----------------------------------------------------------------------------------------
+
+PROFILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "language_profiles.json.gz")
+NGRAM_MAX = 3
+# N-grams kept by language and n-gram size (1, 2, 3) when building profiles
+PROFILE_SIZES = [300, 1000, 2000]
+# Below this margin (natural log) or number of letters, the local identification is not trusted
+LOCAL_MIN_MARGIN = 50
+LOCAL_MIN_LETTERS = 30
+# Only the beginning of long texts is needed
+LOCAL_MAX_TEXT_LENGTH = 2000
+# Language codes of langdetect that differ from the Watson ones
+WATSON_LANGUAGE_CODES = {"zh-cn": "zh", "zh-tw": "zh-TW"}
+
+NON_LETTERS_PATTERN = re.compile(r"[\W\d_]+", re.UNICODE)
+URL_PATTERN = re.compile(r"https?://\S+|@\w+|#", re.UNICODE)
+
+_profiles = None
+
+
+def is_local_language_id_enabled():
+    return os.getenv("CA_LOCAL_LANGUAGE_ID", "true").lower() not in ("false", "0", "no")
+
+
+def get_local_min_margin():
+    return float(os.getenv("CA_LOCAL_LANGUAGE_ID_MARGIN", LOCAL_MIN_MARGIN))
+
+
+# Lower case words (URLs, mentions, digits and punctuation removed)
+def extract_words(text):
+    return NON_LETTERS_PATTERN.sub(" ", URL_PATTERN.sub(" ", text[:LOCAL_MAX_TEXT_LENGTH]).lower()).split()
+
+
+# N-grams of the words padded with a space, as langdetect does
+def extract_ngrams(words):
+    ngrams = []
+    for word in words:
+        padded = " " + word + " "
+        for n in range(1, NGRAM_MAX + 1):
+            for i in range(len(padded) - n + 1):
+                ngram = padded[i:i + n]
+                if ngram.strip():
+                    ngrams.append(ngram)
+    return ngrams
+
+
+# Languages, {ngram: row} and the matrix of the log probabilities of each n-gram (row) in each language (column)
+def load_profiles(path=None):
+    global _profiles
+    if _profiles is not None and path is None:
+        return _profiles
+    with gzip.open(path or PROFILES_PATH, "rt", encoding="utf-8") as f:
+        profiles = json.load(f)
+
+    languages = sorted(profiles["languages"])
+    rows = {}
+    for language in languages:
+        for ngram in profiles["languages"][language]["freq"]:
+            rows.setdefault(ngram, len(rows))
+    # An n-gram missing from a reduced profile is as rare as a single occurrence
+    matrix = np.array([[math.log(1 / (max(profiles["languages"][language]["n_words"]) + 1)) for language in languages]],
+                      dtype=np.float32).repeat(len(rows), axis=0)
+    for column, language in enumerate(languages):
+        profile = profiles["languages"][language]
+        for ngram, count in profile["freq"].items():
+            matrix[rows[ngram], column] = math.log((count + 1) / (profile["n_words"][len(ngram) - 1] + 1))
+    loaded = (languages, rows, matrix)
+    if path is None:
+        _profiles = loaded
+    return loaded
+
+
+# Returns (language, confidence, margin over the second language, number of letters), or (None, 0, 0, letters) when
+# the text has no known n-gram
+def identify_language_locally(text, profiles=None):
+    languages, rows, matrix = profiles if profiles is not None else load_profiles()
+    words = extract_words(text)
+    letters = sum(len(word) for word in words)
+    known_rows = [rows[ngram] for ngram in extract_ngrams(words) if ngram in rows]
+    if len(known_rows) == 0:
+        return None, 0, 0, letters
+
+    scores = matrix[known_rows].sum(axis=0, dtype=np.float64)
+    second, best = np.argsort(scores)[-2:]
+    # Posterior probability with uniform priors
+    confidence = float(1 / np.exp(scores - scores[best]).sum())
+    margin = float(scores[best] - scores[second])
+    return WATSON_LANGUAGE_CODES.get(languages[best], languages[best]), confidence, margin, letters
+
+
+def is_local_result_trusted(language, margin, letters):
+    return language is not None and letters >= LOCAL_MIN_LETTERS and margin >= get_local_min_margin()
+
+
+# Returns (language, confidence) when the local identification is confident enough, None otherwise
+def identify_language_if_confident(text):
+    language, confidence, margin, letters = identify_language_locally(text)
+    if not is_local_result_trusted(language, margin, letters):
+        return None
+    return language, confidence
+
+
+# Reduces the profiles of langdetect (langdetect/profiles folder of its source distribution) to the most frequent
+# lower case n-grams of each language
+def build_profiles(langdetect_profiles_folder, path=None):
+    languages = {}
+    for name in sorted(os.listdir(langdetect_profiles_folder)):
+        with open(os.path.join(langdetect_profiles_folder, name), encoding="utf-8") as f:
+            profile = json.load(f)
+        freq = Counter()
+        for ngram, count in profile["freq"].items():
+            freq[ngram.lower()] += count
+        kept = {}
+        for n, size in enumerate(PROFILE_SIZES, start=1):
+            kept.update(Counter({g: c for g, c in freq.items() if len(g) == n}).most_common(size))
+        languages[profile["name"]] = {"n_words": profile["n_words"], "freq": kept}
+    with gzip.open(path or PROFILES_PATH, "wt", encoding="utf-8") as f:
+        json.dump({"source": "langdetect 1.0.9 profiles (Apache License 2.0)", "languages": languages}, f,
+                  ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    return len(languages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local language identification")
+    parser.add_argument("command", choices=["build-profiles", "identify"])
+    parser.add_argument("argument", help="langdetect profiles folder (build-profiles) or text (identify)")
+    args = parser.parse_args()
+    if args.command == "build-profiles":
+        print("{} language profiles written to {}".format(build_profiles(args.argument), PROFILES_PATH))
+    else:
+        print(identify_language_locally(args.argument))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+
+from sqlalchemy import text
+
+from mana_common import orm
+from mana_common.orm import SCHEMA, ContentLease, ContentLeaseStatus
+from mana_common.shared import log
+
+# ----------------------------------------------------------------------------------------
+# Lease-based work queue for content analysis (PostgreSQL only).
+#
+# Several workers (Code Engine job instances or local processes) can analyse the backlog of
+# pending contents (analysis_ts IS NULL) together: each one claims a few contents with
+# SELECT ... FOR UPDATE SKIP LOCKED and records a lease in content_leases. A lease that was
+# not completed before it expired (crashed worker) is claimed again by another worker, and
+# a failed one (no analysis produced) after LEASE_RETRY_AFTER_S, up to LEASE_MAX_ATTEMPTS
+# times; after that the content is given up: flagged as failed, it is no longer pending.
+# Contents are claimed by priority: those of entities with an ecoregion or a location
+# first, then the freshest.
+# ----------------------------------------------------------------------------------------
+
+# Longer than a Code Engine activation (10 minutes) so that a live worker never loses its lease
+LEASE_DURATION_S = 15 * 60
+LEASE_CLAIM_SIZE = 20
+LEASE_MAX_ATTEMPTS = 3
+LEASE_RETRY_AFTER_S = 60 * 60
+
+_CLAIM_SQL = """
+WITH candidates AS (
+    SELECT c.id
+    FROM {schema}.contents c
+    LEFT JOIN {schema}.content_leases l ON l.content_id = c.id
+    LEFT JOIN {schema}.origins o ON o.id = c.origin_id
+    LEFT JOIN {schema}.entities e ON e.id = o.entity_id
+    WHERE c.analysis_ts IS NULL
+      AND (l.content_id IS NULL
+           OR l.status = 'done'
+           OR (l.status = 'in_flight' AND l.leased_until < now() AND l.attempts < :max_attempts)
+           OR (l.status = 'failed' AND l.attempts < :max_attempts
+               AND coalesce(l.time_updated, l.time_created) < now() - make_interval(secs => :retry_after_s)))
+    -- same priority as content_analysis.main.content_priority_order()
+    ORDER BY (e.ecoregion IS NOT NULL OR e.location IS NOT NULL) DESC, c.time_created DESC NULLS LAST, c.id
+    LIMIT :count
+    FOR UPDATE OF c SKIP LOCKED
+)
+INSERT INTO {schema}.content_leases (content_id, worker_id, status, leased_until, attempts, time_created)
+SELECT id, :worker_id, 'in_flight', now() + make_interval(secs => :lease_s), 1, now() FROM candidates
+ON CONFLICT (content_id) DO UPDATE
+    SET worker_id = EXCLUDED.worker_id,
+        status = 'in_flight',
+        leased_until = EXCLUDED.leased_until,
+        attempts = CASE WHEN content_leases.status = 'done' THEN 1 ELSE content_leases.attempts + 1 END,
+        last_error = NULL,
+        time_updated = now()
+    WHERE content_leases.status = 'done'
+       OR (content_leases.status = 'in_flight' AND content_leases.leased_until < now())
+       OR (content_leases.status = 'failed' AND content_leases.attempts < :max_attempts)
+RETURNING content_id
+""".format(schema=SCHEMA)
+
+_FAIL_EXHAUSTED_SQL = """
+UPDATE {schema}.content_leases
+SET status = 'failed', last_error = 'Lease expired ' || attempts || ' time(s)', time_updated = now()
+WHERE status = 'in_flight' AND leased_until < now() AND attempts >= :max_attempts
+""".format(schema=SCHEMA)
+
+_STATUS_SQL = """
+SELECT
+    (SELECT count(*) FROM {schema}.contents c WHERE c.analysis_ts IS NULL AND NOT EXISTS (
+        SELECT 1 FROM {schema}.content_leases gl
+        WHERE gl.content_id = c.id AND gl.status = 'failed' AND gl.attempts >= :max_attempts)) AS pending,
+    count(*) FILTER (WHERE status = 'in_flight' AND leased_until >= now()) AS in_flight,
+    count(*) FILTER (WHERE status = 'in_flight' AND leased_until < now()) AS expired,
+    count(*) FILTER (WHERE status = 'done') AS done,
+    count(*) FILTER (WHERE status = 'failed' AND attempts < :max_attempts) AS retrying,
+    count(*) FILTER (WHERE status = 'failed' AND attempts >= :max_attempts) AS failed
+FROM {schema}.content_leases
+""".format(schema=SCHEMA)
+
+
+def is_lease_mode():
+    return bool(os.getenv("CA_USE_LEASES"))
+
+
+def get_worker_id():
+    return os.getenv("CA_WORKER_ID") or "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+# Claims up to `count` pending contents for this worker and commits the leases right away (the row locks taken by
+# SKIP LOCKED are only held for the duration of this short transaction, the lease rows protect the contents after).
+def claim_contents(worker_id, count=None):
+    count = count if count is not None else LEASE_CLAIM_SIZE
+    session = orm.get_session()
+    exhausted = session.execute(text(_FAIL_EXHAUSTED_SQL), {"max_attempts": LEASE_MAX_ATTEMPTS}).rowcount
+    if exhausted:
+        log.warning("{} content(s) flagged as failed after {} expired leases".format(exhausted, LEASE_MAX_ATTEMPTS))
+    rows = session.execute(text(_CLAIM_SQL), {
+        "worker_id": worker_id,
+        "count": count,
+        "lease_s": LEASE_DURATION_S,
+        "max_attempts": LEASE_MAX_ATTEMPTS,
+        "retry_after_s": LEASE_RETRY_AFTER_S
+    }).fetchall()
+    session.commit()
+    content_ids = sorted(r[0] for r in rows)
+    log.info("Worker {} claimed {} content(s)".format(worker_id, len(content_ids)))
+    return content_ids
+
+
+# Flags leases as done; meant to be called within the transaction that stores the analyses
+def complete_leases(content_ids):
+    if len(content_ids) == 0:
+        return
+    orm.get_session().query(ContentLease) \
+        .filter(ContentLease.content_id.in_(content_ids)) \
+        .update({ContentLease.status: ContentLeaseStatus.done, ContentLease.leased_until: None},
+                synchronize_session=False)
+
+
+# Claimed again after LEASE_RETRY_AFTER_S, while the content has attempts left (see _CLAIM_SQL)
+def fail_leases(content_ids, error):
+    if len(content_ids) == 0:
+        return
+    orm.get_session().query(ContentLease) \
+        .filter(ContentLease.content_id.in_(content_ids)) \
+        .update({ContentLease.status: ContentLeaseStatus.failed, ContentLease.leased_until: None,
+                 ContentLease.last_error: error}, synchronize_session=False)
+
+
+# Gives contents back to the queue without counting an attempt (e.g. claimed but not processed before exiting)
+def release_leases(content_ids):
+    if len(content_ids) == 0:
+        return
+    orm.get_session().execute(text("""
+        UPDATE {schema}.content_leases
+        SET leased_until = now(), attempts = greatest(attempts - 1, 0), time_updated = now()
+        WHERE content_id = ANY(:content_ids) AND status = 'in_flight'
+    """.format(schema=SCHEMA)), {"content_ids": list(content_ids)})
+    orm.get_session().commit()
+    log.info("Released {} content lease(s)".format(len(content_ids)))
+
+
+# pending = contents not analysed yet (whether leased or not) and not given up, retrying = failed leases to be claimed
+# again after a cool-down, failed = given up contents
+def get_content_queue_status():
+    row = orm.get_session().execute(text(_STATUS_SQL), {"max_attempts": LEASE_MAX_ATTEMPTS}).fetchone()
+    orm.get_session().commit()
+    return {
+        "pending": row["pending"],
+        "in_flight": row["in_flight"],
+        "expired": row["expired"],
+        "done": row["done"],
+        "retrying": row["retrying"],
+        "failed": row["failed"]
+    }
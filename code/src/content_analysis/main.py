@@ -1,31 +1,45 @@
 # -*- coding: utf-8 -*-
 import re
-import io
 import time
+import argparse
+import multiprocessing
+from collections import Counter, OrderedDict
+
+from sqlalchemy import or_, case
 
 from mana_common import orm
-from mana_common.orm import EntityStatus, Entity, \
-    ContentType, Content, Analysis, AnalysisStatus, AnalysisType, \
+from mana_common.orm import EntityStatus, Entity, Origin, \
+    ContentType, Content, Analysis, AnalysisStatus, AnalysisType, ContentLease, ContentAnalysisRun, PrefilterModel, \
     get_session, \
-    load_cache_companies, find_companies, initialize_analysis, delete_previous_analysis
+    load_cache_companies, find_companies, initialize_analysis, delete_previous_analyses, reserve_analysis_ids, \
+    upgrade_enum_type
 
 from watson_developer_cloud.natural_language_understanding_v1 \
-    import Features, EntitiesOptions, KeywordsOptions, ConceptsOptions, SentimentOptions, EmotionOptions
+    import Features, EntitiesOptions, KeywordsOptions, SentimentOptions, EmotionOptions
 import os
 from datetime import datetime
 from time import mktime
 import feedparser
 import socket
 import requests
-from bs4 import BeautifulSoup
 import twitter
 
-import fitz  # this is pymupdf
-
+from content_analysis.leases import is_lease_mode, get_worker_id, claim_contents, complete_leases, fail_leases, \
+    release_leases, get_content_queue_status
+from content_analysis.langid import is_local_language_id_enabled, identify_language_if_confident
+from content_analysis.highlight import SentenceIndex, Highlighter, keyword_score_label
+from content_analysis.prefilter import get_prefilter_mode, get_prefilter_threshold, predict_mana_probability, \
+    PREFILTER_OFF, PREFILTER_ENFORCE
+from content_analysis.pdf import extract_pdf_text
+from content_analysis.extraction import ExtractionError, extract_html_text, close_extraction_pool
+from content_analysis.translation import translate_text, TRANSLATION_CHUNK_SIZE
+from content_analysis.scheduler import DeadlineScheduler, get_deadline, load_historical_item_cost, \
+    record_analysis_run
+from mana_common.resilience import CircuitOpenError, get_open_circuits, get_service_stats, reset_service_stats
 from mana_common.shared import set_logger, log, flush_logs, get_full_url, clean_rss_path, \
     get_nlu, get_assistant_workspace, get_assistant, get_translator, get_assistant_user_id, retryable_twitter_api, \
-    build_tweet_url, find_url_in_text, clean_text_before_evaluation, remove_html_tags, \
-    MIN_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS, TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS, USER_AGENT, \
+    build_tweet_url, find_url_in_text, clean_text_before_evaluation, remove_html_tags, decode_response, \
+    MIN_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS, get_max_text_length, USER_AGENT, \
     TIMEOUT_REQUESTS_S
 
 
@@ -34,6 +48,29 @@ HTML_MIME_TYPES = {'text/html'}
 PDF_MIME_TYPES = {'application/pdf'}
 RATE_LIMIT_ERROR_CODE = 88
 RATE_LIMIT_EXCEED_WAIT_TIME_S = 60
+# Analyses are written to the database by batches: whichever comes first of N contents or T seconds
+ANALYSIS_BATCH_SIZE = 50
+ANALYSIS_BATCH_MAX_DELAY_S = 30
+# Spawned worker processes get their own DB engine & session, Watson clients and companies cache
+WORKERS_START_METHOD = "spawn"
+WORKERS_POLL_S = 0.5
+# Pending contents are scanned by chunks (keyset pagination on id) so that memory does not grow with the backlog
+CONTENT_SCAN_CHUNK_SIZE = 100
+# NLU features requested depend on the stage: the relevance probe of paragraphs / PDF blocks only needs to know whether
+# there are entities & keywords, the evaluation of a content needs everything it scores (see get_nlu_features)
+NLU_PROFILE_PROBE = "probe"
+NLU_PROFILE_EVALUATE = "evaluate"
+# Last NLU responses, by (profile, text): the same text is not sent twice with the same profile
+NLU_CACHE_SIZE = 32
+
+
+# Counters of the current analysis run (per process), see analyse_contents()
+_metrics = Counter()
+_nlu_cache = OrderedDict()
+
+
+def count_metric(name, value=1):
+    _metrics[name] += value
 
 
 def extract_confidence_score_from_assistant_response(assistant_response, intent_name):
@@ -43,84 +80,127 @@ def extract_confidence_score_from_assistant_response(assistant_response, intent_
     return None
 
 
-def translate(text):
-    if len(text) > TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS:
-        log.warning("Text is too long ({}); it will be truncated to {}".format(
-            len(text), TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS)
-        )
-        text = text[:TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS]
+def truncate_for_translation(text):
+    if len(text) > get_max_text_length():
+        log.warning("Text is too long ({}); it will be truncated to {}".format(len(text), get_max_text_length()))
+        text = text[:get_max_text_length()]
+    return text
+
+
+# Identified locally when the local model is confident enough, by Watson Language Translator otherwise
+def identify_language(text):
+    if is_local_language_id_enabled():
+        identified_language = identify_language_if_confident(text)
+        if identified_language is not None:
+            count_metric("identify_local")
+            log.info('Identified language locally: {0} with a confidence of {1}'.format(*identified_language))
+            return identified_language
 
-    language = get_translator().identify(text).get_result()
+    count_metric("identify_remote")
+    # The beginning of the text is enough
+    language = get_translator().identify(text[:TRANSLATION_CHUNK_SIZE]).get_result()
     probable_language = language['languages'][0]['language']
 
     confidence = language['languages'][0]['confidence']
     log.info('Identified language: {0} with a confidence of {1}'.format(probable_language, confidence))
-    if probable_language != 'en' and confidence >= 0.5:
-        translation = get_translator().translate(
-            text=text,
-            model_id=probable_language + '-en'
-        ).get_result()
-        text = translation['translations'][0]['translation']
-        return probable_language, text
+    return probable_language, confidence
+
+
+def is_translation_needed(probable_language, confidence):
+    return probable_language != 'en' and confidence >= 0.5
+
+
+# identified_language: (language, confidence) if the language of the text was already identified
+def translate(text, identified_language=None):
+    text = truncate_for_translation(text)
+    probable_language, confidence = identified_language if identified_language is not None \
+        else identify_language(text)
+    if is_translation_needed(probable_language, confidence):
+        # Long texts are translated by chunks
+        translated_text, chunk_count = translate_text(text, model_id=probable_language + '-en')
+        count_metric("translation_chunks", chunk_count)
+        return probable_language, translated_text
 
     return probable_language, text
 
 
-def nlu_analysis(text):
+def is_translation_precheck_enabled():
+    return os.getenv("CA_TRANSLATION_PRECHECK", "true").lower() not in ("false", "0", "no")
+
+
+# Languages in which company names may be translated (e.g. "Red lantern"): their texts are always translated
+def get_translation_risky_languages():
+    return {language.strip().lower() for language in os.getenv("CA_TRANSLATION_RISKY_LANGUAGES", "").split(",")
+            if language.strip()}
+
+
+# Company names and synonyms are mostly proper nouns, that translation keeps as is: a text with no company candidate in
+# its original language is not translated, unless it is in a risky language (its language is then identified first).
+# Returns (translation needed, identified language or None).
+def precheck_translation(text):
+    if len(find_companies(text)) > 0:
+        count_metric("precheck_company_candidates")
+        return True, None
+
+    risky_languages = get_translation_risky_languages()
+    if len(risky_languages) == 0:
+        count_metric("translation_calls_avoided")  # identify (and maybe translate)
+        return False, None
+
+    identified_language = identify_language(text)
+    if identified_language[0].lower() in risky_languages:
+        count_metric("precheck_risky_language")
+        return True, identified_language
+    if is_translation_needed(*identified_language):
+        count_metric("translation_calls_avoided")  # translate
+    return False, identified_language
+
+
+def get_nlu_features(profile):
+    if profile == NLU_PROFILE_PROBE:
+        return Features(entities=EntitiesOptions(limit=1), keywords=KeywordsOptions(limit=1))
+    # Sentiment & emotion of entities are only scored when companies are detected by NLU
+    entity_scores = orm.get_config()["use_nlu_for_company_detection"]
+    return Features(
+        entities=EntitiesOptions(emotion=entity_scores, sentiment=entity_scores),
+        keywords=KeywordsOptions(emotion=True, sentiment=True),
+        sentiment=SentimentOptions(document=True),
+        emotion=EmotionOptions(document=True)
+    )
+
+
+def nlu_analysis(text, profile=NLU_PROFILE_EVALUATE):
+    key = (profile, text)
+    if key in _nlu_cache:
+        _nlu_cache.move_to_end(key)
+        count_metric("nlu_cached")
+        return _nlu_cache[key]
+
+    count_metric("nlu_{}".format(profile))
     response_nlu = get_nlu().analyze(
         text=text,
-        features=Features(
-            concepts=ConceptsOptions(limit=5),
-            entities=EntitiesOptions(emotion=True, sentiment=True),
-            keywords=KeywordsOptions(emotion=True, sentiment=True),
-            sentiment=SentimentOptions(document=True),
-            emotion=EmotionOptions(document=True)
-        )
+        features=get_nlu_features(profile)
     ).get_result()
+    _nlu_cache[key] = response_nlu
+    if len(_nlu_cache) > NLU_CACHE_SIZE:
+        _nlu_cache.popitem(last=False)
     return response_nlu
 
 
 def is_content_relevant_based_on_nlu(text):
     probable_language, translated_text = translate(text)
-    response_nlu = nlu_analysis(translated_text)
+    response_nlu = nlu_analysis(translated_text, NLU_PROFILE_PROBE)
     try:
         return len(response_nlu["entities"]) > 0 and len(response_nlu["keywords"]) > 0
     except:
         return False
 
 
-def find_useful_div(p):
-    parent = p.find_parent('article')
-    if parent is not None:
-        return parent
-
-    max_parent_lookup = 5
-    current_lookup = 1
-    parent = p.parent
-    while parent is not None and len(parent.find_all('p')) <= 1 and current_lookup < max_parent_lookup:
-        parent = parent.parent
-        current_lookup = current_lookup + 1
-    return parent
-
-
 def count_social_keywords(text):
-    social_keywords = set(re.findall(orm.get_config()["social_keywords_pattern"], text.lower()))
+    social_keywords = set(orm.get_config_matchers()["social_keywords_pattern"].findall(text.lower()))
     return len(social_keywords)
 
 
-def is_useful_paragraph(p):
-    if p.find_parent('header') is not None \
-            or p.find_parent('div', {"id": "header"}) is not None \
-            or p.find_parent('nav') is not None:
-        return False
-
-    if count_social_keywords(p.text) >= 1:
-        if p.find_parent('a'):
-            return False
-
-    return True
-
-
 def remove_social_network_sentences(text):
     final_sentences = []
     sentences = text.split(". ")
@@ -150,65 +230,28 @@ def retrieve_content_from_url(url):
     if mime_type in HTML_MIME_TYPES:  # URL is an HTML page -> Parse it
         log.info("HTML content found for URL: {}".format(url))
         returned_type = AnalysisType.html
-        html_content = response.text
-        soup = BeautifulSoup(html_content, "lxml")
-        for p in soup.find_all("p"):
-            if not (is_useful_paragraph(p)):
-                p.parent.decompose()
-
-        useful_div = None
-
-        for p in soup.find_all("p"):
-            if is_worth_analyzing(p.text):
-                log.info("HTML Content - NLU match found for text: {}".format(p.text))
-                useful_div = find_useful_div(p)
-                break
-
-        if useful_div is None:
-            log.info("HTML Content - Did not find useful div")
-        else:
-            # text is in original language
-            returned_text = " " \
-                .join([p.text for p in useful_div.find_all(["p", "h1", "h2"])]).replace("\n", "") \
-                .replace("\r", "")
+        # Parsed in a worker process, paragraphs are checked here
+        returned_text = extract_html_text(decode_response(response), orm.get_config_matchers()["social_keywords_pattern"],
+                                          is_worth_analyzing)
 
     elif mime_type in PDF_MIME_TYPES:  # URL is a PDF -> Parse it
         log.info("PDF content for URL: {}".format(url))
         returned_type = AnalysisType.pdf
-        pdf_file = io.BytesIO(response.content)
-        with fitz.open(stream=pdf_file, filetype=mime_type) as doc:
-            whole_text = ""
-            text_too_large = False
-            for page in doc:
-                blocks = page.getText("blocks")
-                for block in blocks:
-                    type = block[6]
-                    text = block[4]
-                    if type != 0 or text is None:
-                        continue  # type != text or no text at all: discard
-                    cleansed_text = ' '.join(text.split()).replace("\n", " ").strip()  # remove \n & extra spaces
-                    if is_worth_analyzing(cleansed_text):
-                        if len(whole_text) + len(cleansed_text) > TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS:
-                            text_too_large = True
-                            log.info("PDF Content - Text will be too large, truncating")
-                            break
-                        whole_text += "\n" + cleansed_text
-                if text_too_large:
-                    break
-            if len(whole_text) > 0:
-                log.info("PDF Content - Found valid content for URL: {} ({} chars)".format(url, len(whole_text) - 1))
-                returned_text = whole_text[1:]  # remove first \n
-            else:
-                log.info("PDF Content - Found no valid content for URL: {} ({} chars)".format(url, len(whole_text) - 1))
+        # Pages are extracted in worker processes, the text budget applies to the whole document
+        returned_text = extract_pdf_text(response.content, is_worth_analyzing)
+        if len(returned_text) > 0:
+            log.info("PDF Content - Found valid content for URL: {} ({} chars)".format(url, len(returned_text)))
+        else:
+            log.info("PDF Content - Found no valid content for URL: {}".format(url))
     else:  # URL is something else (image, video etc...)
         log.info("Content type not supported: {}".format(content_type))
 
-    if len(returned_text) > TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS:
+    if len(returned_text) > get_max_text_length():
         log.info("Text is too long ({}); it will be truncated to {}".format(
-            len(returned_text), TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS)
+            len(returned_text), get_max_text_length())
         )
 
-    return returned_text[:TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS], returned_type
+    return returned_text[:get_max_text_length()], returned_type
 
 
 # Process a Twitter origin for a reference entity
@@ -378,23 +421,301 @@ def load_new_content():
     log.info("Completed, new content items = {}".format(total_content))
 
 
-def analyse_contents():
+# Buffers analyses (and the analysis_ts updates of their contents) and writes them with one transaction per batch.
+# A crash only loses the current batch: its contents keep analysis_ts == None in the database and will be analysed
+# again by the next run.
+class AnalysisBatchWriter:
+    def __init__(self, batch_size=None, max_delay_s=None, use_leases=False):
+        self.batch_size = batch_size if batch_size is not None else ANALYSIS_BATCH_SIZE
+        self.max_delay_s = max_delay_s if max_delay_s is not None else ANALYSIS_BATCH_MAX_DELAY_S
+        self.use_leases = use_leases
+        self._contents = []
+        self._analyses = []
+        self._batch_started_at = None
+
+    def add(self, content, analyses):
+        if self._batch_started_at is None:
+            self._batch_started_at = time.monotonic()
+        self._contents.append(content)
+        self._analyses.extend(analyses)
+        if len(self._contents) >= self.batch_size or \
+                time.monotonic() - self._batch_started_at >= self.max_delay_s:
+            self.flush()
+
+    def flush(self):
+        if len(self._contents) == 0:
+            return
+        session = orm.get_session()
+
+        content_ids = [c.id for c in self._contents if c.id is not None]
+        keep_ids = [a.id for a in self._analyses if a.id is not None]
+        delete_previous_analyses(content_ids, keep_ids)
+
+        new_analyses = [a for a in self._analyses if a.id is None]
+        for analysis, analysis_id in zip(new_analyses, reserve_analysis_ids(len(new_analyses))):
+            analysis.id = analysis_id
+
+        session.add_all(self._analyses)
+        if self.use_leases:
+            # Leases are closed in the same transaction as the analyses they protect
+            complete_leases([c.id for c in self._contents if c.analysis_ts is not None])
+            fail_leases([c.id for c in self._contents if c.analysis_ts is None], "No analysis produced")
+        # Contents are already in the session, their analysis_ts updates are part of the same transaction
+        session.commit()
+        log.info("[AnalysisBatchWriter] stored {} analysis(es) for {} content(s)".format(
+            len(self._analyses), len(self._contents)))
+
+        self._contents = []
+        self._analyses = []
+        self._batch_started_at = None
+
+
+# A partition (index, count) restricts contents to those with id % count == index
+def filter_partition(query, partition):
+    if partition is None:
+        return query
+    index, count = partition
+    return query.filter(Content.id % count == index)
+
+
+def count_pending_contents(partition=None):
     # !!! BE VERY CAREFUL !!!
     # /!\ Content.analysis_ts == None is not equivalent to Content.analysis_ts is None, beware of linter warnings
     # !!!
-    contents = orm.get_session().query(Content).filter(Content.analysis_ts == None).all()
+    query = orm.get_session().query(Content).filter(Content.analysis_ts == None)
+    return filter_partition(query, partition).count()
+
+
+# Yields chunks of pending contents ordered by id. Each chunk is a fresh query starting after the last id seen, so
+# contents that could not be analysed (and are still pending) are not returned twice during the same run.
+def iter_pending_contents(chunk_size=None, partition=None):
+    chunk_size = chunk_size if chunk_size is not None else CONTENT_SCAN_CHUNK_SIZE
+    last_id = 0
+    while True:
+        query = orm.get_session().query(Content).filter(Content.analysis_ts == None, Content.id > last_id)
+        chunk = filter_partition(query, partition) \
+            .order_by(Content.id) \
+            .limit(chunk_size) \
+            .all()
+        if len(chunk) == 0:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].id
+
+
+# Contents of entities with an ecoregion or a location first, then the freshest ones
+def content_priority_order():
+    has_place = case([(or_(Entity.ecoregion != None, Entity.location != None), 0)], else_=1)
+    return [has_place, Content.time_created.desc().nullslast(), Content.id]
+
+
+# Yields chunks of pending contents by priority (see content_priority_order). Only the ids are selected upfront, contents
+# are then loaded chunk by chunk.
+def iter_prioritized_contents(chunk_size=None, partition=None):
+    chunk_size = chunk_size if chunk_size is not None else CONTENT_SCAN_CHUNK_SIZE
+    query = orm.get_session().query(Content.id) \
+        .outerjoin(Origin, Content.origin_id == Origin.id) \
+        .outerjoin(Entity, Origin.entity_id == Entity.id) \
+        .filter(Content.analysis_ts == None)
+    content_ids = [row[0] for row in filter_partition(query, partition).order_by(*content_priority_order()).all()]
+    for i in range(0, len(content_ids), chunk_size):
+        chunk_ids = content_ids[i:i + chunk_size]
+        contents = orm.get_session().query(Content).filter(Content.id.in_(chunk_ids)).all()
+        position = {content_id: p for p, content_id in enumerate(chunk_ids)}
+        yield sorted(contents, key=lambda c: position.get(c.id, len(position)))
+
+
+# Same as iter_pending_contents, but contents are claimed through leases so that several workers can share the backlog.
+# With a scheduler, no more contents are claimed once the deadline is near.
+def iter_leased_contents(worker_id, scheduler=None):
+    while True:
+        if scheduler is not None and not scheduler.has_time_for_next_item():
+            return
+        content_ids = claim_contents(worker_id)
+        if len(content_ids) == 0:
+            return
+        yield orm.get_session().query(Content).filter(Content.id.in_(content_ids)).order_by(Content.id).all()
+
 
+# Returns the counters (contents, analyses, statuses...) of this run. With a deadline (time.time() value), contents
+# are analysed by priority and no content is started when the deadline is too close to analyse it.
+def analyse_contents(partition=None, deadline=None):
+    _metrics.clear()
+    started_at = time.monotonic()
+    use_leases = is_lease_mode()
     count = 1
-    length = len(contents)
+    length = count_pending_contents(partition)
     log.info("Number of contents {}".format(length))
-    for c in contents:
-        analyses = analyse_content(c)
-        for a in analyses:
-            log.info("adding analyse to session {}".format(a))
-            orm.get_session().add(a)
-            orm.get_session().commit()
-        log.info("[analyse_contents] Processed content {} / {}".format(count, length))
-        count += 1
+
+    scheduler = None
+    if deadline is not None:
+        scheduler = DeadlineScheduler(deadline, load_historical_item_cost())
+        log.info("Content analysis must end in {:.0f}s (~{:.1f}s per content)".format(
+            scheduler.remaining_s(), scheduler.estimated_item_cost_s()))
+
+    if use_leases:
+        worker_id = get_worker_id()
+        log.info("Contents will be claimed through leases by worker {}".format(worker_id))
+        chunks = iter_leased_contents(worker_id, scheduler)
+    elif scheduler is not None:
+        chunks = iter_prioritized_contents(partition=partition)
+    else:
+        chunks = iter_pending_contents(partition=partition)
+
+    writer = AnalysisBatchWriter(use_leases=use_leases)
+    unprocessed_ids = []
+    circuit_open = False
+    reset_service_stats()
+    try:
+        for contents in chunks:
+            unprocessed_ids = [c.id for c in contents]
+            for c in contents:
+                if scheduler is not None and not scheduler.has_time_for_next_item():
+                    break
+                content_started_at = time.monotonic()
+                try:
+                    # Contents are not even retrieved while a Watson service is unavailable
+                    open_circuits = get_open_circuits()
+                    if len(open_circuits) > 0:
+                        raise CircuitOpenError(", ".join(open_circuits))
+                    analyses = analyse_content(c)
+                except CircuitOpenError as ex:
+                    # No more contents are claimed: the ones of this chunk are given back (leases released) for the
+                    # next run or other workers
+                    log.warning("[analyse_contents] {}: content {} is parked, stopping".format(ex, c.id))
+                    park_content(c)
+                    count_metric("parked")
+                    circuit_open = True
+                    break
+                writer.add(c, analyses)
+                unprocessed_ids.remove(c.id)
+                count_metric("contents")
+                count_metric("analyses", len(analyses))
+                for a in analyses:
+                    count_metric("status_{}".format(a.status.name if a.status is not None else "none"))
+                log.info("[analyse_contents] Processed content {} / {}".format(count, length))
+                count += 1
+                if scheduler is not None:
+                    scheduler.item_done(time.monotonic() - content_started_at)
+            # Everything of this chunk is committed: drop it from the session (identity map) before the next one
+            writer.flush()
+            orm.get_session().expunge_all()
+            if circuit_open or (scheduler is not None and scheduler.deadline_reached):
+                break
+    finally:
+        writer.flush()
+        close_extraction_pool()
+        if use_leases:
+            release_leases(unprocessed_ids)
+            log.info("Content analysis queue status: {}".format(get_content_queue_status()))
+
+    deadline_reached = scheduler is not None and scheduler.deadline_reached
+    if circuit_open:
+        count_metric("circuit_open")
+    if deadline_reached:
+        count_metric("deadline_reached")
+    if circuit_open or deadline_reached:
+        count_metric("contents_left", max(length - count + 1, 0))
+    # Calls, errors, retries, throttled & rejected calls, total latency by Watson service
+    for service, stats in get_service_stats().items():
+        for name, value in stats.items():
+            count_metric("{}_{}".format(service, name), value)
+    _metrics["worker_time_s"] += round(time.monotonic() - started_at)
+    log.info("Content analysis metrics: {}".format(dict(_metrics)))
+    return dict(_metrics)
+
+
+# Gives a content back to the pending ones, without analysis (a Watson service is unavailable)
+def park_content(content):
+    content.analysis_ts = None
+    session = orm.get_session()
+    for analysis in [o for o in session.new if isinstance(o, Analysis) and o.content is content]:
+        analysis.content = None
+        session.expunge(analysis)
+
+
+# Records the run so that next runs can estimate how long analysing a content takes
+def record_metrics(metrics):
+    try:
+        record_analysis_run(get_worker_id(), metrics, deadline_reached=metrics.get("deadline_reached", 0) > 0)
+    except Exception as ex:
+        log.warning("Could not record content analysis run: {}".format(ex))
+        orm.get_session().rollback()
+
+
+# Entry point of a worker process (see analyse_contents_in_workers)
+def analyse_contents_worker(partition, deadline=None):
+    socket.setdefaulttimeout(TIMEOUT_REQUESTS_S)
+    index, count = partition
+    try:
+        set_logger("ca-w{}".format(index))
+        log.info("Worker {} / {} starting".format(index + 1, count))
+        load_cache_companies()
+        metrics = analyse_contents(partition=partition, deadline=deadline)
+        record_metrics(metrics)
+        return metrics
+    finally:
+        flush_logs()
+
+
+# Runs in a worker process (see analyse_contents_in_workers): its metrics are sent back with its index
+def run_contents_worker(partition, deadline, results):
+    results.put((partition[0], analyse_contents_worker(partition, deadline=deadline)))
+
+
+# Analyses pending contents with worker processes; contents are split by id modulo the number of workers (or claimed
+# through leases when CA_USE_LEASES is set). Returns the merged counters of all workers.
+# Workers are not daemon processes (as those of a multiprocessing.Pool): they start their own supervised extraction
+# pool (see extraction.py), with its timeouts and memory ceiling.
+def analyse_contents_in_workers(workers, deadline=None):
+    log.info("Analyzing with {} worker processes".format(workers))
+    # Make sure nothing of this process' session is pending before workers open their own connections
+    orm.get_session().commit()
+    context = multiprocessing.get_context(WORKERS_START_METHOD)
+    results = context.SimpleQueue()
+    processes = [context.Process(target=run_contents_worker, args=((i, workers), deadline, results),
+                                 name="ca-w{}".format(i), daemon=False) for i in range(workers)]
+    for process in processes:
+        process.start()
+    worker_metrics = {}
+    try:
+        # Metrics are read as workers end, so that none of them waits for the queue to be read
+        while len(worker_metrics) < workers and any(p.is_alive() for p in processes):
+            if results.empty():
+                time.sleep(WORKERS_POLL_S)
+            else:
+                index, metrics = results.get()
+                worker_metrics[index] = metrics
+        while not results.empty():
+            index, metrics = results.get()
+            worker_metrics[index] = metrics
+    finally:
+        for process in processes:
+            process.join()
+
+    metrics = Counter()
+    for index in sorted(worker_metrics):
+        metrics.update(worker_metrics[index])
+    log.info("Content analysis metrics (all workers): {}".format(dict(metrics)))
+    failed = [p.name for i, p in enumerate(processes) if i not in worker_metrics]
+    if len(failed) > 0:
+        raise RuntimeError("Content analysis workers {} failed (exit codes {})".format(
+            failed, [p.exitcode for i, p in enumerate(processes) if i not in worker_metrics]))
+    return dict(metrics)
+
+
+# Shadow mode of the pre-filter: would it have taken the same decision as Watson?
+def count_prefilter_agreement(probability, retained_by_watson):
+    sent_to_watson = probability >= get_prefilter_threshold()
+    if sent_to_watson or not retained_by_watson:
+        count_metric("prefilter_agree")
+    else:
+        count_metric("prefilter_disagree")
+    if not sent_to_watson:
+        count_metric("prefilter_would_skip")
+    log.info("Pre-filter probability {:.3f}, retained by Watson: {}".format(probability, retained_by_watson))
 
 
 def send_message_to_assistant(input_text, context):
@@ -434,8 +755,21 @@ def daniel_evaluation(analysis):
         log.info("Starts")
 
         try:
-            probable_language, translated_text = translate(text)
-
+            identified_language = None
+            if not orm.get_config()["use_nlu_for_company_detection"] and is_translation_precheck_enabled():
+                translation_needed, identified_language = precheck_translation(text)
+                if not translation_needed:
+                    log.info("No company candidate in the original text, it is not translated")
+                    if identified_language is not None:
+                        analysis.original_language = identified_language[0]
+                    analysis.status = AnalysisStatus.no_companies
+                    analysis.flag = '-1'
+                    return analysis, companies
+
+            probable_language, translated_text = translate(text, identified_language)
+
+        except CircuitOpenError:
+            raise
         except Exception as ex:
             log.info("Exception during translation: {}".format(ex))
             analysis.status = AnalysisStatus.failed_at_translation
@@ -532,6 +866,25 @@ def daniel_evaluation(analysis):
             nlu_company_confidence = 100
 
         if company_found:
+            prefilter_probability = None
+            if get_prefilter_mode() != PREFILTER_OFF:
+                prefilter_probability = predict_mana_probability(translated_text)
+            if prefilter_probability is not None and get_prefilter_mode() == PREFILTER_ENFORCE and \
+                    prefilter_probability < get_prefilter_threshold():
+                log.info("Pre-filter probability {:.3f}: not sent to Watson".format(prefilter_probability))
+                count_metric("prefilter_skipped")
+                analysis.status = AnalysisStatus.prefiltered
+                analysis.flag = 0
+                analysis.text = translated_text
+                analysis.count = 0
+                analysis.score_keywords_confirmed = 0
+                if orm.get_config()["use_nlu_for_company_detection"]:
+                    analysis.company = company
+                    analysis.company_match = {"reason": "nlu", "score": nlu_company_confidence}
+                analysis.weighted_score_company = score_pondere_company
+                analysis.nlu_company_confidence = nlu_company_confidence
+                return analysis, companies
+
             if orm.get_config()[
                 "use_nlu_for_company_detection"]:  # for non NLU company extraction, we will return the company array and create incidents for each
                 analysis.company = company
@@ -597,6 +950,7 @@ def daniel_evaluation(analysis):
                 keywords_list.append([response_nlu["keywords"][l]["text"], score_pondere_keyword])
 
             context = None
+            sentence_index = SentenceIndex(translated_text)
             for keyword_data in keywords_list:
                 keyword = keyword_data[0]
                 log.info('Submitting keyword to assistant : {0}'.format(keyword))
@@ -612,7 +966,7 @@ def daniel_evaluation(analysis):
                                           position_alerting_entity[0]:position_alerting_entity[1]]
                         list_alerting_entities_confirmed.append(alerting_entity)
                         # counter_confirmed_detected_alerting_entities+=1
-                    for sentence_keyword in translated_text.split('. '):
+                    for sentence_keyword in sentence_index.sentences_containing(keyword):
                         if keyword in sentence_keyword:
                             # If an alerting entity was discovered, meaning it is not one of the intents by elimination
                             # if response_bot["output"]["text"]!=['OuiMANA'] and response_bot["output"]["text"]!=['NonMANA']:
@@ -677,16 +1031,18 @@ def daniel_evaluation(analysis):
             #     if response_nlc['top_class']=="Oui_MANA":
             #         flag_article_retained=3
 
+            if prefilter_probability is not None:
+                count_prefilter_agreement(prefilter_probability, flag_article_retained != 0)
+
             # If the article was retained by one layer, i.e. that the flag value is not 0, we store all its information
-            article_highlighted = translated_text
+            highlighter = Highlighter(translated_text)
             if flag_article_retained != 0:
                 score_keywords_confirmed = []
 
                 list_sentences_confirmed = list(set(list_sentences_confirmed))
                 count_sentences = len(list_sentences_confirmed)
                 for sentence in list_sentences_confirmed:
-                    article_highlighted = article_highlighted.replace(sentence,
-                                                                      '<mark style="background-color: yellow">' + sentence + '</mark>')
+                    highlighter.mark(sentence, "yellow")
 
                 for k in list_keywords_confirmed:
                     score_keywords_confirmed = +k[1]
@@ -694,19 +1050,13 @@ def daniel_evaluation(analysis):
                 list_all_keywords = list_keywords_confirmed + list_keywords_deceitful
                 list_all_keywords = list(set(map(tuple, list_all_keywords)))
                 for keyword_data in list_all_keywords:
-                    article_highlighted = article_highlighted.replace(keyword_data[0],
-                                                                      '<mark style="background-color: orange">' +
-                                                                      keyword_data[0] + "(" + str(
-                                                                          round(keyword_data[1], 2)) + ")" + '</mark>')
+                    highlighter.mark(keyword_data[0], "orange", label=keyword_score_label(keyword_data[1]))
 
                 list_alerting_entities_confirmed = list(set(list_alerting_entities_confirmed))
                 for keyword in list_alerting_entities_confirmed:
-                    article_highlighted = article_highlighted.replace(
-                        keyword,
-                        '<mark style="background-color: red">' + keyword + '</mark>'
-                    )
+                    highlighter.mark(keyword, "red")
 
-                article_highlighted = article_highlighted.replace('$', 'dollars')
+                article_highlighted = highlighter.render(replace_dollars=True)
 
                 analysis.status = AnalysisStatus.completed
                 analysis.flag = flag_article_retained
@@ -721,10 +1071,8 @@ def daniel_evaluation(analysis):
             else:
                 list_keywords_deceitful = list(set(map(tuple, list_keywords_deceitful)))
                 for keyword_data in list_keywords_deceitful:
-                    article_highlighted = article_highlighted.replace(keyword_data[0],
-                                                                      '<mark style="background-color: orange">' +
-                                                                      keyword_data[0] + "(" + str(
-                                                                          round(keyword_data[1], 2)) + ")" + '</mark>')
+                    highlighter.mark(keyword_data[0], "orange", label=keyword_score_label(keyword_data[1]))
+                article_highlighted = highlighter.render()
 
                 analysis.status = AnalysisStatus.completed
                 analysis.flag = flag_article_retained
@@ -741,6 +1089,8 @@ def daniel_evaluation(analysis):
             analysis.flag = '-1'
             return analysis, companies
 
+    except CircuitOpenError:
+        raise
     except Exception as ex:
         log.warning("Exception during analysis: {}".format(ex))
         analysis.status = AnalysisStatus.other_exception
@@ -751,9 +1101,10 @@ def daniel_evaluation(analysis):
 
 def analyse_content(content):
     log.info('[analyse_content] Starting for content id {}'.format(content.id))
-    delete_previous_analysis(content)
     current_analysis = None
     analyses = []
+    # Kept along with the analysis of the next link (or of the tweet itself)
+    extraction_failures = []
     try:
         if content.content_type == ContentType.tweet:
             log.info("[analyse_content] Starting tweet analysis process")
@@ -762,16 +1113,24 @@ def analyse_content(content):
             if urls is not None:
                 for url in urls:
                     log.info("[analyse_content] found link in content {}".format(url))
-                    real_url = get_full_url(url, orm.get_config()["url_extensions_to_check_for_true_url"])
+                    real_url = get_full_url(url, orm.get_config_matchers()["url_extensions_to_check_for_true_url"])
                     log.info(orm.get_config()["url_pattern_to_ignore_for_content_analysis"])
-                    if not any(ext in real_url for ext in orm.get_config()["url_pattern_to_ignore_for_content_analysis"]):
+                    if not orm.get_config_matchers()["url_pattern_to_ignore_for_content_analysis"].matches(real_url):
                         analysis = initialize_analysis(content)
                         current_analysis = analysis
                         content.analysis_ts = analysis.analysis_ts
                         log.info("[analyse_content] valid real url to analyse {}".format(real_url))
                         analysis.link = real_url
 
-                        analysis.original_text, analysis.type = retrieve_content_from_url(real_url)
+                        try:
+                            analysis.original_text, analysis.type = retrieve_content_from_url(real_url)
+                        except ExtractionError as ex:
+                            log.warning("[analyse_content] could not extract {}: {}".format(real_url, ex))
+                            analysis.status = AnalysisStatus.failed_at_extraction
+                            analysis.status_exception = str(ex)
+                            extraction_failures.append(analysis)
+                            current_analysis = None
+                            continue
 
                         if len(analysis.original_text) == 0:
                             log.info("[analyse_content] no content retrieved from {}".format(real_url))
@@ -821,6 +1180,9 @@ def analyse_content(content):
             analysis, companies = daniel_evaluation(analysis)
             analyses = create_analysis_for_companies(analysis, companies)
 
+    except CircuitOpenError:
+        # The content is parked, see analyse_contents()
+        raise
     except Exception as ex:
         log.info("[analyse_content] Exception during analysis: {}".format(ex))
         if current_analysis is not None:
@@ -829,7 +1191,7 @@ def analyse_content(content):
             analyses.append(current_analysis)
         pass
 
-    return analyses
+    return extraction_failures + analyses
 
 
 def create_analysis_for_companies(analysis, companies):
@@ -872,8 +1234,10 @@ def create_analysis_for_companies(analysis, companies):
     return analyses
 
 
-def main():
+def main(workers=None):
     socket.setdefaulttimeout(TIMEOUT_REQUESTS_S)
+    # The time budget (CA_DEADLINE_S) includes the retrieval of new content
+    deadline = get_deadline(time.time())
 
     try:
         set_logger("ca")
@@ -884,6 +1248,16 @@ def main():
             log.info("Skipping step as SKIP_CA is set")
             return
 
+        if workers is None:
+            workers = int(os.getenv("CA_WORKERS", "1"))
+
+        if is_lease_mode():
+            ContentLease.__table__.create(bind=orm.get_db_engine(), checkfirst=True)
+        ContentAnalysisRun.__table__.create(bind=orm.get_db_engine(), checkfirst=True)
+        upgrade_enum_type(AnalysisStatus)
+        if get_prefilter_mode() != PREFILTER_OFF:
+            PrefilterModel.__table__.create(bind=orm.get_db_engine(), checkfirst=True)
+
         log.info("Loading companies from DB")
         load_cache_companies()
 
@@ -891,7 +1265,10 @@ def main():
         load_new_content()
 
         log.info("Analyzing new content")
-        analyse_contents()
+        if workers > 1:
+            analyse_contents_in_workers(workers, deadline)
+        else:
+            record_metrics(analyse_contents(deadline=deadline))
 
         log.info("Normal end of processing - completed")
     finally:
@@ -901,4 +1278,7 @@ def main():
 
 # Run if local (Docker)
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="MANA content analysis")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of analysis processes (default: CA_WORKERS environment variable, or 1)")
+    main(workers=parser.parse_args().workers)
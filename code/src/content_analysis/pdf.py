@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import multiprocessing
+from collections import deque
+
+import fitz  # this is pymupdf
+
+from mana_common import orm
+from mana_common.shared import log, get_max_text_length, MIN_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS
+from content_analysis.extraction import ExtractionError, get_extraction_pool, close_extraction_pool, \
+    get_extraction_workers, is_extraction_isolated, run_extraction_task, describe_extraction_failure
+
+# ----------------------------------------------------------------------------------------
+# PDF extraction: pages are extracted by the extraction pool (see extraction.py), with a
+# timeout per page (a page that takes too long is skipped, the workers are replaced); a
+# document that cannot be opened, or none of whose pages can be read, raises
+# ExtractionError. Text blocks are filtered
+# and scored locally, and only the best candidates go through the remote relevance check
+# (Watson): the document is kept, in full up to the text budget, if one of them is relevant.
+# ----------------------------------------------------------------------------------------
+
+PDF_PAGE_TIMEOUT_S = 30
+# Pages submitted ahead of the one being waited for, by worker
+PDF_PAGES_AHEAD = 2
+# Maximum number of blocks sent to the remote relevance check, by document
+PDF_MAX_RELEVANCE_CHECKS = 5
+# Blocks made of less letters than that (tables, page numbers...) are dropped
+PDF_MIN_LETTERS_RATIO = 0.5
+
+# Document opened by a worker process: (path, document)
+_worker_document = None
+
+
+def open_worker_document(path):
+    global _worker_document
+    if _worker_document is None or _worker_document[0] != path:
+        if _worker_document is not None:
+            _worker_document[1].close()
+        _worker_document = (path, fitz.open(path))
+    return _worker_document[1]
+
+
+# Runs in a worker process
+def count_pdf_pages(path):
+    return len(open_worker_document(path))
+
+
+# Runs in a worker process: cleansed text blocks of a page
+def extract_page_blocks(path, page_number):
+    blocks = []
+    for block in open_worker_document(path)[page_number].getText("blocks"):
+        if block[6] != 0 or block[4] is None:
+            continue  # type != text or no text at all: discard
+        text = ' '.join(block[4].split()).strip()  # remove \n & extra spaces
+        if len(text) > 0:
+            blocks.append(text)
+    return blocks
+
+
+# Yields (page number, blocks), blocks being None when the page could not be extracted in time
+def iter_pdf_pages(path, page_count):
+    if not is_extraction_isolated():
+        for page_number in range(page_count):
+            try:
+                yield page_number, extract_page_blocks(path, page_number)
+            except Exception as ex:
+                log.warning("PDF page {} could not be extracted: {}".format(
+                    page_number, describe_extraction_failure(ex)))
+                yield page_number, None
+        return
+
+    pending = deque()
+    next_page = 0
+    try:
+        while next_page < page_count or len(pending) > 0:
+            while next_page < page_count and len(pending) < get_extraction_workers() * PDF_PAGES_AHEAD:
+                pending.append((next_page,
+                                get_extraction_pool().apply_async(extract_page_blocks, (path, next_page))))
+                next_page += 1
+            page_number, result = pending.popleft()
+            try:
+                yield page_number, result.get(PDF_PAGE_TIMEOUT_S)
+            except multiprocessing.TimeoutError:
+                log.warning("PDF page {} not extracted after {}s, skipping it".format(page_number, PDF_PAGE_TIMEOUT_S))
+                # The worker is stuck: replace the pool and submit the other pages again
+                close_extraction_pool(terminate=True)
+                pending = deque((p, get_extraction_pool().apply_async(extract_page_blocks, (path, p)))
+                                for p, _ in pending)
+                yield page_number, None
+            except Exception as ex:
+                log.warning("PDF page {} could not be extracted: {}".format(
+                    page_number, describe_extraction_failure(ex)))
+                yield page_number, None
+    finally:
+        # Stopped early (text budget reached): do not leave pages of this document to the next one
+        if any(not result.ready() for _, result in pending):
+            close_extraction_pool(terminate=True)
+
+
+def is_candidate_block(text):
+    if len(text) <= MIN_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS:
+        return False
+    return sum(c.isalpha() for c in text) >= PDF_MIN_LETTERS_RATIO * len(text)
+
+
+def get_company_terms():
+    return [name.lower() for company in orm.get_companies_cache() for name in [company["name"]] + company["synonyms"]]
+
+
+# Blocks mentioning tracked companies first, then the longest ones
+def score_block(text, company_terms):
+    lower_text = text.lower()
+    return sum(term in lower_text for term in company_terms), min(len(text), 1000)
+
+
+# Returns the text of the document (blocks in order, up to the text budget), or "" if none of the best candidate blocks
+# is relevant according to is_relevant(text); raises ExtractionError if the document cannot be read
+def extract_pdf_text(pdf_content, is_relevant):
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(pdf_content)
+        path = f.name
+    try:
+        page_count = run_extraction_task(count_pdf_pages, path)
+
+        blocks = []
+        size = 0
+        skipped_pages = 0
+        for page_number, page_blocks in iter_pdf_pages(path, page_count):
+            if page_blocks is None:
+                skipped_pages += 1
+                continue
+            for text in page_blocks:
+                if not is_candidate_block(text):
+                    continue
+                if size + len(text) + 1 > get_max_text_length():
+                    break
+                blocks.append(text)
+                size += len(text) + 1
+            if size + MIN_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS > get_max_text_length():
+                log.info("PDF Content - Text budget reached at page {} / {}".format(page_number + 1, page_count))
+                break
+        log.info("PDF Content - {} candidate block(s) in {} page(s) ({} skipped)".format(
+            len(blocks), page_count, skipped_pages))
+        if page_count > 0 and skipped_pages == page_count:
+            raise ExtractionError("none of the {} page(s) could be extracted".format(page_count))
+
+        company_terms = get_company_terms()
+        candidates = sorted(blocks, key=lambda b: score_block(b, company_terms), reverse=True)
+        for text in candidates[:PDF_MAX_RELEVANCE_CHECKS]:
+            if is_relevant(text):
+                return "\n".join(blocks)
+        return ""
+    finally:
+        os.remove(path)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import zlib
+import argparse
+from collections import Counter
+
+import numpy as np
+
+from mana_common import orm
+from mana_common.orm import Analysis, AnalysisExpertManaStatus, PrefilterModel
+from mana_common.shared import set_logger, log, flush_logs
+
+# ----------------------------------------------------------------------------------------
+# Local pre-filter of content analysis: a logistic regression on hashed word n-grams, trained
+# (CPU only, offline) on the OUI_MANA / NON_MANA verdicts of the experts (Analysis.expert_mana).
+# It is applied to texts with a company match, before the NLU + Assistant evaluation:
+# - CA_PREFILTER_MODE=shadow: the probability is computed and compared to the Watson result
+#   (agreement is logged and counted in the run metrics), nothing is skipped
+# - CA_PREFILTER_MODE=enforce: texts below CA_PREFILTER_THRESHOLD are not sent to Watson, their
+#   analysis gets the 'prefiltered' status
+# Train (or re-train) the model with: python src/content_analysis/prefilter.py train
+# ----------------------------------------------------------------------------------------
+
+PREFILTER_OFF = "off"
+PREFILTER_SHADOW = "shadow"
+PREFILTER_ENFORCE = "enforce"
+PREFILTER_MODES = {PREFILTER_OFF, PREFILTER_SHADOW, PREFILTER_ENFORCE}
+# Below this probability of being OUI_MANA, a text is not sent to Watson (enforce mode)
+PREFILTER_THRESHOLD = 0.1
+PREFILTER_FEATURES = 2 ** 18
+PREFILTER_NGRAMS = 2
+PREFILTER_EPOCHS = 10
+PREFILTER_LEARNING_RATE = 0.5
+PREFILTER_L2 = 1e-5
+PREFILTER_MIN_EXAMPLES = 50
+# Share of the labeled contents kept aside (by content id) to evaluate the model before it is stored
+PREFILTER_HOLDOUT_MODULO = 5
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+_classifier = None
+_classifier_loaded = False
+
+
+def get_prefilter_mode():
+    mode = os.getenv("CA_PREFILTER_MODE", PREFILTER_OFF).lower()
+    if mode not in PREFILTER_MODES:
+        log.warning("Unknown CA_PREFILTER_MODE '{}', pre-filter is off".format(mode))
+        return PREFILTER_OFF
+    return mode
+
+
+def get_prefilter_threshold():
+    return float(os.getenv("CA_PREFILTER_THRESHOLD", PREFILTER_THRESHOLD))
+
+
+# Sparse features of a text: hashed (crc32, stable between processes) word n-grams, log counts, L2 normalized
+def hash_features(text, n_features=None, ngrams=None):
+    n_features = n_features if n_features is not None else PREFILTER_FEATURES
+    ngrams = ngrams if ngrams is not None else PREFILTER_NGRAMS
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    counts = Counter()
+    for n in range(1, ngrams + 1):
+        for i in range(len(tokens) - n + 1):
+            counts[zlib.crc32(" ".join(tokens[i:i + n]).encode("utf-8")) % n_features] += 1
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+    norm = np.linalg.norm(values)
+    return indices, values / norm if norm > 0 else values
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+class PrefilterClassifier:
+    def __init__(self, weights, bias, n_features=None, ngrams=None, model_id=None):
+        self.weights = weights
+        self.bias = bias
+        self.n_features = n_features if n_features is not None else PREFILTER_FEATURES
+        self.ngrams = ngrams if ngrams is not None else PREFILTER_NGRAMS
+        self.model_id = model_id
+
+    # Probability of the text being OUI_MANA
+    def predict_proba(self, text):
+        indices, values = hash_features(text, self.n_features, self.ngrams)
+        return float(sigmoid(self.weights[indices].dot(values) + self.bias))
+
+    @staticmethod
+    def train(texts, labels, n_features=None, ngrams=None, epochs=None, seed=0):
+        n_features = n_features if n_features is not None else PREFILTER_FEATURES
+        ngrams = ngrams if ngrams is not None else PREFILTER_NGRAMS
+        epochs = epochs if epochs is not None else PREFILTER_EPOCHS
+        examples = [hash_features(t, n_features, ngrams) for t in texts]
+        # Experts confirm few articles: both classes weigh the same in the loss
+        positives = sum(labels)
+        class_weights = {1: len(labels) / (2 * max(positives, 1)),
+                         0: len(labels) / (2 * max(len(labels) - positives, 1))}
+
+        weights = np.zeros(n_features)
+        bias = 0.0
+        rng = np.random.RandomState(seed)
+        for epoch in range(epochs):
+            learning_rate = PREFILTER_LEARNING_RATE / (1 + epoch)
+            for i in rng.permutation(len(examples)):
+                indices, values = examples[i]
+                gradient = (sigmoid(weights[indices].dot(values) + bias) - labels[i]) * class_weights[labels[i]]
+                weights[indices] -= learning_rate * (gradient * values + PREFILTER_L2 * weights[indices])
+                bias -= learning_rate * gradient
+        return PrefilterClassifier(weights, bias, n_features, ngrams)
+
+
+# Latest trained model, or None when no model was trained yet
+def get_prefilter_classifier():
+    global _classifier, _classifier_loaded
+    if _classifier_loaded:
+        return _classifier
+    model = orm.get_session().query(PrefilterModel).order_by(PrefilterModel.id.desc()).first()
+    if model is None:
+        log.warning("No pre-filter model was trained, pre-filter is off")
+    else:
+        _classifier = PrefilterClassifier(np.frombuffer(model.weights, dtype=np.float32), model.bias,
+                                          model.n_features, model.ngrams, model.id)
+        log.info("Pre-filter model {} loaded (trained on {} examples: {})".format(
+            model.id, model.examples, model.metrics))
+    _classifier_loaded = True
+    return _classifier
+
+
+# Probability of the text being OUI_MANA, None if there is no model
+def predict_mana_probability(text):
+    classifier = get_prefilter_classifier()
+    if classifier is None:
+        return None
+    return classifier.predict_proba(text)
+
+
+# One example per content: OUI_MANA if experts confirmed one of its analyses
+def load_training_examples():
+    rows = orm.get_session() \
+        .query(Analysis.content_id, Analysis.translated_text, Analysis.original_text, Analysis.expert_mana) \
+        .filter(Analysis.expert_mana.in_([AnalysisExpertManaStatus.OUI_MANA, AnalysisExpertManaStatus.NON_MANA])) \
+        .all()
+    examples = {}
+    for content_id, translated_text, original_text, expert_mana in rows:
+        text = translated_text or original_text
+        if not text:
+            continue
+        label = 1 if expert_mana == AnalysisExpertManaStatus.OUI_MANA else 0
+        if content_id in examples:
+            label = max(label, examples[content_id][1])
+        examples[content_id] = (text, label)
+    return examples
+
+
+def evaluate_classifier(classifier, texts, labels, threshold):
+    probabilities = np.array([classifier.predict_proba(t) for t in texts])
+    labels = np.array(labels)
+    sent = probabilities >= threshold
+    return {
+        "examples": len(labels),
+        "accuracy": round(float(np.mean((probabilities >= 0.5) == labels)), 4),
+        # Share of OUI_MANA contents that would still be evaluated by Watson (should stay close to 1)
+        "positive_recall": round(float(np.mean(sent[labels == 1])), 4) if labels.sum() > 0 else None,
+        # Share of contents that would not be sent to Watson
+        "skip_rate": round(float(np.mean(~sent)), 4),
+    }
+
+
+def train_prefilter_model(epochs=None):
+    examples = load_training_examples()
+    positives = sum(label for _, label in examples.values())
+    log.info("{} labeled content(s), {} OUI_MANA".format(len(examples), positives))
+    if len(examples) < PREFILTER_MIN_EXAMPLES or positives == 0 or positives == len(examples):
+        log.error("Not enough labeled contents to train the pre-filter (at least {} with both verdicts)".format(
+            PREFILTER_MIN_EXAMPLES))
+        return None
+
+    train_ids = [i for i in examples if i % PREFILTER_HOLDOUT_MODULO != 0]
+    holdout_ids = [i for i in examples if i % PREFILTER_HOLDOUT_MODULO == 0]
+    classifier = PrefilterClassifier.train([examples[i][0] for i in train_ids], [examples[i][1] for i in train_ids],
+                                           epochs=epochs)
+    metrics = evaluate_classifier(classifier, [examples[i][0] for i in holdout_ids],
+                                  [examples[i][1] for i in holdout_ids], get_prefilter_threshold())
+    log.info("Pre-filter evaluation on {} held out content(s): {}".format(len(holdout_ids), metrics))
+
+    # The stored model is trained on all the labeled contents
+    classifier = PrefilterClassifier.train([t for t, _ in examples.values()], [l for _, l in examples.values()],
+                                           epochs=epochs)
+    model = PrefilterModel(
+        n_features=classifier.n_features,
+        ngrams=classifier.ngrams,
+        weights=classifier.weights.astype(np.float32).tobytes(),
+        bias=float(classifier.bias),
+        examples=len(examples),
+        metrics=metrics
+    )
+    orm.get_session().add(model)
+    orm.get_session().commit()
+    log.info("Pre-filter model {} stored".format(model.id))
+    return metrics
+
+
+def main(epochs=None):
+    try:
+        set_logger("ca-prefilter")
+        PrefilterModel.__table__.create(bind=orm.get_db_engine(), checkfirst=True)
+        train_prefilter_model(epochs)
+    finally:
+        flush_logs()
+
+
+# Run if local (Docker)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MANA content analysis pre-filter")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--epochs", type=int, default=None,
+                        help="number of passes over the labeled contents (default: {})".format(PREFILTER_EPOCHS))
+    main(epochs=parser.parse_args().epochs)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from mana_common import orm
+from mana_common.orm import ContentAnalysisRun
+from mana_common.shared import log
+
+# ----------------------------------------------------------------------------------------
+# Time budget of a content analysis run. When CA_DEADLINE_S is set (number of seconds the
+# content analysis step may last, e.g. a bit less than the job max execution time), contents
+# are analysed by priority and no new content is started once the remaining time is not
+# enough to analyse one more (estimated from past runs), so that the current batch of
+# analyses can be committed before the job is stopped.
+# ----------------------------------------------------------------------------------------
+
+# Used when there is no past run to learn from
+DEFAULT_ITEM_COST_S = 10
+# Number of past runs the per-content cost is estimated from
+ITEM_COST_HISTORY_RUNS = 20
+# Weight (in number of contents) of the historical estimate against the contents analysed during this run
+ITEM_COST_HISTORY_WEIGHT = 10
+# Analyses vary a lot (a tweet vs. a 50 pages PDF): keep a margin of a few contents
+ITEM_COST_SAFETY_FACTOR = 3
+# Time kept to write the last batch of analyses
+FLUSH_MARGIN_S = 15
+
+
+def get_deadline(started_at):
+    budget = os.getenv("CA_DEADLINE_S")
+    if not budget:
+        return None
+    return started_at + int(budget)
+
+
+def load_historical_item_cost():
+    runs = orm.get_session().query(ContentAnalysisRun) \
+        .filter(ContentAnalysisRun.contents > 0) \
+        .order_by(ContentAnalysisRun.id.desc()) \
+        .limit(ITEM_COST_HISTORY_RUNS) \
+        .all()
+    contents = sum(r.contents for r in runs)
+    if contents == 0:
+        return None
+    return sum(r.duration_s for r in runs) / contents
+
+
+def record_analysis_run(worker_id, metrics, deadline_reached=False):
+    orm.get_session().add(ContentAnalysisRun(
+        worker_id=worker_id,
+        contents=metrics.get("contents", 0),
+        duration_s=metrics.get("worker_time_s", 0),
+        deadline_reached=deadline_reached,
+        metrics=metrics
+    ))
+    orm.get_session().commit()
+
+
+class DeadlineScheduler:
+    def __init__(self, deadline, historical_item_cost_s=None):
+        self.deadline = deadline
+        self.historical_item_cost_s = historical_item_cost_s if historical_item_cost_s is not None \
+            else DEFAULT_ITEM_COST_S
+        self.items = 0
+        self.items_time_s = 0
+        self.deadline_reached = False
+
+    def estimated_item_cost_s(self):
+        return (self.historical_item_cost_s * ITEM_COST_HISTORY_WEIGHT + self.items_time_s) / \
+               (ITEM_COST_HISTORY_WEIGHT + self.items)
+
+    def remaining_s(self):
+        return self.deadline - time.time()
+
+    def item_done(self, duration_s):
+        self.items += 1
+        self.items_time_s += duration_s
+
+    def has_time_for_next_item(self):
+        needed_s = self.estimated_item_cost_s() * ITEM_COST_SAFETY_FACTOR + FLUSH_MARGIN_S
+        if self.remaining_s() < needed_s:
+            if not self.deadline_reached:
+                log.info("Deadline is near ({:.0f}s left, ~{:.1f}s per content): no new content will be analysed"
+                         .format(self.remaining_s(), self.estimated_item_cost_s()))
+            self.deadline_reached = True
+            return False
+        return True
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from mana_common.shared import log, get_translator
+
+# ----------------------------------------------------------------------------------------
+# Translation of long texts: the text is split on paragraph, then sentence boundaries into
+# chunks small enough for one Language Translator request, chunks are translated
+# concurrently (bounded pool) and put back together in order, with the separators of the
+# original text.
+# ----------------------------------------------------------------------------------------
+
+TRANSLATION_CHUNK_SIZE = 10000
+TRANSLATION_WORKERS = 4
+# Boundaries a chunk preferably ends on, by preference
+CHUNK_BOUNDARIES = ["\n\n", "\n", ". ", "! ", "? ", "; ", ", ", " "]
+
+
+def get_translation_workers():
+    return int(os.getenv("CA_TRANSLATION_WORKERS", TRANSLATION_WORKERS))
+
+
+# Returns the (start, end) offsets of the chunks; the text between two chunks is only made of boundary characters
+def split_into_chunks(text, chunk_size=None):
+    chunk_size = chunk_size if chunk_size is not None else TRANSLATION_CHUNK_SIZE
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            # Last boundary of the preferred kind in the second half of the chunk (avoid tiny chunks)
+            for boundary in CHUNK_BOUNDARIES:
+                position = text.rfind(boundary, start + chunk_size // 2, end)
+                if position >= 0:
+                    end = position + len(boundary.rstrip()) if boundary.strip() else position
+                    break
+        chunks.append((start, end))
+        start = end
+        # Separators are not translated
+        while start < len(text) and text[start].isspace():
+            start += 1
+    return chunks
+
+
+def translate_chunk(chunk, model_id):
+    return get_translator().translate(text=chunk, model_id=model_id).get_result()['translations'][0]['translation']
+
+
+# Returns the translated text and the number of chunks translated
+def translate_text(text, model_id, chunk_size=None, workers=None):
+    workers = workers if workers is not None else get_translation_workers()
+    chunks = split_into_chunks(text, chunk_size)
+    if len(chunks) > 1:
+        log.info("Translating {} chars in {} chunks".format(len(text), len(chunks)))
+    if len(chunks) <= 1 or workers <= 1:
+        translated_chunks = [translate_chunk(text[start:end], model_id) for start, end in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            translated_chunks = list(executor.map(lambda chunk: translate_chunk(text[chunk[0]:chunk[1]], model_id),
+                                                  chunks))
+
+    parts = []
+    for i, (start, end) in enumerate(chunks):
+        next_start = chunks[i + 1][0] if i + 1 < len(chunks) else len(text)
+        parts.append(translated_chunks[i])
+        parts.append(text[end:next_start])
+    return "".join(parts), len(chunks)
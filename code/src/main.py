@@ -3,7 +3,9 @@ from source_grouping.main import main as sg_main
 from source_tagging.main import main as st_main
 from content_analysis.main import main as ca_main
 
-sa_main()
-sg_main()
-st_main()
-ca_main()
+# Guarded: content analysis worker processes (CA_WORKERS) re-import the main module when they start
+if __name__ == "__main__":
+    sa_main()
+    sg_main()
+    st_main()
+    ca_main()
@@ -0,0 +1,88 @@
+import re
+from urllib.parse import urlsplit
+
+# ----------------------------------------------------------------------------------------
+# Matchers built once from the lists & patterns of the config (see orm.get_config_matchers)
+# instead of being scanned or compiled again for every URL or text:
+# - SubstringMatcher: "any(s in text for s in strings)", as one regex of the escaped strings
+# - PatternMatcher: "any(re.search(p, text) for p in patterns)", as one regex
+# - HostSuffixMatcher: domains, matched against the host of a URL and its parent domains
+#   (trie of the reversed labels), e.g. "facebook.com" matches "https://m.facebook.com/..."
+# ----------------------------------------------------------------------------------------
+
+DOMAIN_PATTERN = re.compile(r"^[\w-]+(\.[\w-]+)+$")
+_END = "."
+
+
+class SubstringMatcher:
+    def __init__(self, strings):
+        strings = [s for s in (strings or []) if s]
+        # Longest first, so that search() returns the longest string found at a position
+        self.regex = re.compile("|".join(re.escape(s) for s in sorted(strings, key=len, reverse=True))) \
+            if len(strings) > 0 else None
+
+    def search(self, text):
+        return self.regex.search(text) if self.regex is not None and text is not None else None
+
+    def matches(self, text):
+        return self.search(text) is not None
+
+
+class PatternMatcher:
+    def __init__(self, patterns):
+        patterns = list(patterns or [])
+        self.regexes = []
+        if len(patterns) > 0:
+            try:
+                self.regexes = [re.compile("|".join("(?:{})".format(p) for p in patterns))]
+            except re.error:
+                # Patterns that cannot be combined (e.g. global flags) are kept apart
+                self.regexes = [re.compile(p) for p in patterns]
+
+    def search(self, text):
+        if text is None:
+            return None
+        for regex in self.regexes:
+            match = regex.search(text)
+            if match is not None:
+                return match
+        return None
+
+    def matches(self, text):
+        return self.search(text) is not None
+
+
+class HostSuffixMatcher:
+    def __init__(self, domains):
+        self.trie = {}
+        substrings = []
+        for domain in (domains or []):
+            domain = domain.strip()
+            if DOMAIN_PATTERN.match(domain):
+                node = self.trie
+                for label in reversed(domain.lower().split(".")):
+                    node = node.setdefault(label, {})
+                node[_END] = True
+            elif domain:
+                # Not a domain name (path, port...): matched anywhere in the URL, as before
+                substrings.append(domain)
+        self.substrings = SubstringMatcher(substrings)
+
+    def matches_host(self, host):
+        node = self.trie
+        for label in reversed((host or "").lower().split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
+
+    def matches(self, url):
+        if url is None:
+            return False
+        try:
+            host = urlsplit(url if "//" in url else "//" + url).hostname
+        except ValueError:
+            host = None
+        return self.matches_host(host) or self.substrings.matches(url)
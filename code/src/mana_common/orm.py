@@ -1,16 +1,21 @@
 import os
 
 from sqlalchemy.orm import relationship, backref
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine, Column, ForeignKey, Enum, \
-    Integer, String, Sequence, Float, Boolean, BigInteger, ARRAY, DateTime
+    Integer, String, Sequence, Float, Boolean, BigInteger, ARRAY, DateTime, LargeBinary, text, bindparam, \
+    UniqueConstraint, Index
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.dialects.postgresql import JSON
 from functools import reduce
 from sqlalchemy.sql import func
 import enum
+import re
 from mana_common.shared import log, get_twitter_infos, find_rss_feed, find_company_name_matches
-from datetime import datetime
+from mana_common.matchers import SubstringMatcher, PatternMatcher, HostSuffixMatcher
+from datetime import datetime, timedelta, timezone
 
 DB_POOL_SIZE = 30
 DB_MAX_OVERFLOW = 3
@@ -19,7 +24,13 @@ SCHEMA = "manav3"
 _db_engine = None
 _session = None
 _config = None
+# (config, matchers built from it), see get_config_matchers()
+_config_matchers = None
 _cache_companies = None
+# Site -> RssDiscovery, while loaded (see load_rss_discoveries)
+_rss_discoveries = None
+RSS_DISCOVERY_TTL_DAYS = 30
+RSS_DISCOVERY_NEGATIVE_TTL_DAYS = 7
 
 
 # ----------------------------------------------------------------------------------------
@@ -93,9 +104,32 @@ def get_config():
     return _config
 
 
+# Same keys as get_config(), with the lists & patterns compiled into matchers (see matchers.py), built again only when
+# the config changes
+def get_config_matchers():
+    global _config_matchers
+    config = get_config()
+    if _config_matchers is None or _config_matchers[0] is not config:
+        _config_matchers = (config, {
+            "url_extensions_to_check_for_true_url": SubstringMatcher(config["url_extensions_to_check_for_true_url"]),
+            "domains_where_next_element_matters": HostSuffixMatcher(config["domains_where_next_element_matters"]),
+            "ignore_for_rss_search": PatternMatcher(config["ignore_for_rss_search"]),
+            "url_patterns_to_ignore": PatternMatcher(config["url_patterns_to_ignore"]),
+            "url_pattern_to_ignore_for_content_analysis":
+                SubstringMatcher(config["url_pattern_to_ignore_for_content_analysis"]),
+            "social_keywords_pattern": re.compile(config["social_keywords_pattern"])
+        })
+    return _config_matchers[1]
+
+
 def setup_db(db_connection_string):
     global _db_engine, _session
-    _db_engine = create_engine(db_connection_string, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    engine_options = {}
+    if db_connection_string.startswith("postgres"):
+        # Let psycopg2 send executemany() batches as multi-row INSERT/UPDATE statements
+        engine_options["executemany_mode"] = "values"
+    _db_engine = create_engine(db_connection_string, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                               **engine_options)
     _session = sessionmaker(bind=_db_engine)()
     log.info("DB engine & session set")
 
@@ -292,6 +326,9 @@ def merge_entities(e1_id, e2_id, reason):
     # Origins: "add"
     for o in entity_to_wipe.origins:
         o.entity = entity_to_keep
+    # Grouping keys of the kept entity are computed again by the next source grouping
+    get_session().query(GroupingKey).filter(GroupingKey.entity_id == entity_to_keep.id).delete(
+        synchronize_session=False)
 
     # Merge details: "add"
     etk_details = [] if entity_to_keep.merges_details is None else entity_to_keep.merges_details.copy()
@@ -332,18 +369,109 @@ def create_twitter_origin(entity, twitter_screen_name):
     twitter_origin.entity = entity
     retrieve_tweeter_profile(twitter_origin)
 
+# Cache key of a web site: URL without scheme, "www." and trailing "/"
+def get_rss_discovery_site(url):
+    return re.sub(r"^([a-z][a-z0-9+.-]*:)?//(www\.)?", "", url.strip().lower()).rstrip("/")
+
+
+def get_rss_discovery_ttl(rss):
+    days = os.getenv("SA_RSS_CACHE_TTL_DAYS", RSS_DISCOVERY_TTL_DAYS) if rss is not None \
+        else os.getenv("SA_RSS_NEGATIVE_CACHE_TTL_DAYS", RSS_DISCOVERY_NEGATIVE_TTL_DAYS)
+    return timedelta(days=float(days))
+
+
+# All the discoveries in memory, e.g. for a run of source acquisition (or to be read by other threads)
+def load_rss_discoveries():
+    global _rss_discoveries
+    _rss_discoveries = {d.site: d for d in get_session().query(RssDiscovery).all()}
+    log.info("Loaded {} RSS discovery(ies)".format(len(_rss_discoveries)))
+
+
+def clear_rss_discoveries():
+    global _rss_discoveries
+    _rss_discoveries = None
+
+
+# (True, feed or None if the site has none) if the site was checked recently enough, (False, None) otherwise
+def get_cached_rss_feed(url):
+    site = get_rss_discovery_site(url)
+    if _rss_discoveries is not None:
+        discovery = _rss_discoveries.get(site)
+    else:
+        discovery = get_session().query(RssDiscovery).filter(RssDiscovery.site == site).first()
+    if discovery is None or discovery.checked_at is None \
+            or discovery.checked_at + get_rss_discovery_ttl(discovery.rss) < datetime.now(timezone.utc):
+        return False, None
+    return True, discovery.rss
+
+
+def cache_rss_feed(url, rss):
+    discovery = get_session().merge(RssDiscovery(site=get_rss_discovery_site(url), rss=rss,
+                                                 checked_at=datetime.now(timezone.utc)))
+    if _rss_discoveries is not None:
+        _rss_discoveries[discovery.site] = discovery
+
+
+# find_rss_feed, through the cache of discoveries. A site that could not be fetched is not cached.
+# fetch_rss_feed(url): feed of the site (None if it has none), raising when the site could not be fetched
+def find_rss_feed_cached(url, fetch_rss_feed=None):
+    found, rss = get_cached_rss_feed(url)
+    if found:
+        log.info("RSS discovery of {} cached: {}".format(url, rss))
+        return rss
+    try:
+        rss = fetch_rss_feed(url) if fetch_rss_feed is not None else find_rss_feed(url, raise_errors=True)
+    except Exception:
+        return None
+    cache_rss_feed(url, rss)
+    return rss
+
+
+# Web or RSS origin of a base URL (base URLs are unique), None if there is none
+def find_origin_by_base_url(origin_class, base_url):
+    return get_session().query(origin_class).filter(origin_class.base_url == base_url).first()
+
+
+# True if the origin belongs to another entity than the given one: it is not moved from an entity to another (which
+# could leave the first one without origins), the entities are to be merged instead (see merge_entities)
+def belongs_to_other_entity(origin, entity):
+    return origin.entity is not None and origin.entity is not entity
+
+
+# Origins of the web site that already exist without entity are linked to the entity. None if the web origin already
+# belongs to another entity (e.g. created by source acquisition).
 def create_web_and_rss_origins(entity, web):
     log.info("create web and rss origin for url {}".format(web))
-    web_origin = WebOrigin(raw_url=web, expanded_url=web, base_url=web, entity=entity)
-    rss = find_rss_feed(web_origin.base_url)
+    web_origin = find_origin_by_base_url(WebOrigin, web)
+    if web_origin is not None:
+        if belongs_to_other_entity(web_origin, entity):
+            log.warning("Web origin {} already belongs to entity {}, not linking it to entity {}: merge them instead"
+                        .format(web, web_origin.entity.name, entity.name))
+            return None
+        log.info("Web origin {} already exists, linking it to entity {}".format(web, entity.name))
+        web_origin.entity = entity
+    else:
+        web_origin = WebOrigin(raw_url=web, expanded_url=web, base_url=web, entity=entity)
+    rss_origin = find_origin_by_base_url(RssOrigin, web)
+    if rss_origin is not None:
+        if belongs_to_other_entity(rss_origin, entity):
+            log.warning("Rss origin {} already belongs to entity {}, not linking it to entity {}".format(
+                rss_origin.rss, rss_origin.entity.name, entity.name))
+            return web_origin
+        log.info("Rss origin {} already exists, linking it to entity {}".format(rss_origin.rss, entity.name))
+        rss_origin.entity = entity
+        rss_origin.origin_web = web_origin
+        return web_origin
+    rss = find_rss_feed_cached(web_origin.base_url)
     if rss is not None:
         log.info("Found rss {}".format(rss))
         rss_origin = RssOrigin(rss=rss, base_url=web_origin.base_url, origin_web=web_origin)
         rss_origin.entity = web_origin.entity
+    return web_origin
 
 def update_tweeter_profile(twitter_origin):
     log.info("Updating tweeter profile : {}".format(twitter_origin.screen_name))
-    url, description, location = get_twitter_infos(twitter_origin.screen_name, get_config()['url_extensions_to_check_for_true_url'])
+    url, description, location = get_twitter_infos(twitter_origin.screen_name, get_config_matchers()['url_extensions_to_check_for_true_url'])
     if url != None:
         twitter_origin.twitter_profile.url = url
     if description != None:
@@ -353,7 +481,7 @@ def update_tweeter_profile(twitter_origin):
 
 def retrieve_tweeter_profile(twitter_origin):
     log.info("Saving tweeter profile : {}".format(twitter_origin.screen_name))
-    url, description, location = get_twitter_infos(twitter_origin.screen_name, get_config()['url_extensions_to_check_for_true_url'])
+    url, description, location = get_twitter_infos(twitter_origin.screen_name, get_config_matchers()['url_extensions_to_check_for_true_url'])
     # if user account doesn't exist, values are set to None
     if url != None: # if url is set, account exists and has a description
         profile = TwitterProfile(url=url, description=description)
@@ -393,22 +521,96 @@ def find_companies(text):
     return matching_companies
 
 
-def delete_previous_analysis(content):
-    if get_session() is not None:  # so that the analysis function can be ran autonomously from the main()
+def delete_previous_analyses(content_ids, keep_analysis_ids=None):
+    # Set-based replacement of the former per-content SELECT + DELETE: one statement for a whole batch
+    if len(content_ids) == 0:
+        return 0
+    query = get_session().query(Analysis).filter(Analysis.content_id.in_(content_ids))
+    if keep_analysis_ids:
+        query = query.filter(Analysis.id.notin_(keep_analysis_ids))
+    # New analyses are already attached to the session (through the content backref): they must not be flushed
+    # before the delete, otherwise they would be deleted as well
+    with get_session().no_autoflush:
+        deleted = query.delete(synchronize_session=False)
+    log.info("[delete_previous_analyses] deleted {} previous analysis(es) for {} content(s)".format(
+        deleted, len(content_ids)))
+    return deleted
+
+
+# Pre-allocate analysis ids in a single round trip so that the ORM can send a batch of inserts as one executemany()
+# (it otherwise has to insert rows one by one to fetch each generated id back)
+def reserve_analysis_ids(count):
+    session = get_session()
+    if count == 0 or session.bind is None or session.bind.dialect.name != "postgresql":
+        return []
+    rows = session.execute(
+        text("SELECT nextval('{}.analysis_id_seq') FROM generate_series(1, :count)".format(SCHEMA)),
+        {"count": count}
+    ).fetchall()
+    return [r[0] for r in rows]
+
+
+# Adds occurrences to origins ({origin id: count}) in one statement: the database does the increment, so that concurrent
+# acquisitions cannot lose counts (as reading, incrementing and writing back the attribute would)
+def add_origin_occurrences(increments):
+    if len(increments) == 0:
+        return
+    session = get_session()
+    if session.bind is not None and session.bind.dialect.name == "postgresql":
+        session.execute(
+            text("UPDATE {}.origins AS o SET occurrences = COALESCE(o.occurrences, 0) + v.n, time_updated = now() "
+                 "FROM unnest(CAST(:ids AS integer[]), CAST(:counts AS integer[])) AS v(id, n) "
+                 "WHERE o.id = v.id".format(SCHEMA)),
+            {"ids": list(increments.keys()), "counts": list(increments.values())}
+        )
+    else:
+        origins = Origin.__table__
+        session.execute(
+            origins.update().where(origins.c.id == bindparam("origin_id")).values(
+                occurrences=func.coalesce(origins.c.occurrences, 0) + bindparam("count")),
+            [{"origin_id": origin_id, "count": count} for origin_id, count in increments.items()]
+        )
+
+
+# Unique base URLs of web and RSS origins, for databases created before the constraints were in the model. Not created
+# (with a warning) while a table has duplicates, to be merged manually
+def upgrade_origin_unique_indexes():
+    if get_db_engine().dialect.name != "postgresql":
+        return
+    for table in (WebOrigin.__table__, RssOrigin.__table__):
+        # Name of the index of the unique constraint created along with the table
+        index_name = "{}_base_url_key".format(table.name)
         try:
-            previous_analysis = get_session().query(Analysis).filter(
-                Analysis.content_id == content.id
-            ).all()
-        except Exception as ex:
-            log.info(
-                "[delete_previous_analysis] Unable to query, most likely due to a db schema update (you may need to recreate analysis table), exiting ({})".format(ex))
-            exit()
-            return
-
-        for analysis in previous_analysis:
-            log.info(
-                "[delete_previous_analysis] deleting a previous analysis")
-            get_session().delete(analysis)
+            with get_db_engine().begin() as connection:
+                connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {}.{} (base_url)".format(
+                    index_name, SCHEMA, table.name)))
+        except IntegrityError as ex:
+            log.warning("Unique index {} not created, {} has duplicated base URLs: {}".format(
+                index_name, table.name, ex))
+
+
+# Columns added to origins after the table was created. Existing origins keep keys_changed_at NULL (read as their
+# time_created), rather than all being stamped by the upgrade
+def upgrade_origin_columns():
+    if get_db_engine().dialect.name != "postgresql":
+        return
+    with get_db_engine().begin() as connection:
+        connection.execute(text("ALTER TABLE {}.origins ADD COLUMN IF NOT EXISTS keys_changed_at "
+                                "TIMESTAMP WITH TIME ZONE".format(SCHEMA)))
+        connection.execute(text("ALTER TABLE {}.origins ALTER COLUMN keys_changed_at SET DEFAULT now()".format(SCHEMA)))
+
+
+# Adds the values of a Python enum that are missing from its PostgreSQL type (created by a previous version of the
+# model). ALTER TYPE ... ADD VALUE cannot run in a transaction block before PostgreSQL 12: use an autocommit connection.
+def upgrade_enum_type(enum_class):
+    if get_db_engine().dialect.name != "postgresql":
+        return
+    type_name = enum_class.__name__.lower()
+    with get_db_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for value in enum_class.__members__:
+            connection.execute(text("ALTER TYPE {} ADD VALUE IF NOT EXISTS '{}'".format(type_name, value)))
+    log.info("Enum type {} is up to date".format(type_name))
+
 
 def initialize_analysis(content):
     analysis_ts = int(datetime.now().timestamp())
@@ -444,6 +646,22 @@ class AnalysisStatus(enum.Enum):
     other_exception = 3
     completed = 4
     no_content = 5
+    prefiltered = 6
+    failed_at_extraction = 7
+
+class ContentLeaseStatus(enum.Enum):
+    in_flight = 1
+    done = 2
+    failed = 3
+
+class EnrichmentKind(enum.Enum):
+    rss_discovery = 1
+    twitter_profile = 2
+
+class EnrichmentStatus(enum.Enum):
+    pending = 1
+    done = 2
+    failed = 3
 
 class AnalysisType(enum.Enum):
     tweet = 1
@@ -526,6 +744,8 @@ class Origin(Base):
     last_synced_id = Column(BigInteger)
     time_created = Column(DateTime(timezone=True), server_default=func.now())
     time_updated = Column(DateTime(timezone=True), onupdate=func.now())
+    # Last change of what source grouping keys the origin by (see touch_origin_keys)
+    keys_changed_at = Column(DateTime(timezone=True), server_default=func.now())
 
     __mapper_args__ = {
         'polymorphic_identity': 'origin',
@@ -565,7 +785,7 @@ class WebOrigin(Origin):
     id = Column(Integer, ForeignKey(SCHEMA + '.origins.id'), primary_key=True)
     raw_url = Column(String)
     expanded_url = Column(String)
-    base_url = Column(String)
+    base_url = Column(String, unique=True)
     valid_extraction = Column(Boolean, default=True)
 
     __mapper_args__ = {
@@ -577,7 +797,7 @@ class RssOrigin(Origin):
     __tablename__ = 'origins_rss'
     __table_args__ = {'schema': SCHEMA}
     id = Column(Integer, ForeignKey(SCHEMA + '.origins.id'), primary_key=True)
-    base_url = Column(String)
+    base_url = Column(String, unique=True)
     rss = Column(String)
     valid_extraction = Column(Boolean, default=True)
 
@@ -589,6 +809,29 @@ class RssOrigin(Origin):
     }
 
 
+# What source grouping keys an origin by: its entity, screen name, Twitter profile (whose own changes are in its
+# time_updated) and URLs. time_updated cannot tell these changes apart, as it changes with every mention
+# (see add_origin_occurrences).
+ORIGIN_KEY_ATTRIBUTES = ("entity", "entity_id", "screen_name", "twitter_profile", "twitter_profile_id", "expanded_url",
+                         "base_url")
+
+
+@event.listens_for(Origin, "before_update", propagate=True)
+def touch_origin_keys(mapper, connection, origin):
+    attributes = inspect(origin).attrs
+    if any(name in attributes and attributes[name].history.has_changes() for name in ORIGIN_KEY_ATTRIBUTES):
+        origin.keys_changed_at = func.now()
+
+
+# Last RSS feed discovery on a web site (see find_rss_feed_cached), rss is None when the site has no feed
+class RssDiscovery(Base):
+    __tablename__ = 'rss_discoveries'
+    __table_args__ = {'schema': SCHEMA}
+    site = Column(String, primary_key=True)
+    rss = Column(String)
+    checked_at = Column(DateTime(timezone=True))
+
+
 class Content(Base):
     __tablename__ = 'contents'
     __table_args__ = {'schema': SCHEMA}
@@ -602,6 +845,78 @@ class Content(Base):
     time_updated = Column(DateTime(timezone=True), onupdate=func.now())
 
 
+# Work queue for content analysis: a content is analysed by the worker holding its (non expired) lease
+class ContentLease(Base):
+    __tablename__ = 'content_leases'
+    __table_args__ = {'schema': SCHEMA}
+    content_id = Column(Integer, ForeignKey(SCHEMA + '.contents.id', ondelete="CASCADE"), primary_key=True)
+    worker_id = Column(String)
+    status = Column(Enum(ContentLeaseStatus))
+    leased_until = Column(DateTime(timezone=True))
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    time_created = Column(DateTime(timezone=True), server_default=func.now())
+    time_updated = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+# Network enrichment of a new origin, deferred by source acquisition (see source_acquisition.enrichment)
+class EnrichmentTask(Base):
+    __tablename__ = 'enrichment_tasks'
+    __table_args__ = (UniqueConstraint('kind', 'origin_id'), {'schema': SCHEMA})
+    id = Column(Integer, Sequence('enrichment_tasks_id_seq', schema=SCHEMA), primary_key=True)
+    kind = Column(Enum(EnrichmentKind))
+    origin_id = Column(Integer, ForeignKey(SCHEMA + '.origins.id', ondelete="CASCADE"))
+    status = Column(Enum(EnrichmentStatus), default=EnrichmentStatus.pending)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime(timezone=True))
+    last_error = Column(String)
+    time_created = Column(DateTime(timezone=True), server_default=func.now())
+    time_updated = Column(DateTime(timezone=True), onupdate=func.now())
+
+    origin = relationship(Origin)
+
+
+# Keys of an entity already matched by source grouping: blocking keys, fuzzy values and their n-grams, tokens... (see
+# source_grouping.keys)
+class GroupingKey(Base):
+    __tablename__ = 'grouping_keys'
+    __table_args__ = (Index('grouping_keys_kind_key_idx', 'kind', 'key'), {'schema': SCHEMA})
+    id = Column(Integer, Sequence('grouping_keys_id_seq', schema=SCHEMA), primary_key=True)
+    entity_id = Column(Integer, ForeignKey(SCHEMA + '.entities.id', ondelete="CASCADE"), index=True)
+    kind = Column(String)
+    key = Column(String)
+    # Fuzzy value the key comes from
+    value = Column(String)
+    time_created = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# One row per content analysis run (or worker), used to estimate how long analysing a content takes
+class ContentAnalysisRun(Base):
+    __tablename__ = 'content_analysis_runs'
+    __table_args__ = {'schema': SCHEMA}
+    id = Column(Integer, Sequence('content_analysis_runs_id_seq', schema=SCHEMA), primary_key=True)
+    worker_id = Column(String)
+    contents = Column(Integer)
+    duration_s = Column(Float)
+    deadline_reached = Column(Boolean, default=False)
+    metrics = Column(JSON)
+    time_created = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# Local text classifier used to pre-filter contents before the Watson evaluation (see content_analysis.prefilter)
+class PrefilterModel(Base):
+    __tablename__ = 'prefilter_models'
+    __table_args__ = {'schema': SCHEMA}
+    id = Column(Integer, Sequence('prefilter_models_id_seq', schema=SCHEMA), primary_key=True)
+    n_features = Column(Integer)
+    ngrams = Column(Integer)
+    weights = Column(LargeBinary)
+    bias = Column(Float)
+    examples = Column(Integer)
+    metrics = Column(JSON)
+    time_created = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class OriginGroup(Base):
     __tablename__ = 'origins_mentioned_by_groups'
     __table_args__ = {'schema': SCHEMA}
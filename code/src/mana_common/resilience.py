@@ -0,0 +1,211 @@
+import os
+import time
+import logging
+import random
+import socket
+import threading
+from functools import partial
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import requests
+
+# Same (root) logger as shared.log, which imports this module
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------------------------
+# Resilience of the calls to the Watson services (see shared.get_nlu, get_assistant,
+# get_translator), one ServiceGuard per service and process:
+# - adaptive concurrency (AIMD): the number of concurrent calls grows by one per "window" of
+#   successful calls, and is halved when the service throttles (429, 503) or times out
+# - retries with exponential backoff and full jitter, a 429 Retry-After is honored
+# - circuit breaker: after consecutive failures, calls are rejected (CircuitOpenError) for
+#   a while, then a single call probes the service
+# Latency and error counters by service: get_service_stats()
+# ----------------------------------------------------------------------------------------
+
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY_S = 1
+RETRY_MAX_DELAY_S = 30
+RETRY_AFTER_MAX_S = 60
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLING_STATUS_CODES = {429, 503}
+CONCURRENCY_INITIAL = 4
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 16
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_S = 60
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, service):
+        super().__init__("{} is unavailable (circuit open)".format(service))
+        self.service = service
+
+
+def get_status_code(ex):
+    code = getattr(ex, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(ex):
+    if isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, socket.timeout)):
+        return True
+    return get_status_code(ex) in RETRYABLE_STATUS_CODES
+
+
+def is_throttling(ex):
+    if isinstance(ex, (requests.exceptions.Timeout, socket.timeout)):
+        return True
+    return get_status_code(ex) in THROTTLING_STATUS_CODES
+
+
+# Delay asked by the service (Retry-After: seconds or HTTP date), None if there is none
+def get_retry_after_s(ex):
+    response = getattr(ex, "httpResponse", None)
+    value = response.headers.get("Retry-After") if response is not None and response.headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ServiceGuard:
+    def __init__(self, name, max_attempts=None, concurrency_max=None):
+        self.name = name
+        self.max_attempts = max_attempts if max_attempts is not None else RETRY_MAX_ATTEMPTS
+        self.concurrency_max = concurrency_max if concurrency_max is not None else \
+            int(os.getenv("WATSON_MAX_CONCURRENCY", CONCURRENCY_MAX))
+        self.concurrency_limit = float(min(CONCURRENCY_INITIAL, self.concurrency_max))
+        self.in_flight = 0
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.stats = Counter()
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.state == CIRCUIT_OPEN:
+                if time.monotonic() < self.open_until:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(self.name)
+                log.info("[{}] Circuit half open, probing the service".format(self.name))
+                self.state = CIRCUIT_HALF_OPEN
+            elif self.state == CIRCUIT_HALF_OPEN:
+                # A single probe at a time
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.name)
+            while self.in_flight >= int(self.concurrency_limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency_s, ex=None):
+        with self._condition:
+            self.in_flight -= 1
+            self.stats["calls"] += 1
+            self.stats["latency_ms"] += int(latency_s * 1000)
+            if ex is None or not is_retryable(ex):
+                # The service answered (a 4xx error is about the request)
+                self.consecutive_failures = 0
+                if self.state != CIRCUIT_CLOSED:
+                    log.info("[{}] Circuit closed".format(self.name))
+                    self.state = CIRCUIT_CLOSED
+                if ex is None:
+                    self.concurrency_limit = min(self.concurrency_limit + 1 / self.concurrency_limit,
+                                                 self.concurrency_max)
+                else:
+                    self.stats["errors"] += 1
+            else:
+                self.stats["errors"] += 1
+                self.consecutive_failures += 1
+                if is_throttling(ex):
+                    self.stats["throttled"] += 1
+                    self.concurrency_limit = max(self.concurrency_limit / 2, CONCURRENCY_MIN)
+                if self.state == CIRCUIT_HALF_OPEN or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                    if self.state != CIRCUIT_OPEN:
+                        log.warning("[{}] Circuit open for {}s after {} consecutive failure(s): {}".format(
+                            self.name, CIRCUIT_OPEN_S, self.consecutive_failures, ex))
+                        self.stats["circuit_opened"] += 1
+                    self.state = CIRCUIT_OPEN
+                    self.open_until = time.monotonic() + CIRCUIT_OPEN_S
+            self._condition.notify_all()
+
+    def retry_delay_s(self, ex, attempt):
+        delay = random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** (attempt - 1)))
+        retry_after = get_retry_after_s(ex) if get_status_code(ex) == 429 else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, RETRY_AFTER_MAX_S))
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        attempt = 1
+        while True:
+            self.acquire()
+            started_at = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as ex:
+                self.release(time.monotonic() - started_at, ex)
+                if not is_retryable(ex) or attempt >= self.max_attempts:
+                    raise
+                delay = self.retry_delay_s(ex, attempt)
+                log.info("[{}] Attempt {} failed ({}), retrying in {:.1f}s".format(self.name, attempt, ex, delay))
+                self.stats["retries"] += 1
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.release(time.monotonic() - started_at)
+            return result
+
+    def is_open(self):
+        return self.state == CIRCUIT_OPEN and time.monotonic() < self.open_until
+
+
+# The methods of the client go through the guard of its service
+class GuardedClient:
+    def __init__(self, client, guard):
+        self._client = client
+        self._guard = guard
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith("set_"):
+            return attribute
+        return partial(self._guard.call, attribute)
+
+
+def get_service_guard(name):
+    with _guards_lock:
+        if name not in _guards:
+            _guards[name] = ServiceGuard(name)
+        return _guards[name]
+
+
+# Services currently rejecting calls
+def get_open_circuits():
+    return [name for name, guard in list(_guards.items()) if guard.is_open()]
+
+
+# {service: {calls, errors, retries, throttled, rejected, circuit_opened, latency_ms (total)}}
+def get_service_stats():
+    return {name: dict(guard.stats) for name, guard in list(_guards.items())}
+
+
+def reset_service_stats():
+    for guard in list(_guards.values()):
+        guard.stats.clear()
@@ -5,10 +5,14 @@ import logging
 from logdna import LogDNAHandler
 from bs4 import BeautifulSoup
 import requests
+from requests.compat import chardet
 import re
+import codecs
 from watson_developer_cloud import NaturalLanguageUnderstandingV1, AssistantV1, LanguageTranslatorV3
 from fuzzysearch import find_near_matches
 from tenacity import retry, wait_fixed, stop_after_delay
+from mana_common.matchers import SubstringMatcher, PatternMatcher, HostSuffixMatcher
+from mana_common.resilience import GuardedClient, get_service_guard
 
 
 # Module constants
@@ -27,7 +31,7 @@ is_on_cloud = os.environ.get("__OW_ACTION_NAME") is not None or \
               os.environ.get("CE_DOMAIN") is not None
 # Private module variables
 _twitter_api = None
-_logdna_handler: LogDNAHandler
+_logdna_handler: LogDNAHandler = None
 _natural_language_understanding = None
 _assistant = None
 _translator = None
@@ -36,7 +40,21 @@ _assistant_user_id = None
 
 COMPANY_LEN_LIMIT_FOR_EXACT_MATCH = 10  # company with len <= will require strict matching - switched to 10 instead of 6, to be validated
 MIN_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS = 50
-TRUNCATE_TEXT_LENGTH_FOR_HTML_AND_PDF_PARAGRAPHS = 50000
+# Texts retrieved from HTML pages & PDF files are truncated to this length (CA_MAX_TEXT_LENGTH overrides it)
+MAX_TEXT_LENGTH_FOR_HTML_AND_PDF = 200000
+# The encoding of a fetched page is looked for in its BOM, headers, then <meta charset> / XML declaration in its first
+# bytes; if none is declared and the page is not UTF-8, chardet only gets its beginning
+CHARSET_SNIFF_BYTES = 1024
+CHARSET_DETECTION_BYTES = 32 * 1024
+BYTE_ORDER_MARKS = [(codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")]
+HEADER_CHARSET_PATTERN = re.compile(r'charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+DECLARED_CHARSET_PATTERN = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)'
+                                      rb'|<\?xml[^>]*?encoding\s*=\s*["\']([\w.:-]+)', re.IGNORECASE)
+# RSS discovery only reads the <head> of a page, in chunks, and gives up on pages whose <head> is not over after
+# RSS_DISCOVERY_MAX_BYTES
+RSS_DISCOVERY_CHUNK_BYTES = 16 * 1024
+RSS_DISCOVERY_MAX_BYTES = 512 * 1024
+HEAD_END_PATTERN = re.compile(rb"</head\s*>", re.IGNORECASE)
 USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'
 
 
@@ -107,11 +125,11 @@ def get_assistant():
     global _assistant, _workspace_id_assistant, _assistant_user_id
     if _assistant is None:
         log.info("Setting up Assistant")
-        _assistant = AssistantV1(
+        _assistant = GuardedClient(AssistantV1(
             version=os.environ.get("WA_VERSION"),
             iam_apikey=os.environ.get("WA_API_KEY"),
             url=os.environ.get("WA_URL")
-        )
+        ), get_service_guard("assistant"))
         _workspace_id_assistant = os.environ.get("WA_WORKSPACE_ID")
         _assistant_user_id = os.environ.get("WA_USER_ID")
         log.info("WA URL: {}".format(os.environ.get("WA_URL")))
@@ -124,11 +142,11 @@ def get_nlu():
     global _natural_language_understanding
     if _natural_language_understanding is None:
         log.info("Setting up NLU")
-        _natural_language_understanding = NaturalLanguageUnderstandingV1(
+        _natural_language_understanding = GuardedClient(NaturalLanguageUnderstandingV1(
             version=os.environ.get("WNLU_VERSION"),
             iam_apikey=os.environ.get("WNLU_API_KEY"),
             url=os.environ.get("WNLU_URL")
-        )
+        ), get_service_guard("nlu"))
         log.info("WNLU URL: {}".format(os.environ.get("WNLU_URL")))
         log.info("WNLU API Key: {}...".format(os.environ.get("WNLU_API_KEY")[0:5]))
     return _natural_language_understanding
@@ -137,16 +155,20 @@ def get_nlu():
 def get_translator():
     global _translator
     if _translator is None:
-        _translator = LanguageTranslatorV3(
+        _translator = GuardedClient(LanguageTranslatorV3(
             version=os.environ.get("WT_VERSION"),
             iam_apikey=os.environ.get("WT_API_KEY"),
             url=os.environ.get("WT_URL")
-        )
+        ), get_service_guard("translator"))
         log.info("WT URL: {}".format(os.environ.get("WT_URL")))
         log.info("WT API Key: {}...".format(os.environ.get("WT_API_KEY")[0:5]))
     return _translator
 
 
+def get_max_text_length():
+    return int(os.getenv("CA_MAX_TEXT_LENGTH", MAX_TEXT_LENGTH_FOR_HTML_AND_PDF))
+
+
 def get_assistant_workspace():
     if _workspace_id_assistant is None:
         get_assistant()
@@ -159,9 +181,14 @@ def get_assistant_user_id():
     return _assistant_user_id
 
 
+# Matchers (see orm.get_config_matchers) or the lists of the config
+def as_matcher(values, matcher_class):
+    return values if hasattr(values, "matches") else matcher_class(values)
+
+
 def get_base_url(url, domains_where_next_element_matters):
     try:
-        if any(ext in url for ext in domains_where_next_element_matters):
+        if as_matcher(domains_where_next_element_matters, HostSuffixMatcher).matches(url):
             return "/".join(url.split("/")[0:4])
         return "/".join(url.split("/")[0:3])
     except:
@@ -170,7 +197,7 @@ def get_base_url(url, domains_where_next_element_matters):
 
 # Extract real url from tiny url
 def get_full_url(short_url, url_extensions_to_check_for_true_url):
-    if short_url is not None and any(ext in short_url for ext in url_extensions_to_check_for_true_url):
+    if short_url is not None and as_matcher(url_extensions_to_check_for_true_url, SubstringMatcher).matches(short_url):
         try: 
             print("[get_full_url] trying to get full url for  : " + short_url)
             request_session = requests.Session()
@@ -185,19 +212,79 @@ def get_full_url(short_url, url_extensions_to_check_for_true_url):
         return short_url
 
 
-def find_rss_feed(url):
+# Python codec name of a declared encoding, None if unknown
+def normalize_encoding(name):
+    try:
+        encoding = codecs.lookup(name.strip().decode("ascii") if isinstance(name, bytes) else name.strip()).name
+    except (LookupError, UnicodeDecodeError):
+        return None
+    # As browsers do: latin-1 & ascii pages are windows-1252
+    return "cp1252" if encoding in ("latin-1", "iso8859-1", "ascii") else encoding
+
+
+# Text of a response, see CHARSET_SNIFF_BYTES (requests falls back on chardet over the whole body when the headers do not
+# declare a charset, and decodes any text/* page without charset as latin-1)
+def decode_response(response):
+    return decode_content(response.content or b"", response.headers.get("content-type", ""))
+
+
+def decode_content(content, content_type):
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if content.startswith(bom):
+            return content.decode(encoding, errors="replace")
+
+    match = HEADER_CHARSET_PATTERN.search(content_type or "")
+    encoding = normalize_encoding(match.group(1)) if match is not None else None
+    if encoding is None:
+        match = DECLARED_CHARSET_PATTERN.search(content[:CHARSET_SNIFF_BYTES])
+        encoding = normalize_encoding(match.group(1) or match.group(2)) if match is not None else None
+        # A page cannot declare itself as UTF-16 in ASCII: such declarations are wrong
+        if encoding is not None and encoding.startswith("utf-16"):
+            encoding = "utf-8"
+    if encoding is not None:
+        return content.decode(encoding, errors="replace")
+
+    try:
+        return content.decode("utf-8")
+    except UnicodeDecodeError:
+        encoding = normalize_encoding(chardet.detect(content[:CHARSET_DETECTION_BYTES])["encoding"] or "cp1252")
+        return content.decode(encoding or "cp1252", errors="replace")
+
+
+# Beginning of a streamed page, up to the end of its <head> (or RSS_DISCOVERY_MAX_BYTES)
+def read_html_head(response):
+    content = b""
+    for chunk in response.iter_content(chunk_size=RSS_DISCOVERY_CHUNK_BYTES):
+        # The end tag may span two chunks
+        start = max(len(content) - len("</head>"), 0)
+        content += chunk
+        match = HEAD_END_PATTERN.search(content, start)
+        if match is not None:
+            return content[:match.end()]
+        if len(content) >= RSS_DISCOVERY_MAX_BYTES:
+            break
+    return content
+
+
+# Feed declared in the <head> of a page (the rest of the page is neither downloaded nor parsed)
+# raise_errors: a page that could not be fetched raises (to retry later) instead of returning None
+def find_rss_feed(url, raise_errors=False):
     log.info("trying to get rss feed in url {}".format(url))
     rss = None
     try:
-        response = requests.get(url, headers={'User-Agent': USER_AGENT}, timeout=TIMEOUT_REQUESTS_S)
-        soup = BeautifulSoup(response.text, "lxml")
+        with requests.get(url, headers={'User-Agent': USER_AGENT}, timeout=TIMEOUT_REQUESTS_S, stream=True) as response:
+            if raise_errors and response.status_code >= 500:
+                response.raise_for_status()
+            head = read_html_head(response)
+        soup = BeautifulSoup(decode_content(head, response.headers.get("content-type", "")), "lxml")
         link = soup.find('link', type='application/rss+xml')
         if link is not None:
             rss = link['href']
             log.info("Found {}".format(rss))
     except Exception as e:
         log.error("exception {}".format(e))
-        pass
+        if raise_errors:
+            raise
     return rss
 
 
@@ -280,8 +367,8 @@ def get_redirect_javascript(url):
             log.info("[get_redirect_javascript] Content too large for redirect analysis ({} > {}) , skipping".format(resp_size, max_content_size))
         elif resp_size == 0:
             log.info("[get_redirect_javascript] No content, skipping")
-        elif response.text is not None:
-            soup = BeautifulSoup(response.text, "html.parser")
+        else:
+            soup = BeautifulSoup(decode_response(response), "html.parser")
             if soup.find('head') is not None and soup.find('head').find('script') is not None:
                 ret_val = str(soup.find('head').find('script')).split("window.location.href")[1].replace("=", "").replace(
                     "</script>", "").replace('"', "").replace('\n', "").strip()
@@ -311,12 +398,10 @@ def remove_html_tags(text):
 
 # Some urls should not be processed, for example facebook events
 def check_if_url_match_pattern(url, patterns):
-    for p in patterns:
-        regex = re.compile(p)
-        match = regex.search(url)
-        if match is not None:
-            log.info("Url to ignore found:".format(match.group()))
-            return True
+    match = as_matcher(patterns, PatternMatcher).search(url)
+    if match is not None:
+        log.info("Url to ignore found: {}".format(match.group()))
+        return True
     return False
 
 def is_twitter_rate_limit(retry_state):
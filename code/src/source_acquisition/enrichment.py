@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+import twitter
+from sqlalchemy import or_
+
+from mana_common import orm
+from mana_common.orm import EnrichmentTask, EnrichmentKind, EnrichmentStatus, RssOrigin, TwitterProfile, \
+    get_cached_rss_feed, cache_rss_feed, load_rss_discoveries, clear_rss_discoveries
+from mana_common.shared import log, find_rss_feed, clean_rss_path, get_full_url, retryable_twitter_api
+from source_acquisition.prefetch import RateLimiter, get_twitter_calls_per_minute
+
+# ----------------------------------------------------------------------------------------
+# Deferred enrichment of new origins (SA_DEFER_ENRICHMENT, on by default): instead of
+# looking for the RSS feed of a new web site or fetching the profile of a new Twitter
+# account while tweets are processed, source acquisition queues a task in enrichment_tasks.
+# The drain step (drain_enrichment_queue, run after the acquisition) processes the due tasks
+# with a pool of threads, the results being written by the calling thread only:
+# - a task that fails (web site down, Twitter rate limit...) is retried in a later batch
+#   or run, with exponential backoff, up to ENRICHMENT_MAX_ATTEMPTS times
+# - the drain step stops after SA_ENRICHMENT_MAX_S seconds, what is left is done next run
+# A done task is queued again (same row, back to pending) when it is due again: the RSS
+# discovery of a site still without feed, once the cached discovery expired.
+# ----------------------------------------------------------------------------------------
+
+ENRICHMENT_WORKERS = 8
+ENRICHMENT_BATCH_SIZE = 100
+ENRICHMENT_MAX_S = 300
+ENRICHMENT_MAX_ATTEMPTS = 5
+ENRICHMENT_RETRY_BASE_S = 5 * 60
+ENRICHMENT_RETRY_MAX_S = 24 * 60 * 60
+# Rate limit exceeded, over capacity, internal error: other Twitter errors (unknown or suspended account...) are final
+TWITTER_RETRYABLE_ERROR_CODES = {88, 130, 131}
+
+# (kind, origin id) -> status of the tasks, loaded once per run (see load_enrichment_keys)
+_enrichment_keys = None
+# (kind, origin) of the tasks queued by this process (new origins have no id yet)
+_deferred = set()
+
+
+def is_enrichment_deferred():
+    return os.getenv("SA_DEFER_ENRICHMENT", "true").lower() not in ("false", "0", "no")
+
+
+def get_enrichment_workers():
+    return int(os.getenv("SA_ENRICHMENT_WORKERS", ENRICHMENT_WORKERS))
+
+
+def get_enrichment_max_s():
+    return float(os.getenv("SA_ENRICHMENT_MAX_S", ENRICHMENT_MAX_S))
+
+
+def load_enrichment_keys():
+    global _enrichment_keys
+    _enrichment_keys = {(kind, origin_id): status for kind, origin_id, status in orm.get_session().query(
+        EnrichmentTask.kind, EnrichmentTask.origin_id, EnrichmentTask.status).all()}
+    log.info("Loaded {} enrichment task(s)".format(len(_enrichment_keys)))
+
+
+def clear_enrichment_keys():
+    global _enrichment_keys
+    _enrichment_keys = None
+    _deferred.clear()
+
+
+def find_enrichment_task(kind, origin):
+    return orm.get_session().query(EnrichmentTask).filter(
+        EnrichmentTask.kind == kind,
+        EnrichmentTask.origin_id == origin.id
+    ).first()
+
+
+# Status of the task of an origin, None if there is none
+def get_enrichment_status(kind, origin):
+    if _enrichment_keys is not None:
+        return _enrichment_keys.get((kind, origin.id))
+    if origin.id is None:
+        return None
+    task = find_enrichment_task(kind, origin)
+    return task.status if task is not None else None
+
+
+# A done task is due again when its result may have changed since: the RSS discovery of a site (still without RSS
+# origin), once the discovery is no longer cached
+def is_enrichment_due_again(kind, origin):
+    return kind == EnrichmentKind.rss_discovery and not get_cached_rss_feed(origin.base_url)[0]
+
+
+def defer_enrichment(kind, origin):
+    if (kind, origin) in _deferred:
+        return
+    status = get_enrichment_status(kind, origin)
+    if status is None:
+        log.info("Queuing {} for origin: {}".format(
+            kind.name, origin.entity.name if origin.entity is not None else origin))
+        orm.get_session().add(EnrichmentTask(kind=kind, origin=origin, status=EnrichmentStatus.pending, attempts=0))
+    elif status == EnrichmentStatus.done and is_enrichment_due_again(kind, origin):
+        log.info("Queuing {} again for origin: {}".format(kind.name, origin.id))
+        task = find_enrichment_task(kind, origin)
+        task.status = EnrichmentStatus.pending
+        task.attempts = 0
+        task.next_attempt_at = None
+        task.last_error = None
+        if _enrichment_keys is not None:
+            _enrichment_keys[(kind, origin.id)] = EnrichmentStatus.pending
+    else:
+        # Pending, failed (given up), or done and still valid
+        return
+    _deferred.add((kind, origin))
+
+
+def new_rss_origin(web_origin, rss):
+    rss_origin = RssOrigin(rss=rss, base_url=web_origin.base_url, origin_web=web_origin)
+    rss_origin.rss = clean_rss_path(rss, web_origin.base_url)
+    rss_origin.entity = web_origin.entity
+    return rss_origin
+
+
+# Twitter profile (JSON) of a screen name, and the full URL of its web site
+def fetch_twitter_profile(screen_name, url_extensions_to_check_for_true_url):
+    user_profile = retryable_twitter_api(
+        function_name="GetUser",
+        screen_name=screen_name,
+        return_json=True
+    )
+    return user_profile, get_full_url(user_profile['url'], url_extensions_to_check_for_true_url)
+
+
+# Profile fetched by fetch_twitter_profile, or the error that prevented it
+def associate_twitter_profile(twitter_origin, user_profile=None, url=None, error=None):
+    profile = TwitterProfile()
+    if error is None:
+        profile.url = url
+        profile.description = user_profile['description']
+        twitter_origin.twitter_profile = profile
+        twitter_origin.location = user_profile['location']
+    else:
+        profile.error = error
+    orm.get_session().add(profile)
+
+
+def get_twitter_error_codes(ex):
+    errors = ex.args[0] if len(ex.args) > 0 else None
+    errors = errors if isinstance(errors, list) else [errors]
+    return {e.get("code") for e in errors if isinstance(e, dict)}
+
+
+def is_retryable_enrichment_error(ex):
+    if isinstance(ex, twitter.error.TwitterError):
+        return len(get_twitter_error_codes(ex) & TWITTER_RETRYABLE_ERROR_CODES) > 0
+    return True
+
+
+def get_retry_delay_s(attempts):
+    return min(ENRICHMENT_RETRY_BASE_S * 2 ** (attempts - 1), ENRICHMENT_RETRY_MAX_S) * random.uniform(0.5, 1)
+
+
+def get_enrichment_key(task):
+    return task.origin.base_url if task.kind == EnrichmentKind.rss_discovery else task.origin.screen_name
+
+
+# Runs in a drain thread: network part of a task
+def run_enrichment_task(kind, key, url_extensions_to_check_for_true_url, twitter_rate_limiter):
+    if kind == EnrichmentKind.rss_discovery:
+        return find_rss_feed(key, raise_errors=True)
+    twitter_rate_limiter.acquire()
+    return fetch_twitter_profile(key, url_extensions_to_check_for_true_url)
+
+
+def apply_enrichment(task, result):
+    origin = task.origin
+    if task.kind == EnrichmentKind.rss_discovery:
+        if result is not None and orm.get_session().query(RssOrigin).filter(
+                RssOrigin.base_url == origin.base_url).first() is None:
+            log.info("Adding new rss origin for: {}".format(origin.base_url))
+            rss_origin = new_rss_origin(origin, result)
+            # Mentions of the web site so far
+            rss_origin.occurrences = origin.occurrences or 0
+            orm.get_session().add(rss_origin)
+    elif origin.twitter_profile is None:
+        user_profile, url = result
+        associate_twitter_profile(origin, user_profile, url)
+    task.status = EnrichmentStatus.done
+    task.last_error = None
+
+
+def record_enrichment_failure(task, ex):
+    task.last_error = str(ex)
+    if not is_retryable_enrichment_error(ex):
+        # As when the profile was fetched inline: the error is kept in the profile
+        log.info("Error while retrieving Twitter profile: {}".format(ex))
+        associate_twitter_profile(task.origin, error=str(ex))
+        task.status = EnrichmentStatus.done
+    elif task.attempts >= ENRICHMENT_MAX_ATTEMPTS:
+        log.warning("Giving up {} of origin {} after {} attempts: {}".format(
+            task.kind.name, task.origin_id, task.attempts, ex))
+        task.status = EnrichmentStatus.failed
+    else:
+        task.next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=get_retry_delay_s(task.attempts))
+
+
+# Processes the due tasks of the queue, batch by batch, for at most max_s seconds
+def drain_enrichment_queue(max_s=None):
+    max_s = max_s if max_s is not None else get_enrichment_max_s()
+    if max_s <= 0:
+        log.info("Skipping enrichment as SA_ENRICHMENT_MAX_S is 0")
+        return
+    started_at = time.monotonic()
+    session = orm.get_session()
+    url_extensions = orm.get_config_matchers()["url_extensions_to_check_for_true_url"]
+    twitter_rate_limiter = RateLimiter(get_twitter_calls_per_minute())
+    stats = Counter()
+    load_rss_discoveries()
+    try:
+        with ThreadPoolExecutor(max_workers=get_enrichment_workers(), thread_name_prefix="sa-enrichment") as executor:
+            while time.monotonic() - started_at < max_s:
+                tasks = session.query(EnrichmentTask).filter(
+                    EnrichmentTask.status == EnrichmentStatus.pending,
+                    or_(EnrichmentTask.next_attempt_at.is_(None),
+                        EnrichmentTask.next_attempt_at <= datetime.now(timezone.utc))
+                ).order_by(EnrichmentTask.id).limit(ENRICHMENT_BATCH_SIZE).all()
+                if len(tasks) == 0:
+                    break
+                futures = {}
+                for task in tasks:
+                    key = get_enrichment_key(task)
+                    found, rss = get_cached_rss_feed(key) if task.kind == EnrichmentKind.rss_discovery \
+                        else (False, None)
+                    if found:
+                        task.attempts = (task.attempts or 0) + 1
+                        apply_enrichment(task, rss)
+                        stats["cached"] += 1
+                    else:
+                        futures[executor.submit(run_enrichment_task, task.kind, key, url_extensions,
+                                                twitter_rate_limiter)] = task
+                for future in as_completed(futures):
+                    task = futures[future]
+                    task.attempts = (task.attempts or 0) + 1
+                    try:
+                        result = future.result()
+                    except Exception as ex:
+                        record_enrichment_failure(task, ex)
+                        stats[task.status.name if task.status != EnrichmentStatus.pending else "retried"] += 1
+                        continue
+                    if task.kind == EnrichmentKind.rss_discovery:
+                        cache_rss_feed(get_enrichment_key(task), result)
+                    apply_enrichment(task, result)
+                    stats["done"] += 1
+                session.commit()
+    finally:
+        clear_rss_discoveries()
+    log.info("Enrichment in {:.0f}s: {}".format(time.monotonic() - started_at, dict(stats)))
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+from collections import Counter
 from sqlalchemy.schema import CreateSchema
+from sqlalchemy.orm.attributes import set_committed_value
 import twitter
 import os
 from mana_common.shared import log, flush_logs, set_logger, get_base_url, get_full_url, \
-    find_rss_feed, clean_rss_path, check_if_url_match_pattern, retryable_twitter_api
+    find_rss_feed, check_if_url_match_pattern, retryable_twitter_api
 from mana_common.orm import EntityStatus, Group, Entity, TwitterOrigin, WebOrigin, \
-    RssOrigin, ContentType, Content, OriginGroup, ContentOrigins, TwitterProfile, Base, \
-    get_session, get_db_engine, SCHEMA, get_config
+    RssOrigin, ContentType, Content, OriginGroup, ContentOrigins, EnrichmentTask, EnrichmentKind, RssDiscovery, Base, \
+    get_session, get_db_engine, SCHEMA, get_config_matchers, add_origin_occurrences, upgrade_origin_unique_indexes, \
+    upgrade_origin_columns, find_rss_feed_cached, get_cached_rss_feed, load_rss_discoveries, clear_rss_discoveries
 from mana_common import orm
+from source_acquisition.prefetch import Prefetcher, get_concurrency, get_twitter_calls_per_minute, TIMELINE, \
+    FULL_URL, RSS_FEED, TWITTER_PROFILE
+from source_acquisition.enrichment import is_enrichment_deferred, defer_enrichment, load_enrichment_keys, \
+    clear_enrichment_keys, drain_enrichment_queue, new_rss_origin, fetch_twitter_profile, associate_twitter_profile
 
 # ----------------------------------------------------------------------------------------
 # /!\ Important: do NOT log (=print) outside of Python functions, this will lead to action
@@ -28,6 +35,20 @@ db_connection_string = None
 
 FUZZY_MATCH_SUGGESTED_THRESHOLD = 82
 
+# Origins of the database by key, loaded once per run (see load_origin_maps) and completed as origins are created:
+# base_url -> WebOrigin, screen_name -> TwitterOrigin, base_url -> RssOrigin. When they are not loaded (e.g. API),
+# origins are looked for in the database
+_web_origins = None
+_twitter_origins = None
+_rss_origins = None
+
+# Mentions of origins found in the batch of tweets being processed (see process_tweets): (origin, content, entity of the
+# reference that mentioned it), written all at once by save_mentions(). Outside of a batch, mentions are saved right away
+_mentions = None
+
+# Network calls done ahead in concurrent mode (see prefetch.py), None otherwise
+_prefetcher = None
+
 init_data = {
     "reference_ongs":
         [
@@ -127,75 +148,126 @@ init_data = {
 # +-----------+
 
 
+def load_origin_maps():
+    global _web_origins, _twitter_origins, _rss_origins
+    _web_origins = {}
+    for origin in orm.get_session().query(WebOrigin).order_by(WebOrigin.id).all():
+        _web_origins.setdefault(origin.base_url, origin)
+    _twitter_origins = {}
+    for origin in orm.get_session().query(TwitterOrigin).order_by(TwitterOrigin.id).all():
+        _twitter_origins.setdefault(origin.screen_name, origin)
+    _rss_origins = {}
+    for origin in orm.get_session().query(RssOrigin).order_by(RssOrigin.id).all():
+        _rss_origins.setdefault(origin.base_url, origin)
+    log.info("Loaded {} web, {} Twitter and {} RSS origin(s)".format(
+        len(_web_origins), len(_twitter_origins), len(_rss_origins)))
+
+
+def clear_origin_maps():
+    global _web_origins, _twitter_origins, _rss_origins
+    _web_origins = None
+    _twitter_origins = None
+    _rss_origins = None
+
+
+# Result of function(*args), prefetched in concurrent mode
+def prefetched(kind, key, function, *args):
+    if _prefetcher is None:
+        return function(*args)
+    return _prefetcher.get(kind, key, function, *args)
+
+
+# Feed of a web site (prefetched in concurrent mode), raising when the site could not be fetched
+def fetch_rss_feed(base_url):
+    return prefetched(RSS_FEED, base_url, find_rss_feed, base_url, True)
+
+
+def find_web_origin(base_url):
+    if _web_origins is not None:
+        return _web_origins.get(base_url)
+    return orm.get_session().query(WebOrigin).filter(
+        WebOrigin.base_url == base_url
+    ).first()
+
+
+def find_twitter_origin(screen_name):
+    if _twitter_origins is not None:
+        return _twitter_origins.get(screen_name)
+    return orm.get_session().query(TwitterOrigin).filter(
+        TwitterOrigin.screen_name == screen_name
+    ).first()
+
+
+def find_rss_origin(base_url):
+    if _rss_origins is not None:
+        return _rss_origins.get(base_url)
+    return orm.get_session().query(RssOrigin).filter(
+        RssOrigin.base_url == base_url
+    ).first()
+
+
 def add_rss_origin(web_origin):
     log.info("Adding rss origin for base_url: {}".format(web_origin.base_url))
-    rss_origin = orm.get_session().query(RssOrigin).filter(
-        RssOrigin.base_url == web_origin.base_url
-    ).first()
+    rss_origin = find_rss_origin(web_origin.base_url)
 
     if rss_origin is None:
+        if is_enrichment_deferred():
+            defer_enrichment(EnrichmentKind.rss_discovery, web_origin)
+            return
         log.info("New rss origin to search for: {}".format(web_origin.base_url))
-        rss = find_rss_feed(web_origin.base_url)
+        rss = find_rss_feed_cached(web_origin.base_url, fetch_rss_feed)
         if rss is not None:
-            rss_origin = RssOrigin(rss=rss, base_url=web_origin.base_url,
-                                   origin_web=web_origin)  # TODO add web origin link
-            rss_origin.rss = clean_rss_path(rss, web_origin.base_url)
-            rss_origin.entity = web_origin.entity
-            rss_origin.occurrences = 1
+            rss_origin = new_rss_origin(web_origin, rss)
+            rss_origin.occurrences = 0
             log.info("Adding new rss origin")
             orm.get_session().add(rss_origin)
+            if _rss_origins is not None:
+                _rss_origins[rss_origin.base_url] = rss_origin
         else:
             return
     else:
         log.info("New occurrence of rss origin found for: {}".format(web_origin.base_url))
-        if rss_origin.occurrences is None:
-            rss_origin.occurrences = 1
-        else:
-            rss_origin.occurrences += 1
+
+    add_mention(rss_origin)
 
 
 # Add a web origin
-def add_web_origin(source_content, url):
+def add_web_origin(source_content, url, entity=None):
     short_url = url.url
     expanded_url = url.expanded_url
-    full_url = get_full_url(expanded_url, orm.get_config()["url_extensions_to_check_for_true_url"])
+    full_url = prefetched(FULL_URL, expanded_url, get_full_url, expanded_url,
+                          orm.get_config_matchers()["url_extensions_to_check_for_true_url"])
 
-    if check_if_url_match_pattern(full_url, orm.get_config()["url_patterns_to_ignore"]):
+    if check_if_url_match_pattern(full_url, orm.get_config_matchers()["url_patterns_to_ignore"]):
         return None
 
-    base_url = get_base_url(full_url, orm.get_config()["domains_where_next_element_matters"])
-    web_origin = orm.get_session().query(WebOrigin).filter(
-        WebOrigin.base_url == base_url
-    ).first()
+    base_url = get_base_url(full_url, orm.get_config_matchers()["domains_where_next_element_matters"])
+    web_origin = find_web_origin(base_url)
 
     if web_origin is None:
         log.info("New web origin found for: {}".format(base_url))
         web_origin = WebOrigin(raw_url=short_url, expanded_url=full_url, base_url=base_url)
         new_entity = Entity(name=base_url, is_reference=False)
         web_origin.entity = new_entity
-        web_origin.occurrences = 1
+        web_origin.occurrences = 0
         log.info("Saving new web origin")
         orm.get_session().add(web_origin)
+        if _web_origins is not None:
+            _web_origins[base_url] = web_origin
     else:
         log.info("New occurrence of web origin found for: {}".format(base_url))
-        if web_origin.occurrences is None:
-            web_origin.occurrences = 1
-        else:
-            web_origin.occurrences += 1
 
-    save_origin_content_relation(origin=web_origin, content=source_content)
+    add_mention(web_origin, content=source_content, entity=entity)
 
-    if not check_if_url_match_pattern(full_url, orm.get_config()["ignore_for_rss_search"]):
+    if not check_if_url_match_pattern(full_url, orm.get_config_matchers()["ignore_for_rss_search"]):
         add_rss_origin(web_origin)
 
     return web_origin
 
 
 # Add a Twitter origin
-def add_twitter_origin(source_content, user):
-    twitter_origin = orm.get_session().query(TwitterOrigin).filter(
-        TwitterOrigin.screen_name == user.screen_name
-    ).first()
+def add_twitter_origin(source_content, user, entity=None):
+    twitter_origin = find_twitter_origin(user.screen_name)
 
     if twitter_origin is None:
         # New twitter origin found
@@ -203,40 +275,34 @@ def add_twitter_origin(source_content, user):
         twitter_origin = TwitterOrigin(screen_name=user.screen_name)
         new_entity = Entity(name=user.screen_name, is_reference=False)
         twitter_origin.entity = new_entity
-        twitter_origin.occurrences = 1
-        retrieve_and_associate_twitter_profile(twitter_origin)
+        twitter_origin.occurrences = 0
+        if is_enrichment_deferred():
+            defer_enrichment(EnrichmentKind.twitter_profile, twitter_origin)
+        else:
+            retrieve_and_associate_twitter_profile(twitter_origin)
         orm.get_session().add(twitter_origin)
+        if _twitter_origins is not None:
+            _twitter_origins[user.screen_name] = twitter_origin
     else:
         # New occurrence of existing origin
         log.info("New occurrence of Twitter origin found for: {}".format(user.screen_name))
-        if twitter_origin.occurrences is None:
-            twitter_origin.occurrences = 1
-        else:
-            twitter_origin.occurrences += 1
 
-    save_origin_content_relation(origin=twitter_origin, content=source_content)
+    add_mention(twitter_origin, content=source_content, entity=entity)
 
     return twitter_origin
 
 
 def retrieve_and_associate_twitter_profile(twitter_origin):
     log.info("Saving tweeter profile : {}".format(twitter_origin.screen_name))
-    profile = TwitterProfile()
     try:
-        user_profile = retryable_twitter_api(
-            function_name="GetUser",
-            screen_name=twitter_origin.screen_name,
-            return_json=True
+        user_profile, url = prefetched(
+            TWITTER_PROFILE, twitter_origin.screen_name, fetch_twitter_profile, twitter_origin.screen_name,
+            get_config_matchers()["url_extensions_to_check_for_true_url"]
         )
-        profile.url = get_full_url(user_profile['url'], get_config()["url_extensions_to_check_for_true_url"])
-        profile.description = user_profile['description']
-        twitter_origin.twitter_profile = profile
-        twitter_origin.location = user_profile['location']
+        associate_twitter_profile(twitter_origin, user_profile, url)
     except twitter.error.TwitterError as twitter_ex:
         log.info("Error while retrieving Twitter profile: {}".format(twitter_ex))
-        profile.error = str(twitter_ex)
-
-    orm.get_session().add(profile)
+        associate_twitter_profile(twitter_origin, error=str(twitter_ex))
 
 
 # Save the tweet content and where it came from (origin)
@@ -247,43 +313,111 @@ def save_tweet_content(tweet_content, reference_origin):
     return content
 
 
-# Saving the relation between an origin and where it came from (content)
-def save_origin_content_relation(origin, content):
-    log.info("Saving relation between : {} and {}".format(
-        origin.entity.name if origin.entity is not None else "No entity",
-        content.value
-    ))
-    content_origin = ContentOrigins(content=content, origin=origin)
-    orm.get_session().add(content_origin)
+# A new occurrence of an origin, mentioned by a content (relation to where it came from) of a reference entity (we want
+# to know by which ONG group the origin was found, in order to compute credibility rule down the road)
+def add_mention(origin, content=None, entity=None):
+    if _mentions is not None:
+        _mentions.append((origin, content, entity))
+    else:
+        save_mentions([(origin, content, entity)])
 
 
-# We want to know by which ONG group the origin was found, in order to compute credibility rule down the road
-def save_origin_group_relation(origin, entity, content):
-    log.info("Saving relation with group : {} and entity : {} (content_id : {})".format(
-        entity.group.name,
-        entity.name,
-        content.id
-    ))
-    origin_group = OriginGroup(origin=origin, group_id=entity.group.id, entity_id=entity.id, content_id=content.id)
-    orm.get_session().add(origin_group)
+# Saves mentions with one statement by table: occurrences are incremented by the database, the relations with contents
+# and groups are inserted in bulk
+def save_mentions(mentions):
+    if len(mentions) == 0:
+        return
+    session = orm.get_session()
+    # New origins & contents get their ids
+    session.flush()
+
+    occurrences = Counter(origin for origin, content, entity in mentions)
+    add_origin_occurrences({origin.id: count for origin, count in occurrences.items()})
+    # Same value in memory, without marking the origins as modified
+    for origin, count in occurrences.items():
+        set_committed_value(origin, "occurrences", (origin.occurrences or 0) + count)
+
+    content_origins = [{"content_id": content.id, "origin_id": origin.id}
+                       for origin, content, entity in mentions if content is not None]
+    if len(content_origins) > 0:
+        session.execute(ContentOrigins.__table__.insert(), content_origins)
+    origin_groups = [{"origin_id": origin.id, "group_id": entity.group_id, "entity_id": entity.id,
+                      "content_id": content.id if content is not None else None}
+                     for origin, content, entity in mentions if entity is not None]
+    if len(origin_groups) > 0:
+        session.execute(OriginGroup.__table__.insert(), origin_groups)
+    log.info("Saved {} mention(s) of {} origin(s): {} content relation(s), {} group relation(s)".format(
+        len(mentions), len(occurrences), len(content_origins), len(origin_groups)))
 
 
 # Process a list of tweets
 def process_tweets(reference_origin, tweets):
+    global _mentions
+    _mentions = []
+    try:
+        for t in tweets:
+            if t.in_reply_to_status_id is None:
+                content = save_tweet_content(tweet_content=t.full_text, reference_origin=reference_origin)
+
+                for url in t.urls:
+                    # Web site referenced
+                    add_web_origin(content, url, reference_origin.entity)
+
+                for user in t.user_mentions:
+                    add_twitter_origin(content, user, reference_origin.entity)
+        mentions = _mentions
+    finally:
+        _mentions = None
+    save_mentions(mentions)
+
+
+def fetch_timeline(screen_name, since_id, count):
+    return retryable_twitter_api(
+        function_name="GetUserTimeline",
+        screen_name=screen_name,
+        since_id=since_id,
+        count=count
+    )
+
+
+# Runs in a prefetch thread: URL expansion and RSS discovery of a mentioned URL (see add_web_origin & add_rss_origin)
+def prefetch_url(expanded_url, matchers):
+    full_url = get_full_url(expanded_url, matchers["url_extensions_to_check_for_true_url"])
+    if not is_enrichment_deferred() \
+            and not check_if_url_match_pattern(full_url, matchers["url_patterns_to_ignore"]) \
+            and not check_if_url_match_pattern(full_url, matchers["ignore_for_rss_search"]):
+        base_url = get_base_url(full_url, matchers["domains_where_next_element_matters"])
+        # Discoveries are loaded in memory during the run: no database access here
+        if base_url not in _rss_origins and not get_cached_rss_feed(base_url)[0]:
+            _prefetcher.submit(RSS_FEED, base_url, find_rss_feed, base_url, True)
+    return full_url
+
+
+# Runs in a prefetch thread: timeline of a reference, and what its tweets mention
+def prefetch_timeline(screen_name, since_id, count, matchers):
+    tweets = fetch_timeline(screen_name, since_id, count)
     for t in tweets:
         if t.in_reply_to_status_id is None:
-            content = save_tweet_content(tweet_content=t.full_text, reference_origin=reference_origin)
-
             for url in t.urls:
-                # Web site referenced
-                origin = add_web_origin(content, url)
-                if origin is not None:
-                    save_origin_group_relation(origin, reference_origin.entity, content)
-
+                _prefetcher.submit(FULL_URL, url.expanded_url, prefetch_url, url.expanded_url, matchers)
             for user in t.user_mentions:
-                origin = add_twitter_origin(content, user)
-                if origin is not None:
-                    save_origin_group_relation(origin, reference_origin.entity, content)
+                if user.screen_name not in _twitter_origins and not is_enrichment_deferred():
+                    _prefetcher.submit(TWITTER_PROFILE, user.screen_name, fetch_twitter_profile, user.screen_name,
+                                       matchers["url_extensions_to_check_for_true_url"], twitter_call=True)
+    return tweets
+
+
+# Concurrent mode: timelines (and then their mentions) are fetched ahead, in the order references are processed.
+# Called for the next references (a window as wide as the pool) before each one is processed.
+def prefetch_references(reference_entities):
+    # Read here: prefetch threads do not use the database
+    matchers = orm.get_config_matchers()
+    count = orm.get_config()["max_tweets"]
+    for reference in reference_entities:
+        for twitter_origin in reference.origins:
+            if twitter_origin.type == 'twitter_origin':
+                _prefetcher.submit(TIMELINE, twitter_origin.screen_name, prefetch_timeline, twitter_origin.screen_name,
+                                   twitter_origin.last_synced_id, count, matchers, twitter_call=True)
 
 
 # Process a single reference entity (only tweets)
@@ -300,12 +434,8 @@ def process_twitter_reference(twitter_origin):
 
     try:
         # get last tweets
-        tweets = retryable_twitter_api(
-            function_name="GetUserTimeline",
-            screen_name=twitter_origin.screen_name,
-            since_id=twitter_origin.last_synced_id,
-            count=orm.get_config()["max_tweets"]
-        )
+        tweets = prefetched(TIMELINE, twitter_origin.screen_name, fetch_timeline, twitter_origin.screen_name,
+                            twitter_origin.last_synced_id, orm.get_config()["max_tweets"])
     except twitter.error.TwitterError as twitter_ex:
         log.error("Error while retrieving the latest tweets from the Twitter account: {}".format(twitter_ex))
         # indicate that the account triggered an error - to be dealt with manually in the database
@@ -326,8 +456,9 @@ def process_twitter_reference(twitter_origin):
         orm.get_session().commit()
 
 
-# Process a list of reference entities
+# Process a list of reference entities, serially or, with SA_CONCURRENCY > 1, prefetching their network calls
 def process_references():
+    global _prefetcher
     processed_references = []
 
     query = orm.get_session().query(Entity).filter(Entity.is_reference)
@@ -336,13 +467,32 @@ def process_references():
     log.info("Contributors will be searched from {} entity(ies)".format(length))
     count = 1
 
+    # Origins are looked up in memory; they must not be expired (and reloaded one by one) at each commit
+    expire_on_commit = orm.get_session().expire_on_commit
+    orm.get_session().expire_on_commit = False
+    load_origin_maps()
+    load_enrichment_keys()
+    load_rss_discoveries()
+    concurrency = get_concurrency()
+    if concurrency > 1:
+        log.info("Concurrent acquisition with {} threads".format(concurrency))
+        _prefetcher = Prefetcher(concurrency, get_twitter_calls_per_minute())
     try:
-        for r in reference_entities:
+        for i, r in enumerate(reference_entities):
+            if _prefetcher is not None:
+                prefetch_references(reference_entities[i:i + concurrency])
             processed_references.append(process_reference(r))
             log.info("Processed {} / {}".format(count, length))
             count += 1
     finally:
+        if _prefetcher is not None:
+            _prefetcher.shutdown()
+            _prefetcher = None
         orm.get_session().commit()
+        orm.get_session().expire_on_commit = expire_on_commit
+        clear_origin_maps()
+        clear_enrichment_keys()
+        clear_rss_discoveries()
 
 
 def init_entity(e, status, group):
@@ -361,7 +511,7 @@ def init_entity(e, status, group):
         retrieve_and_associate_twitter_profile(twitter_origin)
     if 'web' in e:
         web_origin = WebOrigin(raw_url=e['web'], expanded_url=e['web'], base_url=e['web'], entity=entity)
-        rss = find_rss_feed(web_origin.base_url)
+        rss = find_rss_feed_cached(web_origin.base_url)
         if rss is not None:
             rss_origin = RssOrigin(rss=rss, base_url=web_origin.base_url, origin_web=web_origin)
             rss_origin.entity = web_origin.entity
@@ -396,6 +546,10 @@ def main():
         set_logger("sa")
         log.info("==Source Acquisition==")
         kickstart_db_if_needed()
+        upgrade_origin_unique_indexes()
+        upgrade_origin_columns()
+        EnrichmentTask.__table__.create(bind=get_db_engine(), checkfirst=True)
+        RssDiscovery.__table__.create(bind=get_db_engine(), checkfirst=True)
 
         if os.getenv("SKIP_SI"):
             log.info("Skipping step as SKIP_SI is set")
@@ -405,6 +559,7 @@ def main():
             return
 
         process_references()
+        drain_enrichment_queue()
         log.info("Normal end of processing - completed")
     finally:
         # Flush logs to make sure we've got them all before leaving
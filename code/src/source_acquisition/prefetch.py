@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from mana_common.shared import log
+
+# ----------------------------------------------------------------------------------------
+# Concurrent source acquisition (SA_CONCURRENCY > 1, see process_references):
+# - the timelines of the references are fetched by a pool of threads, a few references
+#   ahead of the one processed, every call to the Twitter API going through a rate limiter
+#   shared by the pools (SA_TWITTER_CALLS_PER_MINUTE)
+# - the network enrichment of what the tweets mention (URL expansion, and RSS discovery &
+#   Twitter profile when they are not deferred, see enrichment.py) is done ahead by a second
+#   pool, once per URL or screen name: it is not queued behind the next (rate limited)
+#   timelines while the main thread waits for it
+# - the database is only read and written by the main thread (the ORM session is not
+#   thread safe): it processes the references in order, waiting for the prefetched results
+#   it needs, while the pools work on the next references
+# ----------------------------------------------------------------------------------------
+
+SA_CONCURRENCY = 1
+# Twitter API v1.1: 900 calls per 15 minutes for user timelines and profiles
+TWITTER_CALLS_PER_MINUTE = 60
+
+TIMELINE = "timeline"
+FULL_URL = "full_url"
+RSS_FEED = "rss_feed"
+TWITTER_PROFILE = "twitter_profile"
+
+
+def get_concurrency():
+    return int(os.getenv("SA_CONCURRENCY", SA_CONCURRENCY))
+
+
+def get_twitter_calls_per_minute():
+    return float(os.getenv("SA_TWITTER_CALLS_PER_MINUTE", TWITTER_CALLS_PER_MINUTE))
+
+
+# Spaces the calls evenly, whatever the thread making them
+class RateLimiter:
+    def __init__(self, calls_per_minute):
+        self.interval_s = 60 / calls_per_minute if calls_per_minute > 0 else 0
+        self.next_call_at = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_s = max(self.next_call_at - now, 0)
+            self.next_call_at = max(self.next_call_at, now) + self.interval_s
+        if wait_s > 0:
+            time.sleep(wait_s)
+
+
+# Results of network calls computed ahead by pools of threads, by (kind, key): each one is computed once
+class Prefetcher:
+    def __init__(self, workers, twitter_calls_per_minute):
+        self.timeline_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sa-prefetch-timeline")
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sa-prefetch")
+        self.twitter_rate_limiter = RateLimiter(twitter_calls_per_minute)
+        self.futures = {}
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, key, function, *args, twitter_call=False):
+        with self._lock:
+            if (kind, key) not in self.futures:
+                executor = self.timeline_executor if kind == TIMELINE else self.executor
+                self.futures[(kind, key)] = executor.submit(self.run, function, args, twitter_call)
+                self.stats[kind] += 1
+            return self.futures[(kind, key)]
+
+    def run(self, function, args, twitter_call):
+        if twitter_call:
+            self.twitter_rate_limiter.acquire()
+        return function(*args)
+
+    # Prefetched result (or exception), function(*args) computed now if it was not submitted
+    def get(self, kind, key, function, *args):
+        with self._lock:
+            future = self.futures.get((kind, key))
+        if future is None:
+            return function(*args)
+        return future.result()
+
+    # Timelines first: a running one submits what its tweets mention
+    def shutdown(self):
+        self.timeline_executor.shutdown(wait=True, cancel_futures=True)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        log.info("Prefetched: {}".format(dict(self.stats)))
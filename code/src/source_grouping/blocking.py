@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+# ----------------------------------------------------------------------------------------
+# Blocking index of the entities to group: an auto match (see main.is_auto_match) can only
+# happen between two entities sharing a blocking key of compatible kinds:
+# - Twitter origins with the same (lowercased) screen name
+# - web origins with the same lowercased netloc & path
+# - a Twitter profile URL with the same lowercased netloc & path as a web origin
+# Candidates found in the index are still checked with is_auto_match, the index only spares
+# comparing the entities that cannot match.
+# ----------------------------------------------------------------------------------------
+
+SCREEN_NAME = "screen_name"
+WEB_URL = "web_url"
+PROFILE_URL = "profile_url"
+
+# Kinds of keys that can match each kind of key
+JOINED_KINDS = {
+    SCREEN_NAME: (SCREEN_NAME,),
+    WEB_URL: (WEB_URL, PROFILE_URL),
+    PROFILE_URL: (WEB_URL,)
+}
+
+
+# Same as is_auto_match_urls: two URLs match if and only if they have the same key
+def get_url_key(url):
+    if url is None:
+        return None
+    try:
+        split_url = urlsplit(url)
+    except ValueError:
+        return None
+    return split_url.netloc.lower(), split_url.path.lower()
+
+
+def get_blocking_keys(entity):
+    keys = set()
+    for o in entity["origins"]:
+        if o["type"] == "twitter_origin":
+            keys.add((SCREEN_NAME, o["screen_name"].lower() if o["screen_name"] is not None else None))
+            url_key = get_url_key(o["twitter_profile_url"])
+            if url_key is not None:
+                keys.add((PROFILE_URL, url_key))
+        elif o["type"] == "web_origin":
+            url_key = get_url_key(o["expanded_url"])
+            if url_key is not None:
+                keys.add((WEB_URL, url_key))
+    return keys
+
+
+class BlockingIndex:
+    def __init__(self, entities):
+        # (kind, key) -> ids of the entities
+        self.blocks = defaultdict(set)
+        # id -> keys of the entity
+        self.keys = {}
+        # id -> position of the entity in the indexed list
+        self.positions = {}
+        for entity in entities:
+            self.add(entity)
+
+    def add(self, entity):
+        keys = get_blocking_keys(entity)
+        self.keys[entity["id"]] = keys
+        self.positions.setdefault(entity["id"], len(self.positions))
+        for key in keys:
+            self.blocks[key].add(entity["id"])
+
+    # Ids of the entities that may auto match the entity (itself excluded)
+    def candidates(self, entity):
+        keys = self.keys[entity["id"]] if entity["id"] in self.keys else get_blocking_keys(entity)
+        ids = set()
+        for kind, key in keys:
+            for joined_kind in JOINED_KINDS[kind]:
+                ids.update(self.blocks.get((joined_kind, key), ()))
+        ids.discard(entity["id"])
+        return ids
+
+    # Entities of the given ids found in entities, in their order: entities must be the part of the indexed list
+    # starting at offset, entities removed from its end only (as entities_to_match, see main)
+    def select(self, ids, entities, offset=0):
+        selected = []
+        for position in sorted(self.positions[i] - offset for i in ids if i in self.positions):
+            if 0 <= position < len(entities) and entities[position]["id"] in ids:
+                selected.append(entities[position])
+        return selected
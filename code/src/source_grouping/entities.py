@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from sqlalchemy import or_
+
+from mana_common.orm import Entity, Origin, TwitterOrigin, WebOrigin, TwitterProfile, get_session
+
+# ----------------------------------------------------------------------------------------
+# Entities to group, loaded with two queries (entities, then all their origins with the
+# columns of the Twitter / web subtables and of the Twitter profiles) instead of loading
+# the origins & profile of each entity. Only what grouping needs is kept, in arrays:
+# - one row per entity (id, reference, match done), its origins being the range
+#   origin_starts[row]:origin_starts[row + 1] of the origin columns
+# - the dict of an entity (as used by is_auto_match & co) is made when it is compared,
+#   and kept while it is in a list (match_entity marks the auto matched entities)
+# ----------------------------------------------------------------------------------------
+
+
+ENTITY_IDS_CHUNK_SIZE = 1000
+
+
+# match_done: only the entities already matched (True) or to match (False), ids: only these entities
+def filter_entities(query, match_done=None, ids=None):
+    if match_done is not None:
+        query = query.filter(Entity.match_done == True if match_done else or_(Entity.match_done == False,
+                                                                            Entity.match_done == None))
+    if ids is not None:
+        query = query.filter(Entity.id.in_(ids))
+    return query
+
+
+# Rows of the queries, by chunks of ids (sorted, so that rows stay sorted by entity id)
+def query_by_chunks(make_query, ids=None):
+    if ids is None:
+        return make_query(None).all()
+    ids = sorted(ids)
+    rows = []
+    for i in range(0, len(ids), ENTITY_IDS_CHUNK_SIZE):
+        rows.extend(make_query(ids[i:i + ENTITY_IDS_CHUNK_SIZE]).all())
+    return rows
+
+
+def load_entity_rows(match_done=None, ids=None):
+    return query_by_chunks(lambda chunk_ids: filter_entities(
+        get_session().query(Entity.id, Entity.name, Entity.is_reference, Entity.match_done),
+        match_done, chunk_ids
+    ).order_by(Entity.id), ids)
+
+
+def load_origin_rows(match_done=None, ids=None):
+    twitter_origins = TwitterOrigin.__table__
+    web_origins = WebOrigin.__table__
+    twitter_profiles = TwitterProfile.__table__
+    return query_by_chunks(lambda chunk_ids: filter_entities(
+        get_session().query(Origin.entity_id, Origin.type, twitter_origins.c.screen_name, twitter_profiles.c.url,
+                            web_origins.c.expanded_url, web_origins.c.base_url)
+        .join(Entity, Entity.id == Origin.entity_id)
+        .outerjoin(twitter_origins, twitter_origins.c.id == Origin.id)
+        .outerjoin(twitter_profiles, twitter_profiles.c.id == twitter_origins.c.twitter_profile_id)
+        .outerjoin(web_origins, web_origins.c.id == Origin.id),
+        match_done, chunk_ids
+    ).order_by(Origin.entity_id, Origin.id), ids)
+
+
+class EntityTable:
+    def __init__(self, entity_rows, origin_rows):
+        self.ids = np.array([row[0] for row in entity_rows], dtype=np.int64)
+        self.names = [row[1] for row in entity_rows]
+        self.is_reference = np.array([bool(row[2]) for row in entity_rows], dtype=bool)
+        self.match_done = np.array([bool(row[3]) for row in entity_rows], dtype=bool)
+
+        rows = {entity_id: row for row, entity_id in enumerate(self.ids.tolist())}
+        # Origins of unknown entities (deleted since) are left out
+        origin_rows = [o for o in origin_rows if o[0] in rows]
+        self.origin_types = sorted({o[1] for o in origin_rows})
+        type_codes = {origin_type: code for code, origin_type in enumerate(self.origin_types)}
+        self.origin_type_codes = np.array([type_codes[o[1]] for o in origin_rows], dtype=np.int8)
+        self.screen_names = [o[2] for o in origin_rows]
+        self.twitter_profile_urls = [o[3] for o in origin_rows]
+        self.expanded_urls = [o[4] for o in origin_rows]
+        self.base_urls = [o[5] for o in origin_rows]
+        # Origins are sorted by entity id, as entities
+        origin_entity_rows = np.array([rows[o[0]] for o in origin_rows], dtype=np.int64)
+        self.origin_starts = np.searchsorted(origin_entity_rows, np.arange(len(self.ids) + 1))
+
+        # row -> dict of the entity
+        self._entities = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def make_entity(self, row):
+        origins = []
+        for i in range(self.origin_starts[row], self.origin_starts[row + 1]):
+            origin = {"type": self.origin_types[self.origin_type_codes[i]]}
+            if origin["type"] == "twitter_origin":
+                origin["screen_name"] = self.screen_names[i]
+                origin["twitter_profile_url"] = self.twitter_profile_urls[i]
+            elif origin["type"] == "web_origin":
+                origin["expanded_url"] = self.expanded_urls[i]
+                origin["base_url"] = self.base_urls[i]
+            origins.append(origin)
+        return {"id": int(self.ids[row]), "name": self.names[row], "is_reference": bool(self.is_reference[row]),
+                "origins": origins}
+
+    def entity(self, row):
+        if row not in self._entities:
+            self._entities[row] = self.make_entity(row)
+        return self._entities[row]
+
+    def release(self, row):
+        return self._entities.pop(row, None) or self.make_entity(row)
+
+
+# Entities of some rows of a table, as a list (entities are only removed from the end)
+class EntityList:
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.length = len(self.rows)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("entity list index out of range")
+        return self.table.entity(int(self.rows[i]))
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.table.entity(int(self.rows[i]))
+
+    def pop(self):
+        if self.length == 0:
+            raise IndexError("pop from empty entity list")
+        self.length -= 1
+        return self.table.release(int(self.rows[self.length]))
+
+    # Dicts of the entities, not kept (e.g. to build indexes)
+    def iter_uncached(self):
+        for i in range(self.length):
+            yield self.table.make_entity(int(self.rows[i]))
+
+
+def load_entity_table(match_done=None, ids=None):
+    return EntityTable(load_entity_rows(match_done, ids), load_origin_rows(match_done, ids))
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import os
+from itertools import combinations
+from collections import defaultdict, Counter
+from urllib.parse import urlsplit
+
+import numpy as np
+from fuzzywuzzy import utils
+from rapidfuzz import process, fuzz
+
+# ----------------------------------------------------------------------------------------
+# Candidates for suggested matches (see main.is_suggested_match), found without comparing
+# every pair of entities, all of them:
+# - the values compared by is_suggested_match (screen names, netlocs of web origins and
+#   Twitter profile URLs) are processed as fuzz.token_set_ratio does and deduplicated
+# - token_set_ratio is the best ratio of the common tokens (t0) and of each value with its
+#   tokens reordered (t0 + the other tokens: t1, t2)
+# - t0 ~ t1 (or t2) only depends on lengths: when the common tokens are most of a value
+#   ("www gabo org uk" ~ "www sicegaso org uk"), values are paired by their token subsets
+# - t1 ~ t2: the bigrams of a value padded with spaces do not depend on the order of its
+#   tokens, and two values whose ratio reaches the cutoff share at least
+#   3 * LCS + 1 - (length 1 + length 2) of them (an edit breaks at most one common bigram
+#   on each side). So a value shares one of its rarest bigrams (prefix filtering) with
+#   every value it may match: only these values, of compatible lengths and sharing enough
+#   bigrams, are scored (rapidfuzz)
+# - values with too many tokens are scored against all the values (rapidfuzz cdist, on all
+#   cores)
+# - scores use a cutoff a bit lower than the threshold: is_suggested_match still decides
+# ----------------------------------------------------------------------------------------
+
+# Token subsets are not looked at for values with more tokens (scored against all the values)
+MAX_SUBSET_TOKENS = 8
+# fuzzywuzzy rounds the scores it compares to the threshold (81.5 is a match for 82)
+SCORE_CUTOFF_MARGIN = 1
+
+SCREEN_NAME = "screen_name"
+NETLOC = "netloc"
+WEB = "web"
+PROFILE = "profile"
+
+
+def is_fuzzy_index_enabled():
+    return os.getenv("SG_FUZZY_INDEX", "true").lower() not in ("false", "0", "no")
+
+
+def get_fuzzy_workers():
+    return int(os.getenv("SG_FUZZY_WORKERS", "-1"))
+
+
+def get_score_cutoff(threshold):
+    return threshold - SCORE_CUTOFF_MARGIN
+
+
+# As fuzz.token_set_ratio processes a string, with sorted distinct tokens
+def prepare_value(value):
+    processed = utils.full_process(value, force_ascii=True)
+    return " ".join(sorted(set(processed.split())))
+
+
+def get_netloc(url):
+    try:
+        return urlsplit(url).netloc.lower()
+    except ValueError:
+        return None
+
+
+# (field, kind, value) compared by is_suggested_match
+def get_fuzzy_values(entity):
+    values = []
+    for o in entity["origins"]:
+        if o["type"] == "twitter_origin":
+            if o["screen_name"] is not None:
+                values.append((SCREEN_NAME, None, o["screen_name"].lower()))
+            if o["twitter_profile_url"] is not None:
+                values.append((NETLOC, PROFILE, get_netloc(o["twitter_profile_url"])))
+        elif o["type"] == "web_origin" and o["base_url"] is not None:
+            values.append((NETLOC, WEB, get_netloc(o["base_url"])))
+    return [(field, kind, prepare_value(value)) for field, kind, value in values if value is not None]
+
+
+def get_token_subsets(value):
+    tokens = value.split()
+    if len(tokens) > MAX_SUBSET_TOKENS:
+        return []
+    # Tokens are sorted: so are the subsets, as fuzz.token_set_ratio joins the common tokens
+    return [" ".join(subset) for size in range(1, len(tokens) + 1) for subset in combinations(tokens, size)]
+
+
+# Subsets of tokens of a value whose ratio to it reaches the cutoff
+def get_covering_subsets(value, score_cutoff, subsets=None):
+    subsets = subsets if subsets is not None else get_token_subsets(value)
+    return [subset for subset in subsets if fuzz.ratio(subset, value, score_cutoff=score_cutoff) > 0]
+
+
+# Pairs (i, j), i < j, of values whose common tokens alone give a score reaching the cutoff
+def find_values_with_common_tokens(values, score_cutoff):
+    # subset of tokens -> values for which it reaches the cutoff
+    covering = defaultdict(list)
+    subsets = []
+    for i, value in enumerate(values):
+        subsets.append(get_token_subsets(value))
+        for subset in get_covering_subsets(value, score_cutoff, subsets[i]):
+            covering[subset].append(i)
+    pairs = set()
+    # The values containing such a subset
+    containing = defaultdict(list)
+    for j, value_subsets in enumerate(subsets):
+        for subset in value_subsets:
+            if subset in covering:
+                containing[subset].append(j)
+    for subset, ids in containing.items():
+        for i in covering[subset]:
+            pairs.update((min(i, j), max(i, j)) for j in ids if j != i)
+    return pairs
+
+
+def score_values(values, queries, choices, score_cutoff, workers):
+    scores = process.cdist([values[i] for i in queries], [values[j] for j in choices], scorer=fuzz.token_set_ratio,
+                           score_cutoff=score_cutoff, workers=workers)
+    rows, columns = np.nonzero(scores)
+    return zip(np.asarray(queries)[rows].tolist(), np.asarray(choices)[columns].tolist())
+
+
+# Bigrams of a value padded with spaces, numbered to be distinct ("ab1", "ab2" for a second "ab")
+def get_bigram_elements(value):
+    padded = " " + value + " "
+    counts = Counter()
+    elements = []
+    for i in range(len(padded) - 1):
+        gram = padded[i:i + 2]
+        counts[gram] += 1
+        elements.append(gram + str(counts[gram]))
+    return elements
+
+
+# Common bigram elements needed for a ratio reaching the cutoff: 3 * LCS + 1 - (length 1 + length 2)
+def get_min_pair_overlap(lengths, score_cutoff):
+    similarity = score_cutoff / 100
+    return np.ceil((1.5 * similarity - 1) * lengths + 1 - 1e-9)
+
+
+# Bigram elements shared with any value whose ratio to this one (of this length) may reach the cutoff
+def get_min_overlap(length, score_cutoff):
+    return int(get_min_pair_overlap(length * (1 + get_min_length_ratio(score_cutoff)), score_cutoff))
+
+
+# Shortest length of a value over the length of another one for a ratio reaching the cutoff
+def get_min_length_ratio(score_cutoff):
+    similarity = score_cutoff / 100
+    return similarity / (2 - similarity)
+
+
+# Pairs (i, j), i < j, of values whose t1 ~ t2 score (see token_set_ratio) may reach the cutoff, all of them (queries:
+# only the pairs with one of these values)
+def find_similar_values(values, score_cutoff, queries=None):
+    elements = [get_bigram_elements(value) for value in values]
+    frequencies = Counter(e for value_elements in elements for e in value_elements)
+    # Elements of every value (CSR: elements of value i in element_ids[element_starts[i]:element_starts[i + 1]])
+    codes = {e: code for code, e in enumerate(frequencies)}
+    element_ids = np.array([codes[e] for value_elements in elements for e in value_elements], dtype=np.int64)
+    element_starts = np.zeros(len(values) + 1, dtype=np.int64)
+    element_starts[1:] = np.cumsum([len(value_elements) for value_elements in elements])
+    # element -> values having it in their prefix (rarest elements)
+    postings = defaultdict(list)
+    for i, value_elements in enumerate(elements):
+        prefix_length = len(value_elements) - get_min_overlap(len(values[i]), score_cutoff) + 1
+        for e in sorted(value_elements, key=lambda e: (frequencies[e], e))[:prefix_length]:
+            postings[e].append(i)
+    value_postings = defaultdict(list)
+    for ids in postings.values():
+        if len(ids) > 1:
+            ids = np.array(ids)
+            for i in ids.tolist():
+                value_postings[i].append(ids)
+
+    pairs = set()
+    lengths = np.array([len(value) for value in values])
+    min_length_ratio = get_min_length_ratio(score_cutoff)
+    in_value = np.zeros(len(codes), dtype=np.int64)
+    for i, value_ids in value_postings.items():
+        if queries is not None and i not in queries:
+            continue
+        candidates = np.unique(np.concatenate(value_ids))
+        candidates = candidates[(candidates > i if queries is None else candidates != i) &
+                                (lengths[candidates] >= min_length_ratio * lengths[i]) &
+                                (lengths[i] >= min_length_ratio * lengths[candidates])]
+        if len(candidates) == 0:
+            continue
+        # Common elements of the candidates with the value
+        counts = element_starts[candidates + 1] - element_starts[candidates]
+        ends = np.cumsum(counts)
+        positions = np.repeat(element_starts[candidates] - ends + counts, counts) + np.arange(ends[-1])
+        value_element_ids = element_ids[element_starts[i]:element_starts[i + 1]]
+        in_value[value_element_ids] = 1
+        overlaps = np.add.reduceat(in_value[element_ids[positions]], ends - counts)
+        in_value[value_element_ids] = 0
+        candidates = candidates[overlaps >= get_min_pair_overlap(lengths[i] + lengths[candidates], score_cutoff)]
+        pairs.update((min(i, j), max(i, j)) for j in candidates.tolist()
+                     if fuzz.token_set_ratio(values[i], values[j], score_cutoff=score_cutoff) > 0)
+    return pairs
+
+
+def is_long_value(value):
+    return len(value.split()) > MAX_SUBSET_TOKENS
+
+
+# Pairs (i, j), i < j, of values with too many tokens for their subsets (see get_token_subsets) with any value whose
+# score reaches the cutoff
+def find_similar_values_of_long_values(values, score_cutoff, workers):
+    pairs = set()
+    long_values = [i for i, value in enumerate(values) if is_long_value(value)]
+    if len(long_values) > 0:
+        pairs.update((min(i, j), max(i, j)) for i, j in score_values(values, long_values, range(len(values)),
+                                                                     score_cutoff, workers) if j != i)
+    return pairs
+
+
+class FuzzyIndex:
+    def __init__(self, entities, threshold):
+        # id -> ids of the entities that may be a suggested match
+        self.candidates = defaultdict(set)
+        workers = get_fuzzy_workers()
+        score_cutoff = get_score_cutoff(threshold)
+        # field -> value -> [(entity id, kind)]
+        field_refs = {SCREEN_NAME: defaultdict(list), NETLOC: defaultdict(list)}
+        for entity in entities:
+            for field, kind, value in get_fuzzy_values(entity):
+                if value != "":
+                    field_refs[field][value].append((entity["id"], kind))
+        for refs in field_refs.values():
+            values = list(refs)
+            # A value is also similar to itself (entities sharing it)
+            pairs = list(find_similar_values(values, score_cutoff) |
+                         find_values_with_common_tokens(values, score_cutoff) |
+                         find_similar_values_of_long_values(values, score_cutoff, workers))
+            for i, j in pairs + [(i, i) for i in range(len(values))]:
+                for id1, kind1 in refs[values[i]]:
+                    for id2, kind2 in refs[values[j]]:
+                        # Twitter profile URLs are only compared to web origins
+                        if id1 != id2 and not (kind1 == PROFILE and kind2 == PROFILE):
+                            self.candidates[id1].add(id2)
+                            self.candidates[id2].add(id1)
+
+    def get_candidates(self, entity):
+        return self.candidates.get(entity["id"], set())
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from sqlalchemy import and_, or_, func, exists, distinct
+from sqlalchemy.orm import aliased
+
+from mana_common.orm import GroupingKey, Entity, Origin, TwitterOrigin, TwitterProfile, get_session
+from mana_common.shared import log
+from source_grouping.blocking import get_blocking_keys, JOINED_KINDS
+from source_grouping.entities import load_entity_table
+from source_grouping.fuzzy import get_fuzzy_values, get_bigram_elements, get_token_subsets, get_covering_subsets, \
+    get_min_overlap, get_score_cutoff, get_fuzzy_workers, is_long_value, find_similar_values, \
+    find_similar_values_of_long_values
+
+# ----------------------------------------------------------------------------------------
+# Incremental source grouping: the keys of the entities already matched are kept in
+# grouping_keys, so that a run only loads the new entities and the matched entities they
+# may match (then compared as in a full run, see main.get_incremental_entities):
+# - blocking keys (see blocking.py), looked up as they are
+# - fuzzy values (see fuzzy.py) with their bigrams, tokens and covering token subsets: the
+#   matched values having one of the rarest bigrams of a new value (all of the values it
+#   may match have one) are compared to it as by the fuzzy index, the values with the
+#   common tokens that reach the cutoff are taken, values with too many tokens for their
+#   subsets are always compared
+# - a marker row per entity: keys are computed again (refresh_grouping_keys) for the
+#   matched entities without it, or whose origins (keys_changed_at: new occurrences of an
+#   origin do not count) or Twitter profiles changed since (merge_entities removes the
+#   keys of the entity it keeps)
+# ----------------------------------------------------------------------------------------
+
+MARKER = "entity"
+VALUE = "value_"
+BIGRAM = "bigram_"
+TOKEN = "token_"
+COVERING = "covering_"
+LONG = "long_"
+
+KEYS_CHUNK_SIZE = 1000
+INSERT_CHUNK_SIZE = 10000
+REFRESH_CHUNK_SIZE = 1000
+
+
+# Screen name (None for a Twitter origin without one) or (netloc, path): a netloc has no "/"
+def encode_blocking_key(key):
+    if key is None:
+        return ""
+    if isinstance(key, tuple):
+        return "".join(key)
+    return key
+
+
+# (kind, key, value) stored for an entity
+def get_grouping_keys(entity, score_cutoff):
+    keys = {(MARKER, "", None)}
+    keys.update((kind, encode_blocking_key(key), None) for kind, key in get_blocking_keys(entity))
+    for field, kind, value in get_fuzzy_values(entity):
+        if value == "":
+            continue
+        keys.add((VALUE + field, value, None))
+        keys.update((BIGRAM + field, e, value) for e in get_bigram_elements(value))
+        keys.update((TOKEN + field, token, value) for token in value.split())
+        keys.update((COVERING + field, subset, value) for subset in get_covering_subsets(value, score_cutoff))
+        if is_long_value(value):
+            keys.add((LONG + field, value, None))
+    return keys
+
+
+def chunks(keys):
+    keys = sorted(keys)
+    return [keys[i:i + KEYS_CHUNK_SIZE] for i in range(0, len(keys), KEYS_CHUNK_SIZE)]
+
+
+# Matched entities without keys, or with origins or a Twitter profile more recent than them
+def select_stale_entity_ids():
+    marker = aliased(GroupingKey)
+    origins = Origin.__table__
+    twitter_origins = TwitterOrigin.__table__
+    twitter_profiles = TwitterProfile.__table__
+    changed_origins = exists().select_from(
+        origins.outerjoin(twitter_origins, twitter_origins.c.id == origins.c.id)
+        .outerjoin(twitter_profiles, twitter_profiles.c.id == twitter_origins.c.twitter_profile_id)
+    ).where(and_(
+        origins.c.entity_id == Entity.id,
+        or_(func.coalesce(origins.c.keys_changed_at, origins.c.time_created) > marker.time_created,
+            func.coalesce(twitter_profiles.c.time_updated, twitter_profiles.c.time_created) > marker.time_created)
+    ))
+    return [row[0] for row in get_session().query(Entity.id)
+            .outerjoin(marker, and_(marker.entity_id == Entity.id, marker.kind == MARKER))
+            .filter(Entity.match_done == True, or_(marker.id == None, changed_origins))
+            .order_by(Entity.id).all()]
+
+
+def delete_grouping_keys(entity_ids):
+    for chunk in chunks(entity_ids):
+        get_session().query(GroupingKey).filter(GroupingKey.entity_id.in_(chunk)).delete(synchronize_session=False)
+
+
+# rows: (entity_id, kind, key, value)
+def insert_grouping_keys(rows):
+    for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+        get_session().execute(GroupingKey.__table__.insert(), [
+            {"entity_id": entity_id, "kind": kind, "key": key, "value": value}
+            for entity_id, kind, key, value in rows[i:i + INSERT_CHUNK_SIZE]
+        ])
+
+
+# (entity_id, key, value) of the given keys of a kind (all of them without keys)
+def select_keys(kind, keys=None):
+    query = get_session().query(GroupingKey.entity_id, GroupingKey.key, GroupingKey.value) \
+        .filter(GroupingKey.kind == kind)
+    if keys is None:
+        return query.all()
+    rows = []
+    for chunk in chunks(keys):
+        rows.extend(query.filter(GroupingKey.key.in_(chunk)).all())
+    return rows
+
+
+# Key -> number of values having it
+def count_keys(kind, keys):
+    counts = {}
+    for chunk in chunks(keys):
+        counts.update(get_session().query(GroupingKey.key, func.count(distinct(GroupingKey.value)))
+                      .filter(GroupingKey.kind == kind, GroupingKey.key.in_(chunk))
+                      .group_by(GroupingKey.key).all())
+    return counts
+
+
+# (entity_id, value) of the values having all the tokens
+def select_values_with_tokens(kind, tokens):
+    return get_session().query(GroupingKey.entity_id, GroupingKey.value) \
+        .filter(GroupingKey.kind == kind, GroupingKey.key.in_(tokens)) \
+        .group_by(GroupingKey.entity_id, GroupingKey.value) \
+        .having(func.count(distinct(GroupingKey.key)) == len(set(tokens))).all()
+
+
+def refresh_grouping_keys(score_cutoff):
+    entity_ids = select_stale_entity_ids()
+    log.info("Grouping keys to compute for {} entities".format(len(entity_ids)))
+    for i in range(0, len(entity_ids), REFRESH_CHUNK_SIZE):
+        chunk = entity_ids[i:i + REFRESH_CHUNK_SIZE]
+        delete_grouping_keys(chunk)
+        table = load_entity_table(match_done=True, ids=chunk)
+        insert_grouping_keys([(int(table.ids[row]), kind, key, value) for row in range(len(table))
+                              for kind, key, value in get_grouping_keys(table.make_entity(row), score_cutoff)])
+        get_session().commit()
+
+
+# Ids of the matched entities whose fuzzy values of a field may be similar to the values
+def find_fuzzy_candidates(field, values, score_cutoff):
+    elements = {value: get_bigram_elements(value) for value in values}
+    counts = count_keys(BIGRAM + field, {e for value_elements in elements.values() for e in value_elements})
+    # A matched value similar to a new one has one of the elements of its prefix (rarest ones, see fuzzy.py)
+    prefixes = set()
+    for value, value_elements in elements.items():
+        prefix_length = len(value_elements) - get_min_overlap(len(value), score_cutoff) + 1
+        prefixes.update(sorted(value_elements, key=lambda e: (counts.get(e, 0), e))[:prefix_length])
+
+    # matched value -> entity ids
+    value_ids = defaultdict(set)
+    for entity_id, _, value in select_keys(BIGRAM + field, prefixes):
+        value_ids[value].add(entity_id)
+    # Values with too many tokens for their subsets are compared to all the values
+    if any(is_long_value(value) for value in values):
+        long_rows = select_keys(VALUE + field)
+    else:
+        long_rows = select_keys(LONG + field)
+    for entity_id, value, _ in long_rows:
+        value_ids[value].add(entity_id)
+
+    # New values first, then the matched ones, compared as by the fuzzy index
+    ids = set()
+    compared = list(values)
+    for value in sorted(value_ids):
+        if value in elements:
+            ids.update(value_ids[value])
+        else:
+            compared.append(value)
+    pairs = find_similar_values(compared, score_cutoff, queries=set(range(len(values)))) | \
+        find_similar_values_of_long_values(compared, score_cutoff, get_fuzzy_workers())
+    for i, j in pairs:
+        if i < len(values) <= j:
+            ids.update(value_ids[compared[j]])
+
+    # Common tokens alone reaching the cutoff, for the new or for the matched value
+    for value in values:
+        for subset in get_covering_subsets(value, score_cutoff):
+            ids.update(entity_id for entity_id, _ in select_values_with_tokens(TOKEN + field, subset.split()))
+    subsets = {subset for value in values for subset in get_token_subsets(value)}
+    ids.update(entity_id for entity_id, _, _ in select_keys(COVERING + field, subsets))
+    return ids
+
+
+# Ids of the matched entities that may auto or suggested match one of the entities
+def find_matched_candidates(entities, threshold):
+    blocking_keys = defaultdict(set)
+    field_values = defaultdict(set)
+    for entity in entities:
+        for kind, key in get_blocking_keys(entity):
+            for joined_kind in JOINED_KINDS[kind]:
+                blocking_keys[joined_kind].add(encode_blocking_key(key))
+        for field, _, value in get_fuzzy_values(entity):
+            if value != "":
+                field_values[field].add(value)
+    ids = set()
+    for kind, keys in blocking_keys.items():
+        ids.update(entity_id for entity_id, _, _ in select_keys(kind, keys))
+    for field, values in field_values.items():
+        ids.update(find_fuzzy_candidates(field, sorted(values), get_score_cutoff(threshold)))
+    return ids
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+from itertools import chain
 from urllib.parse import urlsplit
+import numpy as np
 from sqlalchemy import update
 from fuzzywuzzy import fuzz
 from mana_common.shared import log, set_logger, flush_logs
-from mana_common.orm import Entity, get_session, merge_entities
+from mana_common.orm import Entity, GroupingKey, get_session, get_db_engine, merge_entities, upgrade_origin_columns
+from source_grouping.blocking import BlockingIndex
+from source_grouping.fuzzy import FuzzyIndex, is_fuzzy_index_enabled, get_score_cutoff
+from source_grouping.entities import EntityList, load_entity_table
+from source_grouping.keys import refresh_grouping_keys, find_matched_candidates
 import os
 
 # ----------------------------------------------------------------------------------------
@@ -22,6 +28,10 @@ FUZZY_MATCH_SUGGESTED_THRESHOLD = 82
 # | Functions |
 # +-----------+
 
+def is_incremental():
+    return os.getenv("SG_INCREMENTAL", "true").lower() not in ("false", "0", "no")
+
+
 def is_auto_match_urls(url1, url2):
     if url1 is None or url2 is None:
         return False
@@ -131,33 +141,11 @@ def is_suggested_match_urls(url1, url2):
 
 # Group entities
 def get_repartition_entities():
-    entities_matched = []
-    entities_to_match = []
-    all_entities_results = get_session().query(Entity).all()
-    nb_of_entities = len(all_entities_results)
-    log.info(f"Obtained {nb_of_entities} entities")
-    i = 1
-    for e in all_entities_results:
-        nb_of_origins = len(e.origins)
-        log.info(f"Processing entity {i} of {nb_of_entities} (has {nb_of_origins} origins)")
-        origins = []
-        for o in e.origins:
-
-            origin = {"type": o.type}
-            if o.type == "twitter_origin":
-                origin["screen_name"] = o.screen_name
-                origin["twitter_profile_url"] = o.twitter_profile.url if o.twitter_profile is not None else None
-            elif o.type == "web_origin":
-                origin["expanded_url"] = o.expanded_url
-                origin["base_url"] = o.base_url
-            origins.append(origin)
-
-        entity = {"id": e.id, "name": e.name, "is_reference": e.is_reference, "origins": origins}
-        if e.match_done:
-            entities_matched.append(entity)
-        else:
-            entities_to_match.append(entity)
-        i += 1
+    table = load_entity_table()
+    log.info(f"Obtained {len(table)} entities ({len(table.origin_type_codes)} origins)")
+    rows = np.arange(len(table))
+    entities_matched = EntityList(table, rows[table.match_done])
+    entities_to_match = EntityList(table, rows[~table.match_done])
 
     log.info(
         "Entities already matched: {}; entities to match: {}".format(len(entities_matched), len(entities_to_match))
@@ -166,10 +154,31 @@ def get_repartition_entities():
     return entities_matched, entities_to_match
 
 
-def match_entity(entity, entities_matched, entities_to_match):
+# Group new entities, with only the matched entities they may match (see keys.py)
+def get_incremental_entities():
+    refresh_grouping_keys(get_score_cutoff(FUZZY_MATCH_SUGGESTED_THRESHOLD))
+    to_match_table = load_entity_table(match_done=False)
+    entities_to_match = EntityList(to_match_table, np.arange(len(to_match_table)))
+    matched_ids = find_matched_candidates(entities_to_match.iter_uncached(), FUZZY_MATCH_SUGGESTED_THRESHOLD)
+    matched_table = load_entity_table(match_done=True, ids=matched_ids)
+    entities_matched = EntityList(matched_table, np.arange(len(matched_table)))
+
+    log.info(
+        "Entities already matched (candidates): {}; entities to match: {}".format(len(entities_matched),
+                                                                                  len(entities_to_match))
+    )
+
+    return entities_matched, entities_to_match
+
+
+# index: blocking index of the entities (see blocking.py), without it every pair is checked for an auto match
+# fuzzy_index: candidates for suggested matches (see fuzzy.py), with both indexes only candidates are compared
+def match_entity(entity, entities_matched, entities_to_match, index=None, fuzzy_index=None):
     log.info("Match entity id {}".format(entity["id"]))
     auto_match_entities = []
     suggested_match_entities = []
+    auto_match_candidates = index.candidates(entity) if index is not None else None
+    suggested_match_candidates = fuzzy_index.get_candidates(entity) if fuzzy_index is not None else None
 
     def try_to_match(e1, e2):
 
@@ -181,7 +190,11 @@ def match_entity(entity, entities_matched, entities_to_match):
             # If any of the entity is auto matched then nothing to do
             return
 
-        is_am, reason_am, twitter_matched_am = is_auto_match(e1, e2)
+        if auto_match_candidates is not None and e2["id"] not in auto_match_candidates:
+            # No blocking key in common: cannot auto match
+            is_am, reason_am, twitter_matched_am = False, None, False
+        else:
+            is_am, reason_am, twitter_matched_am = is_auto_match(e1, e2)
         if is_am:
             if twitter_matched_am:
                 # auto match only if same Twitter account
@@ -194,23 +207,38 @@ def match_entity(entity, entities_matched, entities_to_match):
                 suggested_match_entities.append({"e1": e1, "e2": e2, "reason": reason_am})
         else:
             # We'll to suggested match only if no auto matched was found
-            is_sm, reason_sm = is_suggested_match(e1, e2)
+            if suggested_match_candidates is not None and e2["id"] not in suggested_match_candidates:
+                is_sm, reason_sm = False, None
+            else:
+                is_sm, reason_sm = is_suggested_match(e1, e2)
             if is_sm:
                 log.info("Suggested match found: {} = {} [reason = {}]".format(e1["id"], e2["id"], reason_sm))
                 suggested_match_entities.append({"e1": e1, "e2": e2, "reason": reason_sm})
 
     try:
+        if auto_match_candidates is not None:
+            log.info("Auto match candidates: {}".format(len(auto_match_candidates)))
+        if suggested_match_candidates is not None:
+            log.info("Suggested match candidates: {}".format(len(suggested_match_candidates)))
+
+        compared_matched, compared_to_match = entities_matched, entities_to_match
+        if auto_match_candidates is not None and suggested_match_candidates is not None:
+            # Other entities can neither auto match nor suggested match: same order, without them
+            candidates = auto_match_candidates | suggested_match_candidates
+            compared_matched = index.select(candidates, entities_matched)
+            compared_to_match = index.select(candidates, entities_to_match, len(entities_matched))
+
         # Step 1 of 2: match already matched & new entities
-        total = len(entities_matched)
+        total = len(compared_matched)
         log.info("Step 1 of 2 - max {} operation(s) expected".format(total))
-        for em in entities_matched:
+        for em in compared_matched:
             try_to_match(entity, em)
 
         # Step 2 of 2: match new entities together
-        total = len(entities_to_match)
+        total = len(compared_to_match)
         log.info("Step 2 of 2 - max {} operation(s) expected".format(total))
 
-        for em in entities_to_match:
+        for em in compared_to_match:
             try_to_match(entity, em)
 
         log.info("Entities to merge (auto): {}".format(len(auto_match_entities)))
@@ -273,10 +301,23 @@ def main():
             log.info("Skipping step as SKIP_SG is set")
             return
 
-        entities_matched, entities_to_match = get_repartition_entities()
+        # Without the fuzzy index every pair is compared: all the entities are needed
+        if is_incremental() and is_fuzzy_index_enabled():
+            GroupingKey.__table__.create(bind=get_db_engine(), checkfirst=True)
+            upgrade_origin_columns()
+            entities_matched, entities_to_match = get_incremental_entities()
+        else:
+            entities_matched, entities_to_match = get_repartition_entities()
+        index = BlockingIndex(chain(entities_matched.iter_uncached(), entities_to_match.iter_uncached()))
+        log.info("Blocking index: {} key(s)".format(len(index.blocks)))
+        fuzzy_index = None
+        if is_fuzzy_index_enabled():
+            fuzzy_index = FuzzyIndex(chain(entities_matched.iter_uncached(), entities_to_match.iter_uncached()),
+                                     FUZZY_MATCH_SUGGESTED_THRESHOLD)
+            log.info("Fuzzy index: {} entities with candidates".format(len(fuzzy_index.candidates)))
         while len(entities_to_match) > 0:
             entity = entities_to_match.pop()
-            match_entity(entity, entities_matched, entities_to_match)
+            match_entity(entity, entities_matched, entities_to_match, index, fuzzy_index)
         log.info("Normal end of processing - completed")
     finally:
         # Flush logs to make sure we've got them all before leaving
@@ -1,12 +1,40 @@
+import os
+import json
+import time
+import fitz
 import pytest
 
-from content_analysis.main import analyse_content, analyse_contents
+from content_analysis.main import analyse_content, analyse_contents, iter_pending_contents, \
+    analyse_contents_in_workers, daniel_evaluation, translate, nlu_analysis, is_content_relevant_based_on_nlu, \
+    _metrics, _nlu_cache
+from content_analysis.highlight import SentenceIndex, Highlighter
+from content_analysis.prefilter import PrefilterClassifier
+from content_analysis.translation import split_into_chunks, translate_text
+from content_analysis.pdf import extract_pdf_text
+from content_analysis.langid import identify_language_if_confident
+from content_analysis.extraction import ExtractionError, run_extraction_task, close_extraction_pool
+from content_analysis.leases import claim_contents, get_content_queue_status, LEASE_MAX_ATTEMPTS, LEASE_RETRY_AFTER_S
 from mana_common import orm
+from mana_common.resilience import CircuitOpenError
 from mana_common.shared import set_logger
 from alchemy_mock.mocking import UnifiedAlchemyMagicMock
+from unittest.mock import MagicMock
 
 original_text = 'Toto est le roi de la déforestation'
 translated_text = 'Toto is the king of deforestation'
+config = {
+    "max_tweets": 10,
+    "trusted_source_origins_threshold": 10,
+    "trusted_source_group_threshold": 3,
+    "source_candidate_threshold": 2,
+    "use_nlu_for_company_detection": False,
+    "url_extensions_to_check_for_true_url": [],
+    "domains_where_next_element_matters": [],
+    "ignore_for_rss_search": [],
+    "url_patterns_to_ignore": [],
+    "url_pattern_to_ignore_for_content_analysis": [],
+    "social_keywords_pattern": ""
+}
 
 # Fixture are function that can be injected into specific tests (passing them as parameter to the test)
 # Or they can be run before all tests in this file, with the use of the autouse flag
@@ -24,19 +52,7 @@ def test_dummy():
 
 def test_deforestation_evidence_return_analyse_with_flag_1(mocker):
     # Mocking get_config which typically retrieves those values from db
-    mocker.patch('mana_common.orm.get_config', return_value={
-        "max_tweets": 10,
-        "trusted_source_origins_threshold": 10,
-        "trusted_source_group_threshold": 3,
-        "source_candidate_threshold": 2,
-        "use_nlu_for_company_detection": False,
-        "url_extensions_to_check_for_true_url": [],
-        "domains_where_next_element_matters": [],
-        "ignore_for_rss_search": [],
-        "url_patterns_to_ignore": [],
-        "url_pattern_to_ignore_for_content_analysis": [],
-        "social_keywords_pattern": ""
-    })
+    mocker.patch('mana_common.orm.get_config', return_value=config)
     session = UnifiedAlchemyMagicMock()
     mocker.patch('mana_common.orm.get_session', return_value=session)
     # Mocking the various Watson Services
@@ -50,6 +66,178 @@ def test_deforestation_evidence_return_analyse_with_flag_1(mocker):
     assert len(analyses) == 1
     assert analyses[0].flag == 1
 
+def test_text_without_company_candidate_is_not_translated(mocker):
+    mocker.patch('mana_common.orm.get_config', return_value=config)
+    mocker.patch('mana_common.orm.get_companies_cache', return_value=[{'name': 'Toto', 'synonyms': ['Titi']}])
+    mock_translate = mocker.patch('content_analysis.main.translate')
+    mock_identify = mocker.patch('content_analysis.main.identify_language')
+    _metrics.clear()
+
+    analysis, companies = daniel_evaluation(orm.Analysis(original_text='Tata est la reine de la déforestation'))
+
+    assert analysis.status == orm.AnalysisStatus.no_companies
+    assert companies == []
+    mock_translate.assert_not_called()
+    mock_identify.assert_not_called()
+    assert _metrics["translation_calls_avoided"] == 1
+
+def test_text_in_risky_language_is_translated_without_company_candidate(mocker):
+    mocker.patch.dict(os.environ, {"CA_TRANSLATION_RISKY_LANGUAGES": "de, fr"})
+    mocker.patch('mana_common.orm.get_config', return_value=config)
+    mocker.patch('mana_common.orm.get_companies_cache', return_value=[{'name': 'Toto', 'synonyms': ['Titi']}])
+    mocker.patch('content_analysis.main.identify_language', return_value=('fr', 0.9))
+    mock_translate = mocker.patch('content_analysis.main.translate', return_value=['fr', 'Tata is the queen'])
+
+    analysis, companies = daniel_evaluation(orm.Analysis(original_text='Tata est la reine de la déforestation'))
+
+    mock_translate.assert_called_once_with('Tata est la reine de la déforestation', ('fr', 0.9))
+    assert analysis.translated_text == 'Tata is the queen'
+    assert analysis.status == orm.AnalysisStatus.no_companies
+
+def test_english_text_identified_locally_is_not_sent_to_translator(mocker):
+    mock_translator = mocker.patch('content_analysis.main.get_translator')
+    text = 'Toto is the king of deforestation, according to a report published this Tuesday by several NGOs'
+
+    assert translate(text) == ('en', text)
+    mock_translator.assert_not_called()
+
+def test_short_text_language_is_identified_by_translator(mocker):
+    mock_translator = mocker.patch('content_analysis.main.get_translator')
+    mock_translator.return_value.identify.return_value.get_result.return_value = \
+        {'languages': [{'language': 'en', 'confidence': 0.8}]}
+
+    assert translate('Toto!') == ('en', 'Toto!')
+    mock_translator.return_value.identify.assert_called_once_with('Toto!')
+    mock_translator.return_value.translate.assert_not_called()
+
+def test_relevance_probe_asks_nlu_for_less_and_evaluation_is_sent_once_per_text(mocker):
+    mocker.patch('mana_common.orm.get_config', return_value=config)
+    mocker.patch('content_analysis.main.translate', return_value=['en', translated_text])
+    analyze = mocker.patch('content_analysis.main.get_nlu').return_value.analyze
+    analyze.return_value.get_result.return_value = {'entities': [{'type': 'Person', 'text': 'Toto'}],
+                                                    'keywords': [{'text': 'deforestation'}]}
+    _nlu_cache.clear()
+
+    assert is_content_relevant_based_on_nlu(original_text)
+    probe_features = analyze.call_args[1]['features']
+    assert probe_features.entities.limit == 1 and probe_features.keywords.limit == 1
+    assert probe_features.sentiment is None and probe_features.emotion is None and probe_features.concepts is None
+
+    nlu_analysis(translated_text)
+    nlu_analysis(translated_text)
+    assert analyze.call_count == 2
+    evaluate_features = analyze.call_args[1]['features']
+    assert evaluate_features.keywords.emotion and evaluate_features.sentiment.document
+    assert evaluate_features.concepts is None
+
+def test_split_into_chunks_prefers_paragraph_then_sentence_boundaries():
+    text = "Toto cuts trees.\n\nToto burns forests. Titi sells palm oil. Tata buys it"
+
+    chunks = split_into_chunks(text, chunk_size=30)
+
+    assert [text[start:end] for start, end in chunks] == \
+           ["Toto cuts trees.", "Toto burns forests.", "Titi sells palm oil.", "Tata buys it"]
+
+def test_translate_text_reassembles_chunks_in_order(mocker):
+    mock_translator = mocker.patch('content_analysis.translation.get_translator')
+    mock_translator.return_value.translate.side_effect = \
+        lambda text, model_id: mocker.Mock(get_result=lambda: {'translations': [{'translation': text.upper()}]})
+    text = "Toto coupe des arbres.\n\nToto brule des forets. Titi vend de l'huile de palme."
+
+    translated_text, chunk_count = translate_text(text, 'fr-en', chunk_size=30, workers=3)
+
+    assert translated_text == text.upper()
+    assert chunk_count == len(split_into_chunks(text, chunk_size=30)) == 3
+
+def build_pdf(pages):
+    doc = fitz.open()
+    for lines in pages:
+        page = doc.newPage()
+        for i, line in enumerate(lines):
+            page.insertText((50, 72 + 100 * i), line)
+    return doc.write()
+
+def test_extract_pdf_text_keeps_all_pages_and_checks_few_blocks_remotely(mocker):
+    mocker.patch('mana_common.orm.get_companies_cache', return_value=[{'name': 'Toto', 'synonyms': ['Titi']}])
+    mocker.patch('content_analysis.pdf.PDF_MAX_RELEVANCE_CHECKS', 2)
+    is_relevant = mocker.Mock(side_effect=lambda text: 'Titi' in text)
+    pages = [["Page {} of a long report about the supply chains of the palm oil industry".format(i), "12 34 56 78"]
+             for i in range(6)]
+    pages[4][0] = "Titi clears the rainforest of Borneo to plant palm trees, says the report"
+
+    try:
+        text = extract_pdf_text(build_pdf(pages), is_relevant)
+    finally:
+        close_extraction_pool()
+
+    # Number only blocks are dropped, the mention of a company is checked first
+    assert text.split("\n") == [p[0] for p in pages]
+    is_relevant.assert_called_once_with(pages[4][0])
+
+def test_extraction_task_that_hangs_is_killed_and_the_pool_replaced():
+    try:
+        with pytest.raises(ExtractionError, match="not done after"):
+            run_extraction_task(time.sleep, 10, timeout=1)
+        assert run_extraction_task(len, "still working") == 13
+    finally:
+        close_extraction_pool()
+
+def test_extraction_task_over_the_memory_ceiling_fails(mocker):
+    mocker.patch.dict(os.environ, {"CA_EXTRACTION_MEMORY_LIMIT_MB": "512"})
+    close_extraction_pool()
+    try:
+        with pytest.raises(ExtractionError, match="memory limit of 512 MB exceeded"):
+            run_extraction_task(bytearray, 1024 ** 3)
+    finally:
+        close_extraction_pool()
+
+def test_link_that_cannot_be_extracted_is_recorded_and_tweet_is_analysed(mocker):
+    mocker.patch('mana_common.orm.get_config', return_value=config)
+    mocker.patch('mana_common.orm.get_session', return_value=UnifiedAlchemyMagicMock())
+    mocker.patch('content_analysis.main.get_full_url', side_effect=lambda url, extensions: url)
+    mocker.patch('content_analysis.main.requests.get').return_value.headers = {'content-type': 'text/html'}
+    mocker.patch('content_analysis.main.extract_html_text',
+                 side_effect=ExtractionError("parse_html_paragraphs not done after 30s"))
+    mocker.patch('content_analysis.main.daniel_evaluation', side_effect=lambda analysis: (analysis, []))
+
+    analyses = analyse_content(content=orm.Content(value=original_text + " https://example.com/article",
+                                                   content_type=orm.ContentType.tweet))
+
+    assert [a.status for a in analyses] == [orm.AnalysisStatus.failed_at_extraction, None]
+    assert analyses[0].link == "https://example.com/article"
+    assert analyses[0].status_exception == "parse_html_paragraphs not done after 30s"
+    assert analyses[1].type == orm.AnalysisType.tweet
+
+def test_prefilter_enforce_mode_skips_watson_for_unlikely_texts(mocker):
+    mocker.patch.dict(os.environ, {"CA_PREFILTER_MODE": "enforce"})
+    mocker.patch('mana_common.orm.get_config', return_value=config)
+    mocker.patch('mana_common.orm.get_session', return_value=UnifiedAlchemyMagicMock())
+    mocker.patch('content_analysis.main.translate', return_value=['fr', translated_text])
+    mocker.patch('mana_common.orm.get_companies_cache', return_value=[{'name': 'Toto', 'synonyms': ['Titi']}])
+    mocker.patch('content_analysis.main.predict_mana_probability', return_value=0.02)
+    mock_nlu = mocker.patch('content_analysis.main.nlu_analysis')
+    mock_assistant = mocker.patch('content_analysis.main.send_message_to_assistant')
+
+    analyses = analyse_content(content=orm.Content(value=original_text, content_type=orm.ContentType.tweet))
+
+    assert len(analyses) == 1
+    assert analyses[0].status == orm.AnalysisStatus.prefiltered
+    assert analyses[0].company == 'Toto'
+    mock_nlu.assert_not_called()
+    mock_assistant.assert_not_called()
+
+def test_prefilter_classifier_learns_from_labeled_texts():
+    positives = ["{} clears the rainforest for palm oil plantations".format(c) for c in ["Toto", "Titi", "Tata"]] + \
+                ["illegal deforestation and fires in the amazon linked to {}".format(c) for c in ["Toto", "Titi"]]
+    negatives = ["{} opens a new store in the city center".format(c) for c in ["Toto", "Titi", "Tata"]] + \
+                ["{} quarterly results beat analyst expectations".format(c) for c in ["Toto", "Titi"]]
+
+    classifier = PrefilterClassifier.train(positives + negatives, [1] * len(positives) + [0] * len(negatives),
+                                           n_features=2 ** 12, epochs=20)
+
+    assert classifier.predict_proba("Tutu clears the rainforest, fires in the amazon") > 0.5
+    assert classifier.predict_proba("Tutu opens a store, results beat expectations") < 0.5
+
 def test_analyse_contents_store_correct_number_of_analyses(mocker):
     # Mocking the database session
     session = UnifiedAlchemyMagicMock()
@@ -67,6 +255,244 @@ def test_analyse_contents_store_correct_number_of_analyses(mocker):
     analyse_contents()
     assert 2 == len(session.query(orm.Analysis).all())
 
+def test_analyse_contents_writes_analyses_by_batch(mocker):
+    session = UnifiedAlchemyMagicMock()
+    for i in range(5):
+        session.add(orm.Content(value=original_text, content_type=orm.ContentType.tweet, analysis_ts=None))
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    mocker.patch('content_analysis.main.analyse_content', side_effect=lambda c: [orm.Analysis(), orm.Analysis()])
+    mocker.patch('content_analysis.main.ANALYSIS_BATCH_SIZE', 2)
+    mock_delete = mocker.patch('content_analysis.main.delete_previous_analyses', return_value=0)
+
+    analyse_contents()
+
+    # 5 contents by batches of 2: 3 transactions, each with a single set-based delete
+    assert session.commit.call_count == 3
+    assert mock_delete.call_count == 3
+    assert 10 == len(session.query(orm.Analysis).all())
+
+def test_analyse_contents_parks_contents_and_stops_while_a_watson_service_is_unavailable(mocker):
+    session = UnifiedAlchemyMagicMock()
+    contents = [orm.Content(value=original_text, content_type=orm.ContentType.tweet, analysis_ts=None) for i in range(3)]
+    for c in contents:
+        session.add(c)
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+
+    def analyse(content):
+        if content is contents[1]:
+            content.analysis_ts = 1
+            raise CircuitOpenError("nlu")
+        content.analysis_ts = 1
+        return [orm.Analysis()]
+    mock_analyse = mocker.patch('content_analysis.main.analyse_content', side_effect=analyse)
+
+    metrics = analyse_contents()
+
+    assert metrics["parked"] == 1
+    assert metrics["contents"] == 1
+    assert metrics["circuit_open"] == 1
+    assert mock_analyse.call_count == 2
+    assert [c.analysis_ts for c in contents] == [1, None, None]
+    assert 1 == len(session.query(orm.Analysis).all())
+
+def test_analyse_contents_stops_claiming_and_releases_leases_when_a_circuit_is_open(mocker):
+    mocker.patch.dict(os.environ, {"CA_USE_LEASES": "true"})
+    contents = [orm.Content(id=i, value=original_text, content_type=orm.ContentType.tweet, analysis_ts=None)
+                for i in range(1, 5)]
+    mocker.patch('mana_common.orm.get_session', return_value=UnifiedAlchemyMagicMock())
+    mocker.patch('content_analysis.main.count_pending_contents', return_value=40)
+    claimed = []
+
+    def claim_chunk(worker_id, scheduler=None):
+        while True:
+            claimed.append(contents)
+            yield contents
+    mocker.patch('content_analysis.main.iter_leased_contents', side_effect=claim_chunk)
+    mocker.patch('content_analysis.main.get_open_circuits', side_effect=[[], ["nlu"]])
+    mocker.patch('content_analysis.main.analyse_content', return_value=[orm.Analysis()])
+    mocker.patch('content_analysis.main.get_content_queue_status', return_value={})
+    mock_release = mocker.patch('content_analysis.main.release_leases')
+
+    metrics = analyse_contents()
+
+    assert len(claimed) == 1
+    assert metrics["contents"] == 1 and metrics["parked"] == 1
+    mock_release.assert_called_once_with([2, 3, 4])
+
+def test_iter_pending_contents_pages_by_id_until_last_partial_chunk(mocker):
+    contents = [orm.Content(id=i, value=original_text, content_type=orm.ContentType.tweet) for i in range(1, 6)]
+    session = mocker.MagicMock()
+    query = session.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+    query.all.side_effect = [contents[0:2], contents[2:4], contents[4:]]
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+
+    chunks = list(iter_pending_contents(chunk_size=2))
+
+    assert [[c.id for c in chunk] for chunk in chunks] == [[1, 2], [3, 4], [5]]
+    assert query.all.call_count == 3
+
+def test_analyse_contents_closes_leases_in_lease_mode(mocker):
+    session = UnifiedAlchemyMagicMock()
+    session.add(orm.Content(id=1, value=original_text, content_type=orm.ContentType.tweet, analysis_ts=None))
+    session.add(orm.Content(id=2, value=original_text, content_type=orm.ContentType.tweet, analysis_ts=None))
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    mocker.patch('content_analysis.main.is_lease_mode', return_value=True)
+    mocker.patch('content_analysis.main.claim_contents', side_effect=[[1, 2], []])
+    mocker.patch('content_analysis.main.get_content_queue_status', return_value={})
+    mock_complete = mocker.patch('content_analysis.main.complete_leases')
+    mock_fail = mocker.patch('content_analysis.main.fail_leases')
+    mock_release = mocker.patch('content_analysis.main.release_leases')
+
+    def analyse_first_content_only(content):
+        if content.id == 1:
+            content.analysis_ts = 1
+            return [orm.Analysis()]
+        return []
+    mocker.patch('content_analysis.main.analyse_content', side_effect=analyse_first_content_only)
+
+    analyse_contents()
+
+    mock_complete.assert_called_once_with([1])
+    mock_fail.assert_called_once_with([2], "No analysis produced")
+    mock_release.assert_called_once_with([])
+
+def test_analyse_contents_stops_before_deadline_and_releases_unprocessed_contents(mocker):
+    session = UnifiedAlchemyMagicMock()
+    for i in range(1, 6):
+        session.add(orm.Content(id=i, value=original_text, content_type=orm.ContentType.tweet, analysis_ts=None))
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    mocker.patch('content_analysis.main.is_lease_mode', return_value=True)
+    mock_claim = mocker.patch('content_analysis.main.claim_contents', side_effect=[[1, 2, 3, 4, 5], []])
+    mocker.patch('content_analysis.main.get_content_queue_status', return_value={})
+    mocker.patch('content_analysis.main.complete_leases')
+    mock_release = mocker.patch('content_analysis.main.release_leases')
+    # No past run: a content is estimated to take 10s, so 45s are needed to start one (x3 + 15s to write the batch)
+    clock = {"now": 0}
+    mocker.patch('content_analysis.scheduler.time.time', side_effect=lambda: clock["now"])
+
+    def analyse_in_20s(content):
+        clock["now"] += 20
+        content.analysis_ts = 1
+        return [orm.Analysis()]
+    mocker.patch('content_analysis.main.analyse_content', side_effect=analyse_in_20s)
+
+    metrics = analyse_contents(deadline=95)
+
+    # Contents are started at 0s, 20s and 40s; at 60s only 35s are left (~38s needed)
+    assert metrics["contents"] == 3
+    assert metrics["deadline_reached"] == 1
+    mock_claim.assert_called_once()
+    mock_release.assert_called_once_with([4, 5])
+
+def test_failed_leases_are_claimed_again_after_a_cool_down_then_given_up(mocker):
+    session = MagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    session.execute.return_value.fetchone.return_value = {
+        "pending": 4, "in_flight": 1, "expired": 0, "done": 5, "retrying": 2, "failed": 1}
+
+    claim_contents("worker-1", 10)
+    assert get_content_queue_status() == {
+        "pending": 4, "in_flight": 1, "expired": 0, "done": 5, "retrying": 2, "failed": 1}
+
+    (_, _), (claim, claim_params), (status, status_params) = [c[0] for c in session.execute.call_args_list]
+    assert "l.status = 'failed' AND l.attempts < :max_attempts" in claim.text
+    assert claim_params["retry_after_s"] == LEASE_RETRY_AFTER_S
+    assert claim_params["max_attempts"] == LEASE_MAX_ATTEMPTS
+    # Given up contents are no longer pending
+    assert "gl.status = 'failed' AND gl.attempts >= :max_attempts" in status.text
+    assert status_params == {"max_attempts": LEASE_MAX_ATTEMPTS}
+
+# Worker processes are forked, so that they keep the mocks
+def analyse_contents_in_forked_workers(mocker, workers, analyse_contents):
+    mocker.patch('mana_common.orm.get_session', return_value=UnifiedAlchemyMagicMock())
+    mocker.patch('content_analysis.main.WORKERS_START_METHOD', "fork")
+    mocker.patch('content_analysis.main.WORKERS_POLL_S', 0.05)
+    mocker.patch('content_analysis.main.load_cache_companies')
+    mocker.patch('content_analysis.main.record_metrics')
+    mocker.patch('content_analysis.main.analyse_contents', side_effect=analyse_contents)
+    return analyse_contents_in_workers(workers)
+
+def test_analyse_contents_in_workers_merges_worker_metrics(mocker):
+    def analyse_contents(partition, deadline):
+        index, count = partition
+        return {"contents": index + 1, "analyses": 2 * count, "worker_{}".format(index): 1}
+
+    metrics = analyse_contents_in_forked_workers(mocker, 2, analyse_contents)
+
+    assert metrics == {"contents": 3, "analyses": 8, "worker_0": 1, "worker_1": 1}
+
+def test_workers_extract_in_their_own_supervised_pool(mocker):
+    def analyse_contents(partition, deadline):
+        try:
+            # Extraction runs in another process, a stuck one is killed
+            with pytest.raises(ExtractionError, match="not done after"):
+                run_extraction_task(time.sleep, 10, timeout=1)
+            return {"extracted_apart": int(run_extraction_task(os.getpid) != os.getpid())}
+        finally:
+            close_extraction_pool()
+
+    metrics = analyse_contents_in_forked_workers(mocker, 2, analyse_contents)
+
+    assert metrics == {"extracted_apart": 2}
+
+def test_analyse_contents_in_workers_fails_when_a_worker_fails(mocker):
+    def analyse_contents(partition, deadline):
+        if partition[0] == 1:
+            raise ValueError("worker failure")
+        return {"contents": 1}
+
+    with pytest.raises(RuntimeError, match=r"\['ca-w1'\] failed \(exit codes \[1\]\)"):
+        analyse_contents_in_forked_workers(mocker, 2, analyse_contents)
+
+def test_sentence_index_finds_the_same_sentences_as_splitting_the_text():
+    text = "Toto cuts trees. Toto is the king of deforestation. Titi burns. forests. Toto. "
+    index = SentenceIndex(text)
+
+    for keyword in ["Toto", "king of", "s. T", "burns", "fores", "", "Tata"]:
+        assert index.sentences_containing(keyword) == [s for s in text.split('. ') if keyword in s]
+
+def test_highlighter_renders_like_replace_when_marks_do_not_overlap():
+    text = "Toto cuts trees for $10. Toto is the king of deforestation. Titi burns forests"
+    highlighter = Highlighter(text)
+    highlighter.mark("Toto is the king of deforestation", "yellow")
+    highlighter.mark("burns", "orange", label="(-0.63)")
+    highlighter.mark("Titi", "red")
+
+    expected = text.replace("Toto is the king of deforestation",
+                            '<mark style="background-color: yellow">Toto is the king of deforestation</mark>') \
+        .replace("burns", '<mark style="background-color: orange">burns(-0.63)</mark>') \
+        .replace("Titi", '<mark style="background-color: red">Titi</mark>') \
+        .replace('$', 'dollars')
+    assert highlighter.render(replace_dollars=True) == expected
+
+def test_highlighter_nests_contained_marks_and_drops_partial_overlaps():
+    highlighter = Highlighter("Toto is the king of deforestation")
+    highlighter.mark("king of deforestation", "yellow")
+    highlighter.mark("the king", "orange", label="(0.1)")
+    highlighter.mark("deforestation", "orange", label="(0.2)")
+    highlighter.mark("deforestation", "orange", label="(0.2)")
+    highlighter.mark("or", "red")
+
+    assert highlighter.render() == 'Toto is the <mark style="background-color: yellow">king of ' \
+                                   '<mark style="background-color: orange">def' \
+                                   '<mark style="background-color: red">or</mark>estation(0.2)</mark></mark>'
+
+def test_highlighter_finds_overlapping_and_prefix_patterns_like_find():
+    text = "aaaa deforestation of the forests, the deforestation of the forests by deforesters"
+    long_sentence = "deforestation of the forests by deforesters"
+    patterns = ["aa", "a", "defor", "deforest", "deforestation", "forest", "forests", long_sentence, "Tata"]
+    highlighter = Highlighter(text)
+    for pattern in patterns:
+        highlighter.mark(pattern, "yellow")
+
+    expected = []
+    for pattern in patterns:
+        position = text.find(pattern)
+        while position >= 0:
+            expected.append((position, position + len(pattern)))
+            position = text.find(pattern, position + len(pattern))
+    assert sorted((start, end) for start, end, _, _, _ in highlighter.find_spans()) == sorted(expected)
+
 # Mocking assistant function
 def mock_assistant_oui_mana(input_text, context):
     if input_text == translated_text:
@@ -76,3 +502,15 @@ def mock_assistant_oui_mana(input_text, context):
 
 
 
+
+def test_local_language_id_agrees_with_the_labelled_sample_when_trusted():
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks", "langid_sample.jsonl")
+    with open(path, encoding="utf-8") as f:
+        sample = [json.loads(line) for line in f]
+
+    identified = [(item, identify_language_if_confident(item["text"])) for item in sample]
+    trusted = [(item, result) for item, result in identified if result is not None]
+    assert len(trusted) > len(sample) / 2
+    assert all(result[0] == item["language"] for item, result in trusted)
+    # Short texts are left to Watson
+    assert identify_language_if_confident("Stop deforestation now!") is None
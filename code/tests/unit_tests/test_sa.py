@@ -1,3 +1,5 @@
+import threading
+from datetime import datetime, timedelta, timezone
 import pytest
 
 import mana_common
@@ -5,8 +7,11 @@ from mana_common import orm
 from mana_common.shared import set_logger
 from alchemy_mock.mocking import UnifiedAlchemyMagicMock
 from source_acquisition.main import add_rss_origin, add_web_origin, add_twitter_origin, \
-    save_tweet_content, save_origin_content_relation, save_origin_group_relation,\
-    process_tweets, process_twitter_reference, process_reference, process_tweets
+    save_tweet_content, save_mentions, \
+    process_tweets, process_twitter_reference, process_reference, process_tweets, load_origin_maps, clear_origin_maps, \
+    find_web_origin, process_references
+from source_acquisition.enrichment import load_enrichment_keys, clear_enrichment_keys, drain_enrichment_queue, \
+    defer_enrichment, ENRICHMENT_MAX_ATTEMPTS
 
 from twitter import Url, User, Status
 
@@ -45,7 +50,8 @@ def create_origin(session):
     return origin
 
 
-def test_add_rss_origin_finds_rss_and_set_occurences_to_1(mocker):
+def test_add_rss_origin_finds_rss_and_set_occurences_to_1(mocker, monkeypatch):
+    monkeypatch.setenv("SA_DEFER_ENRICHMENT", "false")
     session = UnifiedAlchemyMagicMock()
     mocker.patch('mana_common.orm.get_session', return_value=session)
 
@@ -60,7 +66,8 @@ def test_add_rss_origin_finds_rss_and_set_occurences_to_1(mocker):
     assert (rss.occurrences == 1)
 
 
-def test_add_rss_origin_increments_single_rss_origin_occurences_if_exists(mocker):
+def test_add_rss_origin_increments_single_rss_origin_occurences_if_exists(mocker, monkeypatch):
+    monkeypatch.setenv("SA_DEFER_ENRICHMENT", "false")
     session = UnifiedAlchemyMagicMock()
     mocker.patch('mana_common.orm.get_session', return_value=session)
 
@@ -137,6 +144,34 @@ def test_add_twitter_origin_increments_single_origin_if_known_screen_name(mocker
     assert (twitter_origin.occurrences == 2)
 
 
+def test_origins_are_looked_up_in_memory_once_origin_maps_are_loaded(mocker):
+    session = UnifiedAlchemyMagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    mocker.patch('source_acquisition.main.retrieve_and_associate_twitter_profile', return_value=None)
+    mocker.patch('source_acquisition.main.find_rss_feed', return_value=None)
+    known_origin = orm.WebOrigin(id=1, raw_url=base_url, base_url=base_url.rstrip("/"), occurrences=3,
+                                 entity=orm.Entity(name=base_url))
+    session.add(known_origin)
+
+    load_origin_maps()
+    load_enrichment_keys()
+    session.query = mocker.Mock(side_effect=AssertionError("no query once origins are loaded"))
+    try:
+        content = orm.Content(value="dummy text", content_type=orm.ContentType.tweet)
+        add_web_origin(content, Url(url=base_url, expanded_url=base_url))
+        other_url = 'https://news.mongabay.com/'
+        for i in range(2):
+            add_web_origin(content, Url(url=other_url, expanded_url=other_url))
+            add_twitter_origin(content, User(screen_name="dummy"))
+
+        assert known_origin.occurrences == 4
+        assert find_web_origin('https://news.mongabay.com').occurrences == 2
+        assert add_twitter_origin(content, User(screen_name="dummy")).occurrences == 3
+    finally:
+        clear_origin_maps()
+        clear_enrichment_keys()
+
+
 def test_save_tweet_content_associate_content_with_the_correct_origin(mocker):
     session = UnifiedAlchemyMagicMock()
     mocker.patch('mana_common.orm.get_session', return_value=session)
@@ -160,30 +195,49 @@ def test_save_tweet_content_associate_content_with_the_correct_origin(mocker):
     assert (retrieved_content.origin.screen_name == "dummy")
 
 
-def test_save_origin_content_relation_saves_a_new_record(mocker):
+def test_save_mentions_writes_occurrences_and_relations_in_bulk(mocker):
     session = UnifiedAlchemyMagicMock()
     mocker.patch('mana_common.orm.get_session', return_value=session)
+    execute = mocker.patch.object(session, 'execute')
+    add_origin_occurrences = mocker.patch('source_acquisition.main.add_origin_occurrences')
 
     content = create_content(session)
+    content.id = 10
     origin = create_origin(session)
+    origin.id = 1
+    origin.occurrences = 3
+    other_origin = orm.WebOrigin(id=2, base_url=base_url, occurrences=0)
+    entity = orm.Entity(id=5, name="Dummy", group_id=7)
 
-    save_origin_content_relation(origin, content)
+    save_mentions([(origin, content, entity), (origin, content, entity), (other_origin, content, None),
+                   (other_origin, None, None)])
 
-    assert (session.query(orm.ContentOrigins).count() == 1)
+    add_origin_occurrences.assert_called_once_with({1: 2, 2: 2})
+    assert (origin.occurrences == 5)
+    assert (other_origin.occurrences == 2)
+    # One statement for the content relations, one for the group relations
+    assert (execute.call_count == 2)
+    assert (execute.call_args_list[0][0][1] == [{"content_id": 10, "origin_id": 1}, {"content_id": 10, "origin_id": 1},
+                                                 {"content_id": 10, "origin_id": 2}])
+    assert (execute.call_args_list[1][0][1] == [{"origin_id": 1, "group_id": 7, "entity_id": 5, "content_id": 10}] * 2)
 
 
-def test_save_origin_group_relation_saves_a_new_record(mocker):
+def test_process_tweets_saves_the_mentions_of_the_batch_at_once(mocker):
     session = UnifiedAlchemyMagicMock()
     mocker.patch('mana_common.orm.get_session', return_value=session)
-
-    content = create_content(session)
+    mocker.patch('source_acquisition.main.retrieve_and_associate_twitter_profile', return_value=None)
+    mocker.patch('source_acquisition.main.find_rss_feed', return_value=None)
+    mock_save_mentions = mocker.patch('source_acquisition.main.save_mentions')
     origin = create_origin(session)
 
-    entity = orm.Entity(name="Dummy", group=orm.Group(name="DummyGroup"))
-
-    save_origin_group_relation(origin, entity, content)
+    tweets = [Status(in_reply_to_status_id=None, full_text="dummy text", urls=[Url(expanded_url=base_url)],
+                     user_mentions=[User(screen_name="Dummy")]) for i in range(2)]
+    process_tweets(reference_origin=origin, tweets=tweets)
 
-    assert (session.query(orm.OriginGroup).count() == 1)
+    assert (mock_save_mentions.call_count == 1)
+    mentions = mock_save_mentions.call_args[0][0]
+    assert (len(mentions) == 4)
+    assert (all(entity is origin.entity for mentioned_origin, content, entity in mentions))
 
 
 def test_process_tweets_calls_save_tweet_content_for_each_not_rt_tweets(mocker):
@@ -271,19 +325,212 @@ def test_process_twitter_reference_returns_correct_number_of_tweets_and_set_orig
     assert (origin.last_synced_id == 1)
 
 
+class MockConcurrentTwApi:
+    @staticmethod
+    def GetUserTimeline(screen_name, since_id, count):
+        return [Status(id=2, in_reply_to_status_id=None, full_text="tweet of " + screen_name,
+                       urls=[Url(url="https://t.co/1", expanded_url="https://news.mongabay.com/2021/01/")],
+                       user_mentions=[User(screen_name="mongabay")])]
 
+    @staticmethod
+    def GetUser(screen_name, return_json):
+        return {"url": "https://news.mongabay.com", "description": "", "location": ""}
 
 
+def test_process_references_concurrently_prefetches_network_calls_once_and_writes_from_main_thread(mocker, monkeypatch):
+    session = UnifiedAlchemyMagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    mocker.patch.object(session, 'execute')
+    monkeypatch.setenv("SA_CONCURRENCY", "4")
+    monkeypatch.setenv("SA_DEFER_ENRICHMENT", "false")
+    monkeypatch.setenv("SA_TWITTER_CALLS_PER_MINUTE", "0")
+    mana_common.shared._twitter_api = MockConcurrentTwApi
+    rss_threads = []
+    mocker.patch('source_acquisition.main.find_rss_feed',
+                 side_effect=lambda url, raise_errors=False: rss_threads.append(threading.current_thread().name))
+    add = session.add
+    add_threads = []
+    mocker.patch.object(session, 'add', side_effect=lambda o: add_threads.append(threading.current_thread().name)
+                        or add(o))
+
+    group = orm.Group(id=1, name="FOE")
+    for name in ("foeeurope", "bund_net", "amisdelaterre"):
+        reference = orm.Entity(name=name, is_reference=True, group=group)
+        reference.origins.append(orm.TwitterOrigin(screen_name=name))
+        session.add(reference)
+
+    process_references()
+
+    web_origin = session.query(orm.WebOrigin).first()
+    assert (web_origin.base_url == "https://news.mongabay.com")
+    assert (web_origin.occurrences == 3)
+    assert (session.query(orm.TwitterOrigin).filter(orm.TwitterOrigin.screen_name == "mongabay").first()
+            .occurrences == 3)
+    assert (len(rss_threads) == 1 and rss_threads[0].startswith("sa-prefetch"))
+    assert (set(add_threads) == {threading.main_thread().name})
+
+
+def test_process_references_concurrently_expands_the_urls_of_a_timeline_before_the_next_timelines(mocker,
+                                                                                                    monkeypatch):
+    session = UnifiedAlchemyMagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    mocker.patch.object(session, 'execute')
+    monkeypatch.setenv("SA_CONCURRENCY", "2")
+    monkeypatch.setenv("SA_DEFER_ENRICHMENT", "false")
+    monkeypatch.setenv("SA_TWITTER_CALLS_PER_MINUTE", "0")
+    mocker.patch('source_acquisition.main.find_rss_feed', return_value=None)
+    events = []
+
+    class MockOrderTwApi:
+        @staticmethod
+        def GetUserTimeline(screen_name, since_id, count):
+            events.append(("timeline", screen_name))
+            url = "https://{}.org/".format(screen_name)
+            return [Status(id=2, in_reply_to_status_id=None, full_text="tweet of " + screen_name,
+                           urls=[Url(url="https://t.co/1", expanded_url=url)], user_mentions=[])]
+    mana_common.shared._twitter_api = MockOrderTwApi
+    mocker.patch('source_acquisition.main.get_full_url',
+                 side_effect=lambda url, extensions: events.append(("full_url", url)) or url)
+
+    names = ["reference{}".format(i) for i in range(6)]
+    group = orm.Group(id=1, name="FOE")
+    for name in names:
+        reference = orm.Entity(name=name, is_reference=True, group=group)
+        reference.origins.append(orm.TwitterOrigin(screen_name=name))
+        session.add(reference)
+
+    process_references()
+
+    assert (sorted(events) == sorted([("timeline", n) for n in names] +
+                                     [("full_url", "https://{}.org/".format(n)) for n in names]))
+    # Timelines are fetched 2 references ahead: the URLs of a timeline do not wait for the timelines after them
+    for i in range(len(names) - 2):
+        assert (events.index(("full_url", "https://{}.org/".format(names[i]))) <
+                events.index(("timeline", names[i + 2])))
+
+
+def test_new_origins_queue_their_enrichment_once_instead_of_fetching_it(mocker):
+    session = UnifiedAlchemyMagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    find_rss_feed = mocker.patch('source_acquisition.main.find_rss_feed')
+    retrieve_profile = mocker.patch('source_acquisition.main.retrieve_and_associate_twitter_profile')
+
+    load_enrichment_keys()
+    try:
+        content = create_content(session)
+        for i in range(2):
+            add_web_origin(content, Url(url=base_url, expanded_url=base_url))
+            add_twitter_origin(content, User(screen_name="dummy"))
+    finally:
+        clear_enrichment_keys()
+
+    assert (find_rss_feed.call_count == 0)
+    assert (retrieve_profile.call_count == 0)
+    tasks = session.query(orm.EnrichmentTask).all()
+    assert (sorted(t.kind.name for t in tasks) == ["rss_discovery", "twitter_profile"])
+    assert (all(t.status == orm.EnrichmentStatus.pending for t in tasks))
+
+
+def test_drain_enrichment_queue_applies_results_and_backs_off_failures(mocker):
+    session = UnifiedAlchemyMagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    web_origin = orm.WebOrigin(id=1, base_url="https://news.mongabay.com", occurrences=4,
+                               entity=orm.Entity(name="MONGABAY"))
+    down_origin = orm.WebOrigin(id=2, base_url="https://down.example.org", occurrences=1,
+                                entity=orm.Entity(name="down"))
+    found = orm.EnrichmentTask(id=1, kind=orm.EnrichmentKind.rss_discovery, origin=web_origin,
+                               status=orm.EnrichmentStatus.pending, attempts=0)
+    failing = orm.EnrichmentTask(id=2, kind=orm.EnrichmentKind.rss_discovery, origin=down_origin,
+                                 status=orm.EnrichmentStatus.pending, attempts=0)
+    exhausted = orm.EnrichmentTask(id=3, kind=orm.EnrichmentKind.rss_discovery, origin=down_origin,
+                                   status=orm.EnrichmentStatus.pending, attempts=ENRICHMENT_MAX_ATTEMPTS - 1)
+    # The mocked session ignores filters: only the first batch is pending
+    mocker.patch.object(session, 'query', return_value=mocker.MagicMock(**{
+        'filter.return_value.order_by.return_value.limit.return_value.all.side_effect': [[found, failing, exhausted],
+                                                                                           []],
+        'filter.return_value.first.return_value': None
+    }))
+    mocker.patch.object(session, 'add')
+
+    def find_rss_feed(url, raise_errors=False):
+        if url == down_origin.base_url:
+            raise ConnectionError("down")
+        return "https://news.mongabay.com/feed/"
+    mocker.patch('source_acquisition.enrichment.find_rss_feed', side_effect=find_rss_feed)
+
+    drain_enrichment_queue(max_s=60)
+
+    assert (found.status == orm.EnrichmentStatus.done)
+    rss_origin = session.add.call_args[0][0]
+    assert (rss_origin.rss == "https://news.mongabay.com/feed/" and rss_origin.occurrences == 4)
+    assert (failing.status == orm.EnrichmentStatus.pending and failing.attempts == 1)
+    assert (failing.next_attempt_at > datetime.now(timezone.utc))
+    assert (exhausted.status == orm.EnrichmentStatus.failed)
+
+
+def test_done_rss_discovery_is_queued_again_once_its_cache_entry_expires(mocker):
+    session = UnifiedAlchemyMagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    web_origin = orm.WebOrigin(id=1, base_url="https://news.mongabay.com", occurrences=4,
+                               entity=orm.Entity(name="MONGABAY"))
+    task = orm.EnrichmentTask(id=1, kind=orm.EnrichmentKind.rss_discovery, origin=web_origin,
+                              status=orm.EnrichmentStatus.done, attempts=2, last_error="down")
+    discovery = orm.RssDiscovery(site="news.mongabay.com", rss=None, checked_at=datetime.now(timezone.utc))
+    for o in [web_origin, task, discovery]:
+        session.add(o)
 
+    try:
+        add_rss_origin(web_origin)
+        assert (task.status == orm.EnrichmentStatus.done)
 
+        discovery.checked_at = datetime.now(timezone.utc) - orm.get_rss_discovery_ttl(None) - timedelta(days=1)
+        add_rss_origin(web_origin)
+    finally:
+        clear_enrichment_keys()
 
+    assert (task.status == orm.EnrichmentStatus.pending)
+    assert (task.attempts == 0 and task.next_attempt_at is None and task.last_error is None)
+    assert (len(session.query(orm.EnrichmentTask).all()) == 1)
 
 
-
-
-
-
-
-
-
-
+def test_expired_negative_rss_discovery_is_queued_and_discovered_again(mocker):
+    session = UnifiedAlchemyMagicMock()
+    mocker.patch('mana_common.orm.get_session', return_value=session)
+    web_origin = orm.WebOrigin(id=1, base_url="https://news.mongabay.com", occurrences=4,
+                               entity=orm.Entity(name="MONGABAY"))
+    task = orm.EnrichmentTask(id=1, kind=orm.EnrichmentKind.rss_discovery, origin=web_origin,
+                              status=orm.EnrichmentStatus.done, attempts=1)
+    # "No feed" found 2 days ago
+    discovery = orm.RssDiscovery(site="news.mongabay.com", rss=None,
+                                 checked_at=datetime.now(timezone.utc) - timedelta(days=2))
+    for o in [web_origin, task, discovery]:
+        session.add(o)
+    find_rss_feed = mocker.patch('source_acquisition.enrichment.find_rss_feed',
+                                 return_value="https://news.mongabay.com/feed/")
+
+    try:
+        mocker.patch.dict('os.environ', {"SA_RSS_NEGATIVE_CACHE_TTL_DAYS": "3"})
+        defer_enrichment(orm.EnrichmentKind.rss_discovery, web_origin)
+        assert (task.status == orm.EnrichmentStatus.done)
+
+        mocker.patch.dict('os.environ', {"SA_RSS_NEGATIVE_CACHE_TTL_DAYS": "1"})
+        defer_enrichment(orm.EnrichmentKind.rss_discovery, web_origin)
+        assert (task.status == orm.EnrichmentStatus.pending)
+    finally:
+        clear_enrichment_keys()
+
+    # The mocked session ignores filters: only the first batch is pending, the discovery is read again
+    tasks_query = mocker.MagicMock(**{
+        'filter.return_value.order_by.return_value.limit.return_value.all.side_effect': [[task], []]
+    })
+    lookups = UnifiedAlchemyMagicMock()
+    lookups.add(discovery)
+    mocker.patch.object(session, 'query',
+                        side_effect=lambda *e: tasks_query if e[0] is orm.EnrichmentTask else lookups.query(*e))
+    mocker.patch.object(session, 'add')
+    drain_enrichment_queue(max_s=60)
+
+    find_rss_feed.assert_called_once_with("https://news.mongabay.com", raise_errors=True)
+    assert (task.status == orm.EnrichmentStatus.done)
+    rss_origin = session.add.call_args[0][0]
+    assert (rss_origin.rss == "https://news.mongabay.com/feed/" and rss_origin.occurrences == 4)
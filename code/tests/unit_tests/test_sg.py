@@ -0,0 +1,211 @@
+import copy
+import random
+from collections import defaultdict
+
+import pytest
+from unittest.mock import MagicMock
+
+from mana_common.shared import set_logger
+from alchemy_mock.mocking import UnifiedAlchemyMagicMock
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session, Query
+from source_grouping.main import match_entity, is_auto_match, is_suggested_match, get_repartition_entities, \
+    FUZZY_MATCH_SUGGESTED_THRESHOLD
+from source_grouping.blocking import BlockingIndex
+from source_grouping.fuzzy import FuzzyIndex, get_score_cutoff
+from benchmarks.grouping_benchmark import create_entities as create_benchmark_entities
+from source_grouping.keys import get_grouping_keys, find_matched_candidates, select_stale_entity_ids
+
+names = ["greenpeace", "GreenPeace", "greenpeace_uk", "wwf", "wwf_media", "foeeurope", "foe_europe", "bund_net",
+         "mongabay", "mongabay_news", "Müller", None]
+urls = ["https://www.greenpeace.org", "https://www.greenpeace.org/korea/", "https://WWW.greenpeace.org/Korea/",
+        "https://www.greenpeace.org.uk", "https://wwf.panda.org", "http://foeeurope.org/", "https://www.bund.net",
+        "https://news.mongabay.com", "https://mongabay.co.id/", None]
+
+
+@pytest.fixture(autouse=True)
+def run_before_all_tests(mocker):
+    set_logger("sg_tests")
+
+
+def create_entities(count, seed=1):
+    generator = random.Random(seed)
+    entities = []
+    for i in range(count):
+        origins = []
+        for j in range(generator.randint(1, 3)):
+            kind = generator.choice(["twitter_origin", "web_origin", "rss_origin"])
+            if kind == "twitter_origin":
+                origins.append({"type": kind, "screen_name": generator.choice(names),
+                                "twitter_profile_url": generator.choice(urls)})
+            elif kind == "web_origin":
+                url = generator.choice(urls)
+                origins.append({"type": kind, "expanded_url": url, "base_url": url})
+            else:
+                origins.append({"type": kind})
+        entities.append({"id": i, "name": "entity {}".format(i), "is_reference": generator.random() < 0.1,
+                         "origins": origins})
+    return entities
+
+
+# matched_ids: only these matched entities are loaded (see keys.py)
+def group(mocker, entities, use_index, use_fuzzy_index=False, matched_count=10, matched_ids=None):
+    mocker.patch('source_grouping.main.get_session', return_value=UnifiedAlchemyMagicMock())
+    merges = mocker.patch('source_grouping.main.merge_entities')
+    suggestions = mocker.patch('source_grouping.main.suggested_merge_entities')
+    entities_matched = [e for e in entities[:matched_count] if matched_ids is None or e["id"] in matched_ids]
+    entities_to_match = entities[matched_count:]
+    index = BlockingIndex(entities_matched + entities_to_match) if use_index else None
+    fuzzy_index = FuzzyIndex(entities_matched + entities_to_match, FUZZY_MATCH_SUGGESTED_THRESHOLD) \
+        if use_fuzzy_index else None
+    while len(entities_to_match) > 0:
+        entity = entities_to_match.pop()
+        match_entity(entity, entities_matched, entities_to_match, index, fuzzy_index)
+    return merges.call_args_list, suggestions.call_args_list
+
+
+def test_blocking_index_finds_every_auto_match():
+    entities = create_entities(80)
+    index = BlockingIndex(entities)
+    for e1 in entities:
+        candidates = index.candidates(e1)
+        for e2 in entities:
+            if e1 is not e2 and is_auto_match(e1, e2)[0]:
+                assert e2["id"] in candidates
+
+
+def test_grouping_with_blocking_index_gives_the_same_merges_and_suggestions(mocker):
+    entities = create_entities(80)
+    merges, suggestions = group(mocker, copy.deepcopy(entities), use_index=False)
+    indexed_merges, indexed_suggestions = group(mocker, copy.deepcopy(entities), use_index=True)
+    assert len(merges) > 0 and len(suggestions) > 0
+    assert indexed_merges == merges
+    assert indexed_suggestions == suggestions
+
+
+def test_fuzzy_index_finds_every_suggested_match():
+    entities = [e for e in create_entities(150, seed=2)
+                if all(o.get("base_url", "") is not None for o in e["origins"])]
+    fuzzy_index = FuzzyIndex(entities, FUZZY_MATCH_SUGGESTED_THRESHOLD)
+    for e1 in entities:
+        candidates = fuzzy_index.get_candidates(e1)
+        for e2 in entities:
+            if e1 is not e2 and is_suggested_match(e1, e2)[0]:
+                assert e2["id"] in candidates
+    assert sum(len(c) for c in fuzzy_index.candidates.values()) < len(entities) * (len(entities) - 1)
+
+
+def test_fuzzy_index_misses_no_suggested_match_of_benchmark_entities():
+    entities = create_benchmark_entities(3000)
+    fuzzy_index = FuzzyIndex(entities, FUZZY_MATCH_SUGGESTED_THRESHOLD)
+    suggested = missed = 0
+    for i, e1 in enumerate(entities[:400]):
+        candidates = fuzzy_index.get_candidates(e1)
+        for e2 in entities[i + 1:400]:
+            if is_suggested_match(e1, e2)[0]:
+                suggested += 1
+                missed += e2["id"] not in candidates
+    assert suggested > 0
+    assert missed == 0
+
+
+def test_grouping_with_fuzzy_index_gives_the_same_merges_and_suggestions(mocker):
+    entities = create_entities(80)
+    merges, suggestions = group(mocker, copy.deepcopy(entities), use_index=False)
+    indexed_merges, indexed_suggestions = group(mocker, copy.deepcopy(entities), use_index=True, use_fuzzy_index=True)
+    assert len(merges) > 0 and len(suggestions) > 0
+    assert indexed_merges == merges
+    assert indexed_suggestions == suggestions
+
+
+# Grouping keys of the entities, queried as in grouping_keys
+def store_grouping_keys(mocker, entities):
+    score_cutoff = get_score_cutoff(FUZZY_MATCH_SUGGESTED_THRESHOLD)
+    # kind -> key -> {(entity id, value)}
+    rows = defaultdict(lambda: defaultdict(set))
+    for e in entities:
+        for kind, key, value in get_grouping_keys(e, score_cutoff):
+            rows[kind][key].add((e["id"], value))
+    mocker.patch('source_grouping.keys.select_keys', side_effect=lambda kind, keys=None: [
+        (i, key, v) for key in (rows[kind] if keys is None else keys) for i, v in rows[kind].get(key, ())])
+    mocker.patch('source_grouping.keys.count_keys', side_effect=lambda kind, keys: {
+        key: len({v for _, v in rows[kind][key]}) for key in keys if key in rows[kind]})
+    mocker.patch('source_grouping.keys.select_values_with_tokens', side_effect=lambda kind, tokens: set.intersection(
+        *[rows[kind].get(token, set()) for token in tokens]))
+
+
+def test_incremental_grouping_gives_the_same_merges_and_suggestions(mocker):
+    entities = create_entities(150, seed=2)
+    store_grouping_keys(mocker, entities[:120])
+    matched_ids = find_matched_candidates(copy.deepcopy(entities[120:]), FUZZY_MATCH_SUGGESTED_THRESHOLD)
+    assert 0 < len(matched_ids) < 120
+
+    merges, suggestions = group(mocker, copy.deepcopy(entities), use_index=True, use_fuzzy_index=True,
+                                matched_count=120)
+    incremental_merges, incremental_suggestions = group(mocker, copy.deepcopy(entities), use_index=True,
+                                                        use_fuzzy_index=True, matched_count=120,
+                                                        matched_ids=matched_ids)
+    assert len(merges) > 0 and len(suggestions) > 0
+    assert incremental_merges == merges
+    assert incremental_suggestions == suggestions
+
+
+def test_incremental_probe_finds_every_match_of_benchmark_entities(mocker):
+    entities = create_benchmark_entities(2000)
+    matched, new = entities[:1700], entities[1700:]
+    store_grouping_keys(mocker, matched)
+    matched_ids = find_matched_candidates(new, FUZZY_MATCH_SUGGESTED_THRESHOLD)
+    matches = {e2["id"] for e1 in new for e2 in matched if is_auto_match(e1, e2)[0] or is_suggested_match(e1, e2)[0]}
+    assert len(matches) > 0
+    assert matches <= matched_ids
+    assert len(matched_ids) < len(matched)
+
+
+def test_stale_entities_include_origins_with_changed_keys_and_updated_twitter_profiles(mocker):
+    statements = []
+    mocker.patch('source_grouping.keys.get_session', return_value=Session())
+    mocker.patch.object(Query, 'all', autospec=True, side_effect=lambda query: statements.append(
+        str(query.statement.compile(dialect=postgresql.dialect()))) or [])
+
+    assert select_stale_entity_ids() == []
+    assert "coalesce(manav3.origins.keys_changed_at, manav3.origins.time_created) > " \
+           "grouping_keys_1.time_created" in statements[0]
+    assert "coalesce(manav3.twitter_profiles.time_updated, manav3.twitter_profiles.time_created) > " \
+           "grouping_keys_1.time_created" in statements[0]
+    assert "origins.time_updated" not in statements[0]
+
+
+def query_returning(rows):
+    query = MagicMock()
+    for method in ("join", "outerjoin", "filter", "order_by"):
+        getattr(query, method).return_value = query
+    query.all.return_value = rows
+    return query
+
+
+def test_get_repartition_entities_loads_entities_and_origins_with_two_queries(mocker):
+    session = MagicMock()
+    session.query.side_effect = [
+        query_returning([(1, "greenpeace", False, True), (2, "wwf", True, False), (3, "bund", None, None)]),
+        query_returning([(1, "twitter_origin", "greenpeace", "https://www.greenpeace.org", None, None),
+                         (1, "web_origin", None, None, "https://www.greenpeace.org/korea/", "https://www.greenpeace.org"),
+                         (2, "rss_origin", None, None, None, None),
+                         (9, "web_origin", None, None, "https://www.bund.net", "https://www.bund.net")])
+    ]
+    mocker.patch('source_grouping.entities.get_session', return_value=session)
+
+    entities_matched, entities_to_match = get_repartition_entities()
+
+    assert session.query.call_count == 2
+    assert list(entities_matched) == [{"id": 1, "name": "greenpeace", "is_reference": False, "origins": [
+        {"type": "twitter_origin", "screen_name": "greenpeace", "twitter_profile_url": "https://www.greenpeace.org"},
+        {"type": "web_origin", "expanded_url": "https://www.greenpeace.org/korea/",
+         "base_url": "https://www.greenpeace.org"}]}]
+    assert [e["id"] for e in entities_to_match] == [2, 3]
+    assert entities_to_match[0]["origins"] == [{"type": "rss_origin"}]
+    # Marks of match_entity are kept until the entity leaves the list
+    entities_to_match[0]["auto_matched"] = True
+    assert entities_to_match.pop() == {"id": 3, "name": "bund", "is_reference": False, "origins": []}
+    assert len(entities_to_match) == 1
+    assert "auto_matched" in entities_to_match.pop()
+    assert len(entities_to_match) == 0